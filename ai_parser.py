@@ -5,15 +5,31 @@ AI Parser module for extracting expense data from text and PDFs using Claude.
 import base64
 import json
 import os
+import random
+import threading
+import time
 from dotenv import load_dotenv
 from anthropic import Anthropic
 
+import local_extract
+from parse_cache import ParseCache, content_key
+
 # Load environment variables
 load_dotenv()
 
 # Initialize Anthropic client
 client = Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY'))
 
+MODEL = "claude-sonnet-4-6"
+
+# Results by content, so a re-submitted invoice costs no tokens. Set
+# PARSE_CACHE_FILE to '' to turn it off.
+cache = ParseCache(
+    os.getenv('PARSE_CACHE_FILE', 'data/parse-cache.sqlite3'),
+    ttl=int(os.getenv('PARSE_CACHE_TTL_DAYS', '30')) * 24 * 3600,
+    max_entries=int(os.getenv('PARSE_CACHE_MAX_ENTRIES', '10000')),
+)
+
 # The field list is shared by both entry points; only the framing differs.
 # Text is pasted inline, a PDF rides along as an attached document block.
 EXPENSE_FIELDS = """Parse this email/document and extract expense information.
@@ -49,29 +65,88 @@ Return ONLY valid JSON, no other text."""
 # Refusing early gives a readable error instead of an opaque one from the API.
 MAX_PDF_BYTES = 20 * 1024 * 1024
 
+# Part of every cache key: editing a prompt or switching model invalidates
+# the results the old one produced.
+TEXT_PROMPT_VERSION = MODEL + '\n' + PARSE_PROMPT
+PDF_PROMPT_VERSION = MODEL + '\n' + PDF_PROMPT
+
+
+# Answers that mean "slow down": rate limited, or the API is overloaded
+RETRY_STATUSES = (429, 529)
+MAX_BACKOFF = 60
+
+
+class _Backoff:
+    """
+    One pause shared by every thread in the process.
 
-def _ask_claude(content) -> dict:
+    When one call is rate limited, the others hold off too instead of each
+    running into the same limit.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._until = 0.0
+
+    def wait(self):
+        delay = self._until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, attempt: int, retry_after: str = None):
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            # Exponential, with jitter so waiting threads don't retry in step
+            delay = min(MAX_BACKOFF, 2 ** attempt) * random.uniform(0.5, 1.0)
+        with self._lock:
+            self._until = max(self._until, time.monotonic() + delay)
+
+
+_backoff = _Backoff()
+
+
+def _create_message(content, options: dict, retries: int):
+    """client.messages.create, retried up to `retries` times when rate limited."""
+    for attempt in range(retries + 1):
+        _backoff.wait()
+        try:
+            return client.messages.create(
+                model=MODEL,
+                max_tokens=1024,
+                thinking={"type": "disabled"},
+                output_config={"effort": "low"},
+                messages=[
+                    {"role": "user", "content": content}
+                ],
+                **options,
+            )
+        except Exception as e:
+            if getattr(e, 'status_code', None) not in RETRY_STATUSES or attempt == retries:
+                raise
+            headers = getattr(getattr(e, 'response', None), 'headers', None) or {}
+            _backoff.pause(attempt, headers.get('retry-after'))
+
+
+def _ask_claude(content, timeout: float = None, retries: int = 0) -> dict:
     """
     Send message content to Claude and parse the expense JSON it returns.
 
     Args:
         content: A string, or a list of content blocks (text, document, ...)
+        timeout: Seconds per attempt; the client's default when omitted
+        retries: Extra attempts after a rate limit or overload, backing off
+                 in between. Worth it in batches; an interactive request
+                 would rather fail fast.
 
     Returns:
         dict with parsed expense data or error information
     """
     response_text = None
+    options = {'timeout': timeout} if timeout else {}
 
     try:
-        message = client.messages.create(
-            model="claude-sonnet-4-6",
-            max_tokens=1024,
-            thinking={"type": "disabled"},
-            output_config={"effort": "low"},
-            messages=[
-                {"role": "user", "content": content}
-            ]
-        )
+        message = _create_message(content, options, retries)
 
         response_text = next(
             (block.text for block in message.content if block.type == "text"), ""
@@ -108,12 +183,20 @@ def _ask_claude(content) -> dict:
         }
 
 
-def parse_text_with_claude(text: str) -> dict:
+def normalize_text(text: str) -> str:
+    """The text with whitespace runs collapsed, for the cache key."""
+    # Pastes of the same email differ in line endings and indentation, which
+    # mean nothing to the model but would defeat the cache.
+    return ' '.join(text.split())
+
+
+def parse_text_with_claude(text: str, use_cache: bool = True) -> dict:
     """
     Parse text content with Claude to extract expense information.
 
     Args:
         text: The email or document text to parse
+        use_cache: False asks Claude even if this text was parsed before
 
     Returns:
         dict with parsed expense data or error information
@@ -121,19 +204,31 @@ def parse_text_with_claude(text: str) -> dict:
     # Limit text length to avoid token limits
     text = text[:5000]
 
-    return _ask_claude(PARSE_PROMPT.format(content=text))
+    return cache.get_or_parse(
+        content_key(TEXT_PROMPT_VERSION, normalize_text(text)),
+        lambda: _ask_claude(PARSE_PROMPT.format(content=text)),
+        use_cache,
+    )
 
 
-def parse_pdf_with_claude(pdf_data: bytes, filename: str = None) -> dict:
+def parse_pdf_with_claude(pdf_data: bytes, filename: str = None,
+                          use_cache: bool = True, timeout: float = None,
+                          retries: int = 0, local: bool = True) -> dict:
     """
     Parse a PDF with Claude by attaching it as a document block.
 
     Claude renders every page, so this reads scanned and rasterized invoices
     that carry no text layer - the ones local text extraction sees as empty.
+    Invoices from vendors with learned rules don't get that far: see
+    local_extract.
 
     Args:
         pdf_data: Binary PDF data
         filename: Optional filename, which often carries the vendor or invoice number
+        use_cache: False asks Claude even if this PDF was parsed before
+        timeout: Seconds to give each attempt at the API call
+        retries: Extra attempts when rate limited (see _ask_claude)
+        local: False skips local extraction and always asks Claude
 
     Returns:
         dict with parsed expense data or error information
@@ -147,9 +242,29 @@ def parse_pdf_with_claude(pdf_data: bytes, filename: str = None) -> dict:
                      f'The limit is {MAX_PDF_BYTES // (1024 * 1024)}MB.'
         }
 
+    if local:
+        started = time.perf_counter()
+        result = local_extract.extract(pdf_data)
+        elapsed_us = int((time.perf_counter() - started) * 1e6)
+        if result is not None:
+            local_extract.stats.add(local_hits=1, local_hit_us=elapsed_us)
+            return result
+        local_extract.stats.add(local_misses=1, local_miss_us=elapsed_us)
+
     filename_note = f' Its filename is "{filename}".' if filename else ''
 
-    return _ask_claude([
+    # The filename is part of the prompt, so it is part of the key too
+    return cache.get_or_parse(
+        content_key(PDF_PROMPT_VERSION, filename_note, pdf_data),
+        lambda: _ask_pdf(pdf_data, filename_note, timeout, retries),
+        use_cache,
+    )
+
+
+def _ask_pdf(pdf_data: bytes, filename_note: str, timeout: float = None,
+             retries: int = 0) -> dict:
+    started = time.perf_counter()
+    result = _ask_claude([
         {
             "type": "document",
             "source": {
@@ -162,4 +277,7 @@ def parse_pdf_with_claude(pdf_data: bytes, filename: str = None) -> dict:
             "type": "text",
             "text": PDF_PROMPT.format(filename_note=filename_note),
         },
-    ])
+    ], timeout, retries)
+    local_extract.stats.add(claude_pdf_calls=1,
+                            claude_pdf_us=int((time.perf_counter() - started) * 1e6))
+    return result
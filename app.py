@@ -1,24 +1,46 @@
 import click
-from flask import Flask, render_template, request, jsonify, send_file
-# from apscheduler.schedulers.background import BackgroundScheduler  # Phase 3
+from flask import Flask, Response, render_template, request, jsonify, send_file, stream_with_context
 from config import Config
-from models import db, Expense
-# from email_parser import fetch_new_emails  # Phase 3
-from ai_parser import parse_text_with_claude, parse_pdf_with_claude
-from currency import convert_to_eur
-from export import generate_excel_report, get_export_filename
-from datetime import datetime, date
+from models import db, Attachment, Expense, IdempotencyKey, MonthlyRollup
+from ai_parser import parse_text_with_claude, parse_pdf_with_claude, cache as parse_cache
+from currency import convert_to_eur, load_rate_history, rate_provider, ECB_HISTORY_URL
+from export import (generate_excel_report, get_export_filename, parquet_available,
+                    EXPORT_COLUMNS, STREAM_FORMATS)
+import attachments
+import bulk
+import email_worker
+import ingest
+import local_extract
+import rollup
+import serialize
+from parse_jobs import pool as parse_pool
+from response_cache import cache as response_cache, versioned
+from reconcile import VENDOR_ALIASES
+from datetime import datetime, date, timedelta
 from decimal import Decimal
-from io import BytesIO
-from sqlalchemy import func, extract, or_
+from sqlalchemy import delete, func, or_, select, true, tuple_, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import load_only
 from sqlalchemy.exc import IntegrityError
+from psycopg2.extras import execute_values
 import base64
+import hashlib
+import logging
+import os
+import binascii
+import time
+import requests
 
 app = Flask(__name__)
 app.config.from_object(Config)
 
 # Initialize database
 db.init_app(app)
+parse_pool.init_app(app)
+response_cache.init_app(app)
+
+# Fetch today's ECB rates as they are published, not in the first request after
+rate_provider.start()
 
 
 # Blocks a submission being saved twice. A double-clicked Save fires the two
@@ -35,6 +57,19 @@ DUPLICATE_INVOICE_INDEX = '''
       AND vendor_name IS NOT NULL
 '''
 
+# The row an expense would repeat under it. The amount is compared as stored,
+# rounded to cents.
+SAME_INVOICE = '''
+    vendor_name = %(vendor_name)s AND invoice_number = %(invoice_number)s
+    AND amount = %(amount)s::numeric(10, 2) AND expense_date = %(expense_date)s
+'''
+
+# A page of the expense list may not be larger than this, whatever the client asks.
+MAX_PAGE_SIZE = 500
+
+# Idempotency-Keys are forgotten after this; a client retries within minutes
+IDEMPOTENCY_KEY_RETENTION = timedelta(days=1)
+
 
 # CLI Commands
 @app.cli.command('reset-db')
@@ -57,7 +92,19 @@ def init_db():
 
 @app.cli.command('migrate-db')
 def migrate_db():
-    """Add missing columns and indexes to existing tables."""
+    """Add missing tables, columns and indexes."""
+    # New tables come from the models; existing ones are left alone.
+    db.create_all()
+    # Ingest batches queue their files as parse jobs
+    db.session.execute(db.text('''
+        ALTER TABLE parse_jobs
+        ADD COLUMN IF NOT EXISTS batch_id VARCHAR(32) REFERENCES ingest_batches (id) ON DELETE CASCADE
+    '''))
+    db.session.execute(db.text(
+        'CREATE INDEX IF NOT EXISTS ix_parse_jobs_batch_id ON parse_jobs (batch_id)'))
+    # Lets each keyed POST prune the expired Idempotency-Keys
+    db.session.execute(db.text(
+        'CREATE INDEX IF NOT EXISTS ix_idempotency_keys_created_at ON idempotency_keys (created_at)'))
     db.session.execute(db.text('''
         ALTER TABLE expenses
         ADD COLUMN IF NOT EXISTS cost_category VARCHAR(20),
@@ -65,57 +112,323 @@ def migrate_db():
         ADD COLUMN IF NOT EXISTS expense_date DATE,
         ADD COLUMN IF NOT EXISTS amount_eur NUMERIC(10, 2),
         ADD COLUMN IF NOT EXISTS exchange_rate NUMERIC(10, 6),
-        ADD COLUMN IF NOT EXISTS external_id VARCHAR(100)
+        ADD COLUMN IF NOT EXISTS external_id VARCHAR(100),
+        ADD COLUMN IF NOT EXISTS attachment_sha256 VARCHAR(64) REFERENCES attachments (sha256),
+        ADD COLUMN IF NOT EXISTS attachment_size INTEGER
     '''))
     db.session.execute(db.text(DUPLICATE_INVOICE_INDEX))
     db.session.execute(db.text('''
         CREATE UNIQUE INDEX IF NOT EXISTS expenses_external_id_key
         ON expenses (external_id) WHERE external_id IS NOT NULL
     '''))
+    # The paginated expense list walks (created_at, id), where a NULL would
+    # compare as neither before nor after the cursor and drop out of every page
+    # but the first. Rows that predate the default get a time near their own.
+    db.session.execute(db.text('''
+        UPDATE expenses SET created_at = COALESCE(email_date, expense_date, 'epoch')
+        WHERE created_at IS NULL
+    '''))
+    db.session.execute(db.text('ALTER TABLE expenses ALTER COLUMN created_at SET NOT NULL'))
+    # Serves the paginated expense list, which walks (created_at, id) newest first.
+    db.session.execute(db.text('''
+        CREATE INDEX IF NOT EXISTS expenses_created_at_id_idx
+        ON expenses (created_at, id)
+    '''))
+    # Year filtering is a range on expense_date (see year_filter); the type-led
+    # indexes serve the per-type summaries and the vendor ranking.
+    db.session.execute(db.text('''
+        CREATE INDEX IF NOT EXISTS expenses_expense_date_idx
+        ON expenses (expense_date)
+    '''))
+    db.session.execute(db.text('''
+        CREATE INDEX IF NOT EXISTS expenses_type_expense_date_idx
+        ON expenses (type, expense_date)
+    '''))
+    db.session.execute(db.text('''
+        CREATE INDEX IF NOT EXISTS expenses_type_vendor_name_idx
+        ON expenses (type, vendor_name)
+    '''))
+    # Lets the delete path find out whether anything still uses an attachment.
+    db.session.execute(db.text('''
+        CREATE INDEX IF NOT EXISTS expenses_attachment_sha256_idx
+        ON expenses (attachment_sha256) WHERE attachment_sha256 IS NOT NULL
+    '''))
+    # PDFs are already compressed. Stored uncompressed out of line, a download
+    # can read one slice at a time instead of detoasting the whole file.
+    db.session.execute(db.text('ALTER TABLE attachments ALTER COLUMN data SET STORAGE EXTERNAL'))
+    # First run after monthly_rollup was added: fill it from what is already there.
+    if MonthlyRollup.query.first() is None:
+        with raw_cursor() as cur:
+            rollup.rebuild(cur)
     db.session.commit()
     click.echo('Database migrated successfully.')
 
 
+@app.cli.command('migrate-attachments')
+@click.option('--batch-size', default=20, show_default=True,
+              help='Attachments moved per transaction.')
+def migrate_attachments(batch_size):
+    """Move PDFs out of expenses.attachment_data into the attachment store."""
+    legacy = db.session.execute(db.text('''
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'expenses' AND column_name = 'attachment_data'
+    ''')).first()
+    if legacy is None:
+        click.echo('Nothing to migrate: expenses has no attachment_data column.')
+        return
+
+    moved, last_id = 0, 0
+    while True:
+        # Walk by id, so each batch reads only its own rows' PDFs.
+        rows = db.session.execute(db.text('''
+            SELECT id, attachment_data FROM expenses
+            WHERE id > :last_id AND attachment_data IS NOT NULL
+            ORDER BY id LIMIT :batch_size
+        '''), {'last_id': last_id, 'batch_size': batch_size}).all()
+        if not rows:
+            break
+        for expense_id, data in rows:
+            digest, size = attachments.store(bytes(data))
+            db.session.execute(db.text('''
+                UPDATE expenses
+                SET attachment_sha256 = :digest, attachment_size = :size,
+                    attachment_data = NULL
+                WHERE id = :id
+            '''), {'digest': digest, 'size': size, 'id': expense_id})
+        db.session.commit()
+        moved += len(rows)
+        last_id = rows[-1][0]
+        click.echo(f'  moved {moved} attachments (through id {last_id})')
+
+    click.echo(f'Moved {moved} attachments. Once backed up, reclaim the space with:')
+    click.echo('  ALTER TABLE expenses DROP COLUMN attachment_data;')
+
+
+# Set from VALUES in one statement per batch, rather than an UPDATE per row
+BACKFILL_UPDATE = '''
+    UPDATE expenses
+    SET amount_eur = v.amount_eur, exchange_rate = v.exchange_rate
+    FROM (VALUES %s) AS v (id, amount_eur, exchange_rate)
+    WHERE expenses.id = v.id
+'''
+
+
 @app.cli.command('backfill-eur')
-def backfill_eur():
+@click.option('--batch-size', default=5000, show_default=True,
+              help='Expenses converted per transaction.')
+@click.option('--checkpoint', default='.backfill-eur.checkpoint', show_default=True,
+              help='File recording progress, so an interrupted run resumes where it stopped.')
+def backfill_eur(batch_size, checkpoint):
     """Backfill EUR conversion for existing expenses."""
-    expenses = Expense.query.filter(Expense.amount_eur == None).all()
-    count = 0
-    for expense in expenses:
-        amount = Decimal(str(expense.amount))
-        amount_eur, exchange_rate = convert_to_eur(amount, expense.currency)
-        expense.amount_eur = amount_eur
-        expense.exchange_rate = exchange_rate
-        count += 1
-    db.session.commit()
+    # Rows already converted drop out of the query by themselves; the checkpoint
+    # also skips the ones a previous run could not convert.
+    last_id = 0
+    if os.path.exists(checkpoint):
+        with open(checkpoint) as handle:
+            last_id = int(handle.read().strip() or 0)
+        click.echo(f'Resuming after id {last_id} (delete {checkpoint} to start over).')
+
+    count = skipped = 0
+    started = time.monotonic()
+    while True:
+        rows = db.session.execute(db.text('''
+            SELECT id, amount, currency, expense_date FROM expenses
+            WHERE id > :last_id AND amount_eur IS NULL
+            ORDER BY id LIMIT :batch_size
+        '''), {'last_id': last_id, 'batch_size': batch_size}).all()
+        if not rows:
+            break
+
+        # Rates come from the in-memory ECB history, so this loop does no I/O
+        values = []
+        for expense_id, amount, currency, expense_date in rows:
+            amount_eur, exchange_rate = convert_to_eur(amount, currency, expense_date)
+            if amount_eur is None:
+                skipped += 1
+            else:
+                values.append((expense_id, amount_eur, exchange_rate))
+
+        if values:
+            ids = [row[0] for row in values]
+            adjust_rollup(ids, -1)
+            with raw_cursor() as cur:
+                execute_values(cur, BACKFILL_UPDATE, values,
+                               template='(%s, %s::numeric, %s::numeric)', page_size=len(values))
+            adjust_rollup(ids, 1)
+        db.session.commit()
+
+        last_id = rows[-1][0]
+        with open(checkpoint, 'w') as handle:
+            handle.write(str(last_id))
+        count += len(values)
+        rate = count / max(time.monotonic() - started, 1e-9)
+        click.echo(f'  converted {count} expenses (through id {last_id}), {rate:,.0f} rows/s')
+
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
     click.echo(f'Updated {count} expenses with EUR conversion.')
+    if skipped:
+        click.echo(f'{skipped} expenses left without: no ECB rate for their currency and date.')
+
+
+@app.cli.command('update-ecb-history')
+def update_ecb_history():
+    """Download the ECB's full exchange rate history for dated conversions."""
+    path = app.config['ECB_HISTORY_FILE']
+    response = requests.get(ECB_HISTORY_URL, timeout=60)
+    response.raise_for_status()
+
+    # Written beside the old file and swapped in, so a reader never sees half
+    partial = f'{path}.partial'
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(partial, 'wb') as handle:
+        handle.write(response.content)
+    history = load_rate_history(partial)
+    os.replace(partial, path)
+    click.echo(f'Saved ECB rates {history.first} to {history.last} in {path}.')
+
+
+# The newest expenses with a PDF, per vendor, to learn that vendor's layout from
+VENDOR_SAMPLES = '''
+    SELECT id, vendor_name, amount, currency, type, cost_category, explanation,
+           tags, invoice_number, expense_date, sender_domain, attachment_sha256
+    FROM (
+        SELECT *, row_number() OVER (PARTITION BY vendor_name
+                                     ORDER BY expense_date DESC NULLS LAST, id DESC) AS n
+        FROM expenses
+        WHERE attachment_sha256 IS NOT NULL AND vendor_name IS NOT NULL
+    ) AS newest
+    WHERE n <= :samples
+    ORDER BY vendor_name, n
+'''
 
 
-# Phase 3: Email automation (commented out for now)
-# def check_emails():
-#     """Background job to check for new emails."""
-#     with app.app_context():
-#         print(f"Checking emails at {datetime.now()}")
-#         expenses = fetch_new_emails()
-#
-#         for expense_data in expenses:
-#             expense = Expense(**expense_data)
-#             db.session.add(expense)
-#
-#         if expenses:
-#             db.session.commit()
-#             print(f"Created {len(expenses)} expenses")
-#
-#
-# # Initialize scheduler
-# scheduler = BackgroundScheduler()
-# scheduler.add_job(
-#     func=check_emails,
-#     trigger='interval',
-#     minutes=Config.EMAIL_CHECK_INTERVAL,
-#     id='email_check_job',
-#     replace_existing=True
-# )
+@app.cli.command('learn-vendor-rules')
+@click.option('--samples', default=local_extract.SAMPLES_PER_VENDOR, show_default=True,
+              help='Newest PDFs per vendor to learn from.')
+def learn_vendor_rules(samples):
+    """Learn per-vendor rules for reading invoice PDFs without Claude."""
+    if not local_extract.pypdf_available():
+        raise click.ClickException('pypdf is not installed; it reads the PDFs\' text.')
+
+    aliases = {}
+    for key, vendor in VENDOR_ALIASES.items():
+        aliases.setdefault(vendor, []).append(key)
+
+    by_vendor = {}
+    for row in db.session.execute(db.text(VENDOR_SAMPLES), {'samples': samples}).mappings():
+        by_vendor.setdefault(row['vendor_name'], []).append(row)
+
+    learned = []
+    for vendor, rows in by_vendor.items():
+        markers = {vendor.lower(), *aliases.get(vendor, ())}
+        markers.update(row['sender_domain'].lower() for row in rows if row['sender_domain'])
+        pairs = [({
+            'amount': str(row['amount']),
+            'currency': row['currency'],
+            'type': row['type'],
+            'cost_category': row['cost_category'],
+            'explanation': row['explanation'],
+            'tags': row['tags'] or [],
+            'invoice_number': row['invoice_number'],
+            'expense_date': row['expense_date'].isoformat() if row['expense_date'] else None,
+        }, db.session.get(Attachment, row['attachment_sha256']).data) for row in rows]
+
+        rules = local_extract.learn_vendor(vendor, sorted(markers), pairs)
+        if rules is None:
+            click.echo(f'  {vendor}: no consistent layout in {len(rows)} PDFs')
+        else:
+            learned.append(rules)
+            click.echo(f'  {vendor}: learned from {rules["samples"]} PDFs')
+
+    local_extract.vendor_rules.save(learned)
+    click.echo(f'Saved rules for {len(learned)} of {len(by_vendor)} vendors '
+               f'to {local_extract.vendor_rules.path}.')
+
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups():
+    """Recompute the monthly summary totals from the expenses table."""
+    with raw_cursor() as cur:
+        rollup.rebuild(cur)
+    db.session.commit()
+    click.echo(f'Rebuilt {MonthlyRollup.query.count()} monthly rollup rows.')
+
+
+@app.cli.command('ingest-worker')
+@click.option('--once', is_flag=True, help='Poll once, then exit.')
+def ingest_worker(once):
+    """Poll the invoice mailbox, while no other worker does."""
+    if not (Config.EMAIL_ADDRESS and Config.EMAIL_PASSWORD):
+        raise click.ClickException('Set EMAIL_ADDRESS and EMAIL_PASSWORD to poll a mailbox.')
+    # A long-running process: its log is the only record of what it did
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    email_worker.Worker(app).run(once=once)
+
+
+def raw_cursor():
+    """A DB-API cursor on the session's connection, inside its transaction."""
+    return db.session.connection().connection.cursor()
+
+
+def adjust_rollup(ids, sign):
+    """Add (1) or retract (-1) these expenses in monthly_rollup, as they stand now."""
+    # The rollup reads the rows from the database, so pending changes go first.
+    db.session.flush()
+    with raw_cursor() as cur:
+        rollup.adjust(cur, ids, sign)
+
+
+def insert_expense(values: dict):
+    """
+    Insert an expense unless DUPLICATE_INVOICE_INDEX already holds its invoice.
+
+    A double-click costs one statement rather than a failed transaction and a
+    lookup: the INSERT skips the conflict, and the same statement reads the id
+    of the row it ran into.
+
+    Returns:
+        (id, True) for the new row, or (id of the existing row, False)
+    """
+    with raw_cursor() as cur:
+        cur.execute(f'''
+            WITH saved AS (
+                INSERT INTO expenses ({', '.join(values)})
+                VALUES ({', '.join(f'%({name})s' for name in values)})
+                ON CONFLICT (vendor_name, invoice_number, amount, expense_date)
+                    WHERE invoice_number IS NOT NULL
+                      AND invoice_number <> ''
+                      AND vendor_name IS NOT NULL
+                DO NOTHING
+                RETURNING id
+            )
+            SELECT id, true FROM saved
+            UNION ALL
+            SELECT id, false FROM expenses
+            WHERE NOT EXISTS (SELECT FROM saved) AND {SAME_INVOICE}
+        ''', values)
+        row = cur.fetchone()
+        if row is None:
+            # The other row was committed while the INSERT waited on it, too
+            # late for this statement's snapshot to see it.
+            cur.execute(f'SELECT id, false FROM expenses WHERE {SAME_INVOICE}', values)
+            row = cur.fetchone()
+    return row or (None, False)
+
+
+def replay(key: str, request_sha256: str):
+    """The response to a POST /api/expenses repeating an earlier Idempotency-Key."""
+    earlier = db.session.execute(
+        select(IdempotencyKey.request_sha256, Expense)
+        .join(Expense, Expense.id == IdempotencyKey.expense_id)
+        .where(IdempotencyKey.key == key)
+    ).first()
+    if earlier is None:
+        # Its expense has been deleted since
+        return jsonify({'error': 'The expense created with this Idempotency-Key is gone.'}), 409
+    if earlier.request_sha256 != request_sha256:
+        return jsonify({'error': 'This Idempotency-Key was used for a different expense.'}), 422
+    return jsonify(earlier.Expense.to_dict()), 201
 
 
 def requested_year():
@@ -131,12 +444,30 @@ def year_filter(year):
     """
     if year == 'all':
         return None
+    # A half-open range rather than extract('year', ...), so Postgres can use
+    # the expense_date indexes instead of computing the year of every row.
+    year = int(year)
     return or_(
-        extract('year', Expense.expense_date) == int(year),
+        (Expense.expense_date >= date(year, 1, 1)) & (Expense.expense_date < date(year + 1, 1, 1)),
         Expense.expense_date == None
     )
 
 
+def encode_cursor(expense):
+    """Opaque position after this expense (a listed row) in the newest-first listing."""
+    raw = f'{expense["created_at"].isoformat()}|{expense["id"]}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """(created_at, id) from a cursor, or None if it is not one of ours."""
+    try:
+        created_at, expense_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), int(expense_id)
+    except (binascii.Error, UnicodeError, ValueError):
+        return None
+
+
 @app.route('/')
 def index():
     """Main page showing expenses and stats."""
@@ -144,31 +475,75 @@ def index():
 
 
 @app.route('/api/expenses', methods=['GET', 'POST'])
+@versioned
 def expenses_list():
-    """Get expenses with optional filtering, or create a new expense."""
+    """Get expenses with optional filtering, or create a new expense.
+
+    GET returns every matching expense, unless `limit` is given: then it returns
+    one page, {'expenses': [...], 'next_cursor': ...}, and the next page is
+    requested by passing that cursor back as `after`.
+    """
     if request.method == 'GET':
         expense_type = request.args.get('type')
         cost_category = request.args.get('cost_category')
+        limit = request.args.get('limit', type=int)
+        after = request.args.get('after')
 
-        query = Expense.query
+        # Plain rows rather than Expense objects; see serialize.py
+        query = select(*serialize.COLUMNS)
 
         selected = year_filter(requested_year())
         if selected is not None:
-            query = query.filter(selected)
+            query = query.where(selected)
 
         if expense_type:
-            query = query.filter_by(type=expense_type)
+            query = query.where(Expense.type == expense_type)
         if cost_category:
-            query = query.filter_by(cost_category=cost_category)
+            query = query.where(Expense.cost_category == cost_category)
+
+        query = query.order_by(Expense.created_at.desc(), Expense.id.desc())
+
+        if limit is None:
+            return serialize.json_response(serialize.expense_rows(query))
 
-        query = query.order_by(Expense.created_at.desc())
-        expenses = query.all()
+        if after:
+            position = decode_cursor(after)
+            if position is None:
+                return jsonify({'error': 'Invalid cursor'}), 400
+            query = query.where(tuple_(Expense.created_at, Expense.id) < tuple_(*position))
 
-        return jsonify([e.to_dict() for e in expenses])
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        # One row more than the page tells whether another page follows.
+        expenses = serialize.expense_rows(query.limit(limit + 1))
+        page = expenses[:limit]
+        next_cursor = encode_cursor(page[-1]) if len(expenses) > limit else None
+
+        return serialize.json_response({'expenses': page, 'next_cursor': next_cursor})
 
     elif request.method == 'POST':
         data = request.json
 
+        # A client retrying a request it got no answer to gets the expense the
+        # first attempt created, not a second one.
+        key = request.headers.get('Idempotency-Key')
+        if key:
+            if len(key) > IdempotencyKey.key.type.length:
+                return jsonify({'error': 'Idempotency-Key is too long'}), 400
+            request_sha256 = hashlib.sha256(request.get_data()).hexdigest()
+            db.session.execute(delete(IdempotencyKey).where(
+                IdempotencyKey.created_at < datetime.utcnow() - IDEMPOTENCY_KEY_RETENTION))
+            db.session.commit()
+            # Waits for a concurrent request holding the same key to finish
+            claimed = db.session.execute(
+                insert(IdempotencyKey)
+                .values(key=key, request_sha256=request_sha256)
+                .on_conflict_do_nothing(index_elements=['key'])
+                .returning(IdempotencyKey.key)
+            ).first()
+            if claimed is None:
+                db.session.rollback()
+                return replay(key, request_sha256)
+
         # Parse expense_date if provided, default to today
         expense_date = date.today()
         if data.get('expense_date'):
@@ -180,6 +555,8 @@ def expenses_list():
         # Handle attachment data (base64 encoded)
         attachment_data = None
         attachment_filename = None
+        attachment_sha256 = None
+        attachment_size = None
         has_attachments = False
         if data.get('attachment_data'):
             try:
@@ -188,15 +565,17 @@ def expenses_list():
                 has_attachments = True
             except Exception:
                 pass
+        if attachment_data:
+            attachment_sha256, attachment_size = attachments.store(attachment_data)
 
         # Get amount and currency for EUR conversion
         amount = Decimal(str(data.get('amount', 0)))
         currency = data.get('currency', 'USD')
 
-        # Convert to EUR
-        amount_eur, exchange_rate = convert_to_eur(amount, currency)
+        # Convert to EUR at the rate of the day it was spent
+        amount_eur, exchange_rate = convert_to_eur(amount, currency, expense_date)
 
-        expense = Expense(
+        values = dict(
             amount=amount,
             type=data.get('type', 'cost'),
             cost_category=data.get('cost_category'),
@@ -209,32 +588,49 @@ def expenses_list():
             vendor_name=data.get('vendor_name'),
             invoice_number=data.get('invoice_number'),
             expense_date=expense_date,
-            attachment_data=attachment_data,
             attachment_filename=attachment_filename,
+            attachment_sha256=attachment_sha256,
+            attachment_size=attachment_size,
             has_attachments=has_attachments,
+            created_at=datetime.utcnow(),
         )
 
-        db.session.add(expense)
-        try:
-            db.session.commit()
-        except IntegrityError:
-            # The duplicate-invoice index rejected this. Report the existing row
-            # rather than a 500, so a double-click reads as "already saved".
+        expense_id, created = insert_expense(values)
+        if not created:
+            # Report the existing row rather than a 500, so a double-click reads
+            # as "already saved". Rolling back drops the attachment and the key.
             db.session.rollback()
-            existing = Expense.query.filter_by(
-                vendor_name=expense.vendor_name,
-                invoice_number=expense.invoice_number,
-                amount=expense.amount,
-                expense_date=expense.expense_date,
-            ).first()
             return jsonify({
-                'error': f'Invoice {expense.invoice_number} from '
-                         f'{expense.vendor_name} is already recorded for this '
+                'error': f'Invoice {values["invoice_number"]} from '
+                         f'{values["vendor_name"]} is already recorded for this '
                          f'amount and date.',
-                'existing_id': existing.id if existing else None,
+                'existing_id': expense_id,
             }), 409
 
-        return jsonify(expense.to_dict()), 201
+        if key:
+            db.session.execute(update(IdempotencyKey)
+                               .where(IdempotencyKey.key == key)
+                               .values(expense_id=expense_id))
+        adjust_rollup([expense_id], 1)
+        db.session.commit()
+
+        return jsonify(db.session.get(Expense, expense_id).to_dict()), 201
+
+
+@app.route('/api/expenses/bulk', methods=['POST'])
+def create_expenses_bulk():
+    """Create many expenses at once, from a JSON array or NDJSON. See bulk.py."""
+    limit = app.config['BULK_MAX_ITEMS']
+    if request.mimetype == 'application/x-ndjson':
+        # One past the limit is enough to know it was exceeded
+        items = bulk.read_ndjson(request.stream, limit + 1)
+    else:
+        items = request.get_json(silent=True)
+        if not isinstance(items, list):
+            return jsonify({'error': 'Expected a JSON array of expenses, or NDJSON'}), 400
+    if len(items) > limit:
+        return jsonify({'error': f'More than {limit} expenses in one request'}), 413
+    return jsonify(bulk.save(items))
 
 
 @app.route('/api/expenses/<int:expense_id>', methods=['GET', 'PUT', 'DELETE'])
@@ -247,6 +643,8 @@ def expense_detail(expense_id):
 
     elif request.method == 'PUT':
         data = request.json
+        # Take the row out of its current month; it goes back in once edited.
+        adjust_rollup([expense.id], -1)
 
         # Track if we need to recalculate EUR conversion
         recalculate_eur = False
@@ -278,15 +676,18 @@ def expense_detail(expense_id):
                     pass
             else:
                 expense.expense_date = None
+            # The rate depends on the date
+            recalculate_eur = True
 
-        # Recalculate EUR conversion if amount or currency changed
+        # Recalculate EUR conversion if amount, currency or date changed
         if recalculate_eur:
             amount = Decimal(str(expense.amount))
-            amount_eur, exchange_rate = convert_to_eur(amount, expense.currency)
+            amount_eur, exchange_rate = convert_to_eur(amount, expense.currency, expense.expense_date)
             expense.amount_eur = amount_eur
             expense.exchange_rate = exchange_rate
 
         try:
+            adjust_rollup([expense.id], 1)
             db.session.commit()
         except IntegrityError:
             # Editing a row onto another one's invoice, amount and date hits the
@@ -300,25 +701,43 @@ def expense_detail(expense_id):
         return jsonify(expense.to_dict())
 
     elif request.method == 'DELETE':
+        digest = expense.attachment_sha256
+        adjust_rollup([expense.id], -1)
         db.session.delete(expense)
+        db.session.flush()
+        if digest:
+            attachments.release(digest)
         db.session.commit()
         return '', 204
 
 
 @app.route('/api/expenses/<int:expense_id>/pdf')
 def download_pdf(expense_id):
-    """Download PDF attachment."""
-    expense = Expense.query.get_or_404(expense_id)
+    """Download PDF attachment, streamed from the attachment store.
+
+    The content hash is the ETag, so a repeat download is a 304, and Range
+    requests fetch only the bytes asked for.
+    """
+    expense = Expense.query.options(
+        load_only(Expense.attachment_filename, Expense.attachment_sha256, Expense.attachment_size)
+    ).get_or_404(expense_id)
 
-    if not expense.attachment_data:
+    if not expense.attachment_sha256:
         return jsonify({'error': 'No attachment'}), 404
 
-    return send_file(
-        BytesIO(expense.attachment_data),
+    response = send_file(
+        attachments.AttachmentReader(db.engine, expense.attachment_sha256, expense.attachment_size),
         mimetype='application/pdf',
         as_attachment=True,
-        download_name=expense.attachment_filename
+        download_name=expense.attachment_filename,
+        etag=expense.attachment_sha256,
+        conditional=False,
     )
+    # send_file cannot size an arbitrary file object, and without a length
+    # Werkzeug will not serve ranges - so the conditional step happens here.
+    response.content_length = expense.attachment_size
+    return response.make_conditional(request, accept_ranges=True,
+                                     complete_length=expense.attachment_size)
 
 
 @app.route('/api/parse-text', methods=['POST'])
@@ -331,7 +750,8 @@ def parse_text():
 
     text = data.get('text', '')
 
-    result = parse_text_with_claude(text)
+    # "refresh": true asks Claude again instead of reusing an earlier result
+    result = parse_text_with_claude(text, use_cache=not data.get('refresh'))
 
     if 'error' in result:
         return jsonify({'success': False, 'error': result['error']}), 400
@@ -357,7 +777,9 @@ def parse_pdf():
         pdf_data = file.read()
         filename = file.filename
 
-        result = parse_pdf_with_claude(pdf_data, filename)
+        # refresh=true asks Claude, skipping both the cache and the vendor rules
+        refresh = request.form.get('refresh') == 'true'
+        result = parse_pdf_with_claude(pdf_data, filename, use_cache=not refresh, local=not refresh)
 
         if 'error' in result:
             return jsonify({'success': False, 'error': result['error']}), 400
@@ -374,18 +796,96 @@ def parse_pdf():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+@app.route('/api/parse-jobs', methods=['POST'])
+def create_parse_job():
+    """Queue an uploaded PDF for parsing; poll GET /api/parse-jobs/<id> for the result."""
+    file = request.files.get('file')
+    if file is None or file.filename == '':
+        return jsonify({'success': False, 'error': 'No file provided'}), 400
+
+    if not file.filename.lower().endswith('.pdf'):
+        return jsonify({'success': False, 'error': 'File must be a PDF'}), 400
+
+    job = parse_pool.submit(file.read(), file.filename,
+                            use_cache=request.form.get('refresh') != 'true')
+    if job is None:
+        response = jsonify({'success': False,
+                            'error': 'Too many PDFs are being parsed. Try again in a moment.'})
+        response.headers['Retry-After'] = '10'
+        return response, 503
+
+    return jsonify(job.to_dict()), 202
+
+
+@app.route('/api/parse-jobs/<job_id>')
+def get_parse_job(job_id):
+    """Status of a parse job, and its result once done."""
+    job = parse_pool.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Unknown or expired parse job'}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route('/api/ingest', methods=['POST'])
+def create_ingest_batch():
+    """Parse and save many invoices: PDFs and zip archives of them, in `files`."""
+    batch = ingest.start(app, request.files.getlist('files'))
+    if batch.total == 0:
+        return jsonify({'success': False, 'error': 'No files provided'}), 400
+    return jsonify(batch.to_dict()), 202
+
+
+@app.route('/api/ingest/<batch_id>')
+def get_ingest_batch(batch_id):
+    """Progress of an ingest batch, and what became of each file once done."""
+    batch = ingest.get(batch_id)
+    if batch is None:
+        return jsonify({'success': False, 'error': 'Unknown ingest batch'}), 404
+    return jsonify(batch.to_dict())
+
+
+@app.route('/api/parse-cache')
+def parse_cache_stats():
+    """Hits, misses, evictions and size of the AI parse cache."""
+    return jsonify(parse_cache.stats())
+
+
+@app.route('/api/local-extraction')
+def local_extraction_stats():
+    """How many PDFs the vendor rules read without Claude, and how fast."""
+    counters = local_extract.stats.get()
+    hits, misses = counters.get('local_hits', 0), counters.get('local_misses', 0)
+    claude_calls = counters.get('claude_pdf_calls', 0)
+
+    def average_ms(total_us, count):
+        return round(total_us / count / 1000, 1) if count else None
+
+    return jsonify({
+        'enabled': local_extract.pypdf_available(),
+        'vendors': len(local_extract.vendor_rules.get()),
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / (hits + misses), 3) if hits + misses else None,
+        'avg_hit_ms': average_ms(counters.get('local_hit_us', 0), hits),
+        'avg_miss_ms': average_ms(counters.get('local_miss_us', 0), misses),
+        'claude_calls': claude_calls,
+        'avg_claude_ms': average_ms(counters.get('claude_pdf_us', 0), claude_calls),
+    })
+
+
 @app.route('/api/years')
+@versioned
 def get_years():
     """Years that actually have expenses, newest first, for the year picker."""
-    rows = db.session.query(
-        extract('year', Expense.expense_date)
-    ).filter(Expense.expense_date != None).distinct().all()
+    # Every dated expense is counted in monthly_rollup, so its years are the same.
+    rows = db.session.query(MonthlyRollup.year).filter(MonthlyRollup.count > 0).distinct().all()
 
     years = sorted({int(row[0]) for row in rows}, reverse=True)
     return jsonify({'years': years, 'current': datetime.now().year})
 
 
 @app.route('/api/stats')
+@versioned
 def get_stats():
     """Get expense statistics in EUR for the selected year."""
     year = requested_year()
@@ -393,32 +893,25 @@ def get_stats():
     # 'all' has no filter; use a no-op so the queries below read the same either way.
     conditions = [] if selected is None else [selected]
 
-    # Total income and costs (using EUR amounts for consistency)
-    income = db.session.query(func.sum(Expense.amount_eur)).filter(
-        Expense.type == 'income',
-        *conditions
-    ).scalar() or 0
-
-    costs = db.session.query(func.sum(Expense.amount_eur)).filter(
-        Expense.type == 'cost',
-        *conditions
-    ).scalar() or 0
+    # One round trip: the totals and the vendor ranking are two CTEs of a single
+    # statement, and each of the (up to ten) result rows carries the totals
+    # alongside one vendor. Sharing one CTE of the selected rows between them
+    # was measured slower - Postgres materializes it, which costs more than
+    # reading the table twice.
 
-    # Count by type
-    income_count = Expense.query.filter(
-        Expense.type == 'income',
-        *conditions
-    ).count()
-    cost_count = Expense.query.filter(
-        Expense.type == 'cost',
-        *conditions
-    ).count()
+    # Total income and costs, and counts by type (using EUR amounts for consistency)
+    totals = db.session.query(
+        func.sum(Expense.amount_eur).filter(Expense.type == 'income').label('income'),
+        func.sum(Expense.amount_eur).filter(Expense.type == 'cost').label('costs'),
+        func.count().filter(Expense.type == 'income').label('income_count'),
+        func.count().filter(Expense.type == 'cost').label('cost_count'),
+    ).filter(*conditions).cte('totals')
 
     # By vendor (using EUR amounts)
-    vendor_stats = db.session.query(
+    vendors = db.session.query(
         Expense.vendor_name,
         func.sum(Expense.amount_eur).label('total'),
-        func.count(Expense.id).label('count')
+        func.count(Expense.id).label('vendor_count')
     ).filter(
         Expense.type == 'cost',
         Expense.vendor_name != None,
@@ -427,7 +920,22 @@ def get_stats():
         Expense.vendor_name
     ).order_by(
         func.sum(Expense.amount_eur).desc()
-    ).limit(10).all()
+    ).limit(10).cte('vendors')
+
+    results = db.session.query(
+        totals.c.income, totals.c.costs, totals.c.income_count, totals.c.cost_count,
+        vendors.c.vendor_name, vendors.c.total, vendors.c.vendor_count
+    ).select_from(totals).outerjoin(vendors, true()).order_by(vendors.c.total.desc()).all()
+
+    first = results[0]
+    income = first.income or 0
+    costs = first.costs or 0
+    income_count = first.income_count
+    cost_count = first.cost_count
+    # With no vendors the outer join still yields the totals, on a NULL vendor.
+    vendor_stats = [
+        (r.vendor_name, r.total, r.vendor_count) for r in results if r.vendor_name is not None
+    ]
 
     return jsonify({
         'year': 'All years' if year == 'all' else int(year),
@@ -444,34 +952,31 @@ def get_stats():
 
 
 @app.route('/api/monthly-summary')
+@versioned
 def get_monthly_summary():
     """Get monthly expense totals grouped by category, plus income and net."""
-    # Query costs grouped by year, month, and category
-    cost_results = db.session.query(
-        extract('year', Expense.expense_date).label('year'),
-        extract('month', Expense.expense_date).label('month'),
-        Expense.cost_category,
-        func.sum(Expense.amount_eur).label('total')
+    # Costs per year, month, and category, precomputed in monthly_rollup
+    cost_results = MonthlyRollup.query.with_entities(
+        MonthlyRollup.year,
+        MonthlyRollup.month,
+        MonthlyRollup.cost_category,
+        MonthlyRollup.total_eur.label('total')
     ).filter(
-        Expense.type == 'cost',
-        Expense.expense_date != None
-    ).group_by(
-        extract('year', Expense.expense_date),
-        extract('month', Expense.expense_date),
-        Expense.cost_category
+        MonthlyRollup.type == 'cost',
+        MonthlyRollup.count > 0
     ).all()
 
-    # Query income grouped by year, month
-    income_results = db.session.query(
-        extract('year', Expense.expense_date).label('year'),
-        extract('month', Expense.expense_date).label('month'),
-        func.sum(Expense.amount_eur).label('total')
+    # Income per year, month
+    income_results = MonthlyRollup.query.with_entities(
+        MonthlyRollup.year,
+        MonthlyRollup.month,
+        func.sum(MonthlyRollup.total_eur).label('total')
     ).filter(
-        Expense.type == 'income',
-        Expense.expense_date != None
+        MonthlyRollup.type == 'income',
+        MonthlyRollup.count > 0
     ).group_by(
-        extract('year', Expense.expense_date),
-        extract('month', Expense.expense_date)
+        MonthlyRollup.year,
+        MonthlyRollup.month
     ).all()
 
     # Organize results by month
@@ -547,30 +1052,31 @@ def summary_view():
 
 
 @app.route('/api/yearly-summary')
+@versioned
 def get_yearly_summary():
     """Get yearly expense totals grouped by category, plus income and net."""
-    # Query costs grouped by year and category
-    cost_results = db.session.query(
-        extract('year', Expense.expense_date).label('year'),
-        Expense.cost_category,
-        func.sum(Expense.amount_eur).label('total')
+    # Costs per year and category, summed from the monthly rollup
+    cost_results = MonthlyRollup.query.with_entities(
+        MonthlyRollup.year,
+        MonthlyRollup.cost_category,
+        func.sum(MonthlyRollup.total_eur).label('total')
     ).filter(
-        Expense.type == 'cost',
-        Expense.expense_date != None
+        MonthlyRollup.type == 'cost',
+        MonthlyRollup.count > 0
     ).group_by(
-        extract('year', Expense.expense_date),
-        Expense.cost_category
+        MonthlyRollup.year,
+        MonthlyRollup.cost_category
     ).all()
 
-    # Query income grouped by year
-    income_results = db.session.query(
-        extract('year', Expense.expense_date).label('year'),
-        func.sum(Expense.amount_eur).label('total')
+    # Income per year
+    income_results = MonthlyRollup.query.with_entities(
+        MonthlyRollup.year,
+        func.sum(MonthlyRollup.total_eur).label('total')
     ).filter(
-        Expense.type == 'income',
-        Expense.expense_date != None
+        MonthlyRollup.type == 'income',
+        MonthlyRollup.count > 0
     ).group_by(
-        extract('year', Expense.expense_date)
+        MonthlyRollup.year
     ).all()
 
     # Organize results by year
@@ -628,14 +1134,36 @@ def get_yearly_summary():
 
 @app.route('/api/export')
 def export_expenses():
-    """Export the selected year's expenses to an Excel file."""
-    year = requested_year()
+    """Export the selected year's expenses.
 
-    query = Expense.query
+    `format` is xlsx (the default), or csv, jsonl or parquet, which are streamed
+    to the client as they are produced.
+    """
+    year = requested_year()
+    export_format = request.args.get('format', 'xlsx')
+    if export_format != 'xlsx' and export_format not in STREAM_FORMATS:
+        return jsonify({'error': f'Unknown export format: {export_format}'}), 400
+    if export_format == 'parquet' and not parquet_available():
+        return jsonify({'error': 'Parquet export needs pyarrow installed'}), 501
+
+    # Only the exported columns, streamed from a server-side cursor a batch at
+    # a time, so neither the ORM nor the driver holds the whole result.
+    query = db.session.query(*(getattr(Expense, name) for name in EXPORT_COLUMNS))
     selected = year_filter(year)
     if selected is not None:
         query = query.filter(selected)
-    expenses = query.order_by(Expense.expense_date.desc()).all()
+    expenses = query.order_by(Expense.expense_date.desc()).yield_per(1000)
+
+    if export_format in STREAM_FORMATS:
+        generate, mimetype, extension = STREAM_FORMATS[export_format]
+        filename = get_export_filename(year, extension)
+        # The cursor is read while the response is sent, so the request (and
+        # with it the session) has to stay open until the last chunk.
+        return Response(
+            stream_with_context(generate(expenses)),
+            mimetype=mimetype,
+            headers={'Content-Disposition': f'attachment; filename="{filename}"'},
+        )
 
     excel_file = generate_excel_report(expenses, year)
     filename = get_export_filename(year)
@@ -648,20 +1176,8 @@ def export_expenses():
     )
 
 
-# Phase 3: Manual email check endpoint (commented out for now)
-# @app.route('/api/check-emails', methods=['POST'])
-# def manual_email_check():
-#     """Manually trigger email check."""
-#     check_emails()
-#     return jsonify({'message': 'Email check triggered'})
-
-
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
 
-    # Phase 3: Start scheduler (commented out for now)
-    # if not scheduler.running:
-    #     scheduler.start()
-
     app.run(debug=True, host='0.0.0.0', port=5055)
@@ -0,0 +1,119 @@
+"""
+Content-addressed storage for PDF attachments.
+
+Each PDF is stored once in the `attachments` table, keyed by the SHA-256 of its
+bytes, and expenses refer to it by that hash. Uploading the same invoice twice
+stores it once, and no query over `expenses` ever has to carry the bytes.
+"""
+
+import hashlib
+import io
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Attachment
+
+# Bytes fetched per query when an attachment is read back out.
+CHUNK_SIZE = 256 * 1024
+
+SLICE = db.text('SELECT substring(data FROM :start FOR :length) '
+                'FROM attachments WHERE sha256 = :sha256')
+
+
+def store(data: bytes):
+    """
+    Add a PDF to the store unless it is already there.
+
+    Runs in the caller's transaction, so a rejected expense takes its new
+    attachment down with it.
+
+    Returns:
+        Tuple of (sha256, size) to record on the expense
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    db.session.execute(
+        insert(Attachment)
+        .values(sha256=digest, size=len(data), data=data)
+        .on_conflict_do_nothing(index_elements=['sha256'])
+    )
+    return digest, len(data)
+
+
+def release(digest: str):
+    """Delete an attachment once no expense refers to it any more."""
+    # The foreign key from expenses makes this fail if another request has just
+    # attached the same PDF; a savepoint keeps that from undoing the caller's work.
+    try:
+        with db.session.begin_nested():
+            db.session.execute(db.text('''
+                DELETE FROM attachments
+                WHERE sha256 = :sha256
+                  AND NOT EXISTS (SELECT 1 FROM expenses WHERE attachment_sha256 = :sha256)
+            '''), {'sha256': digest})
+    except IntegrityError:
+        pass
+
+
+class AttachmentReader(io.RawIOBase):
+    """
+    A stored attachment as a seekable file, read CHUNK_SIZE per query.
+
+    Werkzeug reads a download after the request context is gone, so this holds
+    its own connection from the engine rather than using the session.
+    A Range request seeks straight to its offset and fetches only that slice.
+    Smaller reads, like the 8KB blocks a WSGI file wrapper asks for, are
+    served from the last chunk fetched.
+    """
+
+    def __init__(self, engine, digest: str, size: int):
+        super().__init__()
+        self._engine = engine
+        self._digest = digest
+        self._size = size
+        self._position = 0
+        self._connection = None
+        self._buffer = b''
+        self._buffer_start = 0  # offset of the buffer in the attachment
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: self._size}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def read(self, size=-1):
+        remaining = self._size - self._position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return b''
+        offset = self._position - self._buffer_start
+        if not 0 <= offset < len(self._buffer):
+            if self._connection is None:
+                self._connection = self._engine.connect()
+            self._buffer = bytes(self._connection.execute(SLICE, {
+                'start': self._position + 1,      # SQL substring counts from 1
+                'length': CHUNK_SIZE,
+                'sha256': self._digest,
+            }).scalar() or b'')
+            self._buffer_start = self._position
+            offset = 0
+        chunk = self._buffer[offset:offset + size]
+        self._position += len(chunk)
+        return chunk
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        self._buffer = b''
+        super().close()
@@ -0,0 +1,295 @@
+"""
+Many expenses in one request: POST /api/expenses/bulk, for scripts moving data
+over from another tool.
+
+The body is a JSON array of expenses as POST /api/expenses takes them, or
+NDJSON with one per line. Every item is checked before anything is written,
+and one that is unusable is reported on its own without holding up the rest.
+The EUR conversions are looked up once per currency and day, and the rows go
+in with one multi-row INSERT, in a single transaction.
+
+An item the duplicate-invoice index would refuse (see DUPLICATE_INVOICE_INDEX
+in app.py) - already recorded, or earlier in the same request - is reported as
+a duplicate with the id of the row it repeats, as POST /api/expenses answers
+409. Should the INSERT fail all the same, because another request saved one of
+the invoices in the meantime, the rows are inserted one savepoint at a time
+instead, so each failure stays its own.
+"""
+
+import base64
+import binascii
+import json
+import logging
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+import psycopg2
+from psycopg2 import errorcodes
+from psycopg2.extras import execute_values
+
+import attachments
+import rollup
+from currency import convert_all_to_eur
+from models import db, Expense
+
+logger = logging.getLogger(__name__)
+
+# The columns an item fills, in INSERT order
+COLUMNS = (
+    'amount', 'type', 'cost_category', 'currency', 'explanation', 'tags',
+    'amount_eur', 'exchange_rate', 'source_type', 'vendor_name', 'invoice_number',
+    'expense_date', 'attachment_filename', 'attachment_sha256', 'attachment_size',
+    'has_attachments', 'created_at',
+)
+
+INSERT = f'INSERT INTO expenses ({", ".join(COLUMNS)}) VALUES %s RETURNING id'
+
+# The rows already holding these invoices, under the duplicate-invoice rule
+EXISTING = '''
+    SELECT e.id, e.vendor_name, e.invoice_number, e.amount, e.expense_date
+    FROM expenses e
+    JOIN (VALUES %s) AS k (vendor_name, invoice_number, amount, expense_date)
+      ON e.vendor_name = k.vendor_name AND e.invoice_number = k.invoice_number
+     AND e.amount = k.amount AND e.expense_date = k.expense_date
+    WHERE e.invoice_number IS NOT NULL AND e.invoice_number <> ''
+      AND e.vendor_name IS NOT NULL
+'''
+
+# NUMERIC(10, 2)
+MAX_AMOUNT = Decimal('99999999.99')
+CENT = Decimal('0.01')
+
+STRING_COLUMNS = ('type', 'cost_category', 'currency', 'explanation', 'source_type',
+                  'vendor_name', 'invoice_number', 'attachment_filename')
+
+
+def read_ndjson(stream, limit: int) -> list:
+    """
+    The items of an NDJSON body, reading no further than `limit` of them.
+
+    A line that is not JSON becomes the JSONDecodeError, for save() to report
+    in its place.
+    """
+    items = []
+    for line in stream:
+        if not line.strip():
+            continue
+        if len(items) >= limit:
+            break
+        try:
+            items.append(json.loads(line))
+        except json.JSONDecodeError as e:
+            items.append(e)
+    return items
+
+
+def _text(item: dict, name: str, default=None):
+    value = item.get(name, default)
+    if value is not None and not isinstance(value, str):
+        raise ValueError(f'{name} must be a string')
+    length = Expense.__table__.c[name].type.length
+    if value and length and len(value) > length:
+        raise ValueError(f'{name} is longer than {length} characters')
+    return value
+
+
+def _row(item) -> dict:
+    """The column values for one item, as POST /api/expenses would save it."""
+    if isinstance(item, json.JSONDecodeError):
+        raise ValueError(f'Not valid JSON: {item.msg}')
+    if not isinstance(item, dict):
+        raise ValueError('Not a JSON object')
+
+    row = {name: _text(item, name) for name in STRING_COLUMNS}
+    row['type'] = _text(item, 'type', 'cost')
+    if row['type'] not in ('income', 'cost'):
+        raise ValueError("type must be 'income' or 'cost'")
+    row['currency'] = _text(item, 'currency', 'USD')
+    if not row['currency']:
+        raise ValueError('currency must not be empty')
+    row['source_type'] = _text(item, 'source_type', 'manual')
+
+    # Unlike POST /api/expenses, a date that cannot be read is an error here
+    # rather than today: a migration would otherwise pile them onto one day.
+    row['expense_date'] = date.today()
+    if item.get('expense_date'):
+        try:
+            row['expense_date'] = date.fromisoformat(item['expense_date'])
+        except (TypeError, ValueError):
+            raise ValueError(f'Invalid expense_date {item["expense_date"]!r}')
+
+    try:
+        row['amount'] = Decimal(str(item.get('amount', 0)))
+    except InvalidOperation:
+        raise ValueError(f'Invalid amount {item.get("amount")!r}')
+    if not row['amount'].is_finite() or abs(row['amount']) > MAX_AMOUNT:
+        raise ValueError(f'Invalid amount {item.get("amount")!r}')
+
+    tags = item.get('tags', [])
+    if tags is not None and not (isinstance(tags, list) and all(isinstance(t, str) for t in tags)):
+        raise ValueError('tags must be a list of strings')
+    row['tags'] = tags
+
+    row['attachment_data'] = None
+    if item.get('attachment_data'):
+        try:
+            row['attachment_data'] = base64.b64decode(item['attachment_data'], validate=True)
+        except (binascii.Error, TypeError, ValueError):
+            raise ValueError('attachment_data is not valid base64')
+        row['attachment_filename'] = row['attachment_filename'] or 'attachment.pdf'
+    row['has_attachments'] = row['attachment_data'] is not None
+    return row
+
+
+def _invoice_key(row: dict):
+    """What the duplicate-invoice index compares, or None if it ignores the row."""
+    if not row['invoice_number'] or row['vendor_name'] is None:
+        return None
+    # Rounded as NUMERIC(10, 2) stores it
+    return (row['vendor_name'], row['invoice_number'],
+            row['amount'].quantize(CENT, ROUND_HALF_UP), row['expense_date'])
+
+
+def _existing(cur, keys) -> dict:
+    """Invoice key -> id of the row already holding it."""
+    if not keys:
+        return {}
+    rows = execute_values(cur, EXISTING, list(keys), template='(%s, %s, %s::numeric, %s::date)',
+                          page_size=len(keys), fetch=True)
+    return {(vendor, invoice, amount, day): expense_id
+            for expense_id, vendor, invoice, amount, day in rows}
+
+
+def _duplicate(row: dict, existing_id) -> dict:
+    return {'status': 'duplicate', 'existing_id': existing_id,
+            'error': f'Invoice {row["invoice_number"]} from {row["vendor_name"]} '
+                     f'is already recorded for this amount and date.'}
+
+
+def _values(row: dict) -> tuple:
+    """The row's INSERT values, its attachment stored first.
+
+    Called inside the savepoint the row is inserted in, so a refused row's
+    attachment is rolled back with it."""
+    if row['attachment_data']:
+        row['attachment_sha256'], row['attachment_size'] = \
+            attachments.store(row['attachment_data'])
+    else:
+        row['attachment_sha256'] = row['attachment_size'] = None
+    return tuple(row[column] for column in COLUMNS)
+
+
+def _insert_each(cur, rows) -> list:
+    """Insert row by row, each in a savepoint; returns the ids, or the error
+    where a row was refused."""
+    ids = []
+    for row in rows:
+        cur.execute('SAVEPOINT bulk_row')
+        try:
+            (expense_id,), = execute_values(cur, INSERT, [_values(row)], fetch=True)
+            cur.execute('RELEASE SAVEPOINT bulk_row')
+        except (psycopg2.IntegrityError, psycopg2.DataError) as e:
+            cur.execute('ROLLBACK TO SAVEPOINT bulk_row')
+            expense_id = e
+        ids.append(expense_id)
+    return ids
+
+
+def save(items: list) -> dict:
+    """
+    Insert the usable items and commit.
+
+    Returns:
+        Counts of created, duplicate and invalid items, and a result per item
+        in the order given: {'index', 'status', ...} with the new `id`, the
+        `existing_id` of a duplicate, or an `error`.
+    """
+    results = [None] * len(items)
+    todo = []
+    for n, item in enumerate(items):
+        try:
+            todo.append((n, _row(item)))
+        except ValueError as e:
+            results[n] = {'status': 'invalid', 'error': str(e)}
+
+    converted = convert_all_to_eur((row['amount'], row['currency'], row['expense_date'])
+                                   for _, row in todo)
+    for (n, row), (amount_eur, exchange_rate) in zip(todo, converted):
+        row['amount_eur'], row['exchange_rate'] = amount_eur, exchange_rate
+        if amount_eur is not None and abs(amount_eur) > MAX_AMOUNT:
+            results[n] = {'status': 'invalid', 'error': 'The amount in EUR is too large'}
+    todo = [(n, row) for n, row in todo if results[n] is None]
+
+    with db.session.connection().connection.cursor() as cur:
+        existing = _existing(cur, {key for _, row in todo if (key := _invoice_key(row))})
+
+        # The first item with an invoice key is inserted, any later ones in the
+        # request are duplicates of it.
+        first_with, duplicates, fresh = {}, [], []
+        for n, row in todo:
+            key = _invoice_key(row)
+            if key in existing:
+                results[n] = _duplicate(row, existing[key])
+            elif key is not None and key in first_with:
+                duplicates.append((n, row, first_with[key]))
+            else:
+                if key is not None:
+                    first_with[key] = n
+                fresh.append((n, row))
+
+        created_at = datetime.utcnow()
+        for n, row in fresh:
+            row['created_at'] = created_at
+
+        ids = []
+        if fresh:
+            cur.execute('SAVEPOINT bulk')
+            try:
+                values = [_values(row) for _, row in fresh]
+                # Ids come from a sequence in VALUES order, so sorted they line
+                # up with the rows whatever order RETURNING lists them in.
+                ids = sorted(expense_id for expense_id, in execute_values(
+                    cur, INSERT, values, page_size=len(values), fetch=True))
+                cur.execute('RELEASE SAVEPOINT bulk')
+            except (psycopg2.IntegrityError, psycopg2.DataError) as e:
+                cur.execute('ROLLBACK TO SAVEPOINT bulk')
+                logger.info('Bulk insert of %d expenses failed (%s); inserting one by one',
+                            len(fresh), e)
+                ids = _insert_each(cur, [row for _, row in fresh])
+
+        created = []
+        for (n, row), expense_id in zip(fresh, ids):
+            if (isinstance(expense_id, psycopg2.IntegrityError)
+                    and expense_id.pgcode == errorcodes.UNIQUE_VIOLATION):
+                key = _invoice_key(row)
+                results[n] = _duplicate(row, key and _existing(cur, [key]).get(key))
+            elif isinstance(expense_id, psycopg2.Error):
+                # A check or NOT NULL constraint, or a value the column can't hold
+                results[n] = {'status': 'invalid', 'error': expense_id.pgerror or str(expense_id)}
+            else:
+                results[n] = {'status': 'created', 'id': expense_id}
+                if row['amount_eur'] is None:
+                    results[n]['error'] = 'Saved without a EUR amount: no exchange rate for it yet'
+                created.append(expense_id)
+        for n, row, first in duplicates:
+            if results[first]['status'] == 'invalid':
+                # Never inserted, so there is nothing for it to duplicate
+                results[n] = {'status': 'invalid',
+                              'error': f'Same invoice as item {first}, which is invalid: '
+                                       f'{results[first]["error"]}'}
+            else:
+                results[n] = _duplicate(row, results[first].get('id')
+                                        or results[first].get('existing_id'))
+
+        rollup.adjust(cur, created, 1)
+    db.session.commit()
+
+    for n, result in enumerate(results):
+        result['index'] = n
+    statuses = [result['status'] for result in results]
+    return {
+        'created': statuses.count('created'),
+        'duplicates': statuses.count('duplicate'),
+        'invalid': statuses.count('invalid'),
+        'results': results,
+    }
@@ -19,7 +19,49 @@ class Config:
     EMAIL_ADDRESS = os.environ.get('EMAIL_ADDRESS')
     EMAIL_PASSWORD = os.environ.get('EMAIL_PASSWORD')
     EMAIL_IMAP_SERVER = os.environ.get('EMAIL_IMAP_SERVER', 'imap.gmail.com')
-    EMAIL_CHECK_INTERVAL = 15  # minutes
+    # Port and TLS are overridable to point the poller at a local test server
+    EMAIL_IMAP_PORT = int(os.environ.get('EMAIL_IMAP_PORT', '993'))
+    EMAIL_IMAP_SSL = os.environ.get('EMAIL_IMAP_SSL', 'true').lower() == 'true'
+    # The poller's longest pause in minutes, and its shortest in seconds when mail is coming in
+    EMAIL_CHECK_INTERVAL = int(os.environ.get('EMAIL_CHECK_INTERVAL', '15'))
+    EMAIL_POLL_MIN_SECONDS = int(os.environ.get('EMAIL_POLL_MIN_SECONDS', '60'))
+    # Messages fetched per IMAP round trip, and emails parsed at once
+    EMAIL_FETCH_BATCH = int(os.environ.get('EMAIL_FETCH_BATCH', '50'))
+    EMAIL_PARSE_WORKERS = int(os.environ.get('EMAIL_PARSE_WORKERS', '4'))
     
+    # ECB rate history for converting at the rate of the expense date.
+    # `flask update-ecb-history` downloads it.
+    ECB_HISTORY_FILE = os.environ.get('ECB_HISTORY_FILE', 'data/eurofxref-hist.zip')
+    # Today's rates, shared by all workers. The URL is overridable for tests.
+    ECB_RATES_FILE = os.environ.get('ECB_RATES_FILE', 'data/eurofxref-daily.json')
+    ECB_DAILY_URL = os.environ.get('ECB_DAILY_URL')
+
     # Claude API
     ANTHROPIC_API_KEY = os.environ.get('ANTHROPIC_API_KEY')
+
+    # Background PDF parsing (POST /api/parse-jobs): threads per worker, jobs
+    # queued or running at once across all workers, seconds per API attempt
+    PARSE_JOB_WORKERS = int(os.environ.get('PARSE_JOB_WORKERS', '2'))
+    PARSE_JOB_MAX_PENDING = int(os.environ.get('PARSE_JOB_MAX_PENDING', '10'))
+    PARSE_JOB_TIMEOUT = int(os.environ.get('PARSE_JOB_TIMEOUT', '120'))
+
+    # Batch uploads (POST /api/ingest): files parsed at once per batch, extra
+    # attempts per file when rate limited, and files and unpacked megabytes
+    # accepted per upload
+    INGEST_PARALLELISM = int(os.environ.get('INGEST_PARALLELISM', '4'))
+    INGEST_RETRIES = int(os.environ.get('INGEST_RETRIES', '5'))
+    INGEST_MAX_FILES = int(os.environ.get('INGEST_MAX_FILES', '500'))
+    INGEST_MAX_MB = int(os.environ.get('INGEST_MAX_MB', '200'))
+
+    # Expenses accepted per POST /api/expenses/bulk
+    BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', '10000'))
+
+    # Megabytes of read-endpoint responses each worker keeps; 0 disables
+    RESPONSE_CACHE_MB = int(os.environ.get('RESPONSE_CACHE_MB', '64'))
+
+    # Per-vendor rules for reading PDFs without Claude.
+    # `flask learn-vendor-rules` writes them.
+    VENDOR_RULES_FILE = os.environ.get('VENDOR_RULES_FILE', 'data/vendor-rules.json')
+    # Where GET /api/local-extraction's counts are kept; '' turns them off
+    LOCAL_EXTRACTION_STATS_FILE = os.environ.get('LOCAL_EXTRACTION_STATS_FILE',
+                                                 'data/local-extraction.sqlite3')
@@ -1,99 +1,513 @@
 """
 Currency conversion module using ECB exchange rates.
-Fetches daily rates from the European Central Bank for EUR conversion.
+
+Amounts are converted at the ECB reference rate of the day they were spent,
+looked up in the ECB's full rate history kept in a local file (see
+`flask update-ecb-history`). Only dates the history does not reach fall back
+to today's rate from the daily feed.
 """
 
+import csv
+import fcntl
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
 import xml.etree.ElementTree as ET
-from datetime import date, timedelta
+import zipfile
+from contextlib import contextmanager
+from datetime import date, datetime, time as dt_time, timedelta, timezone
 from decimal import Decimal
 from typing import Optional, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 import requests
 
-# ECB daily exchange rates XML feed
+from config import Config
+
+# ECB daily exchange rates XML feed (Config.ECB_DAILY_URL can point elsewhere)
 ECB_DAILY_URL = 'https://www.ecb.europa.eu/stats/eurofxref/eurofxref-daily.xml'
 
-# Cache for exchange rates (currency -> rate)
-_rates_cache: dict = {}
-_cache_date: Optional[date] = None
+# Every reference rate since 1999, as a zipped CSV
+ECB_HISTORY_URL = 'https://www.ecb.europa.eu/stats/eurofxref/eurofxref-hist.zip'
+
+# How far past the last day in the history its rates still count. Bridges a
+# weekend or the four-day Easter closure until the file is next updated;
+# anything later gets the daily feed's rate only if those rates are for that
+# day or before it, and no rate otherwise.
+HISTORY_GRACE = timedelta(days=4)
+
+# ECB XML namespaces
+NAMESPACES = {
+    'gesmes': 'http://www.gesmes.org/xml/2002-08-01',
+    'eurofxref': 'http://www.ecb.int/vocabulary/2002-08-01/eurofxref'
+}
+
+# When the ECB publishes the day's rates (around 16:00 Frankfurt time), plus a
+# few minutes' slack. The daily rates count as stale from then until fetched.
+ECB_TIMEZONE = 'Europe/Berlin'
+ECB_PUBLISH_TIME = dt_time(16, 5)
+
+# How long to wait before asking the ECB again when it had nothing newer (a
+# holiday, or a late publication) or could not be reached.
+RECHECK_INTERVAL = timedelta(minutes=15)
+
+logger = logging.getLogger(__name__)
+
+
+def _ecb_now() -> datetime:
+    try:
+        return datetime.now(ZoneInfo(ECB_TIMEZONE))
+    except ZoneInfoNotFoundError:
+        # No tz database on this host: CET is close enough to schedule by
+        return datetime.now(timezone(timedelta(hours=1)))
+
+
+def latest_publication(now: datetime) -> date:
+    """The last business day whose rates should be out by `now` (ECB time)."""
+    day = now.date()
+    if now.time() < ECB_PUBLISH_TIME:
+        day -= timedelta(days=1)
+    while day.weekday() >= 5:
+        day -= timedelta(days=1)
+    return day
+
+
+def _next_publication(now: datetime) -> datetime:
+    """When the next business day's rates are due, in ECB time."""
+    due = datetime.combine(now.date(), ECB_PUBLISH_TIME, tzinfo=now.tzinfo)
+    if due <= now:
+        due += timedelta(days=1)
+    while due.weekday() >= 5:
+        due += timedelta(days=1)
+    return due
+
+
+def parse_daily_rates(content: bytes) -> Tuple[date, dict]:
+    """The ECB's eurofxref-daily.xml: (the day it is for, {currency: rate text})."""
+    root = ET.fromstring(content)
+    cube = root.find('.//eurofxref:Cube/eurofxref:Cube', NAMESPACES)
+    if cube is None or not cube.get('time'):
+        raise ValueError('no rates in the ECB daily feed')
+    rates = {}
+    for rate_elem in cube.findall('eurofxref:Cube', NAMESPACES):
+        currency = rate_elem.get('currency')
+        rate = rate_elem.get('rate')
+        if currency and rate:
+            rates[currency] = rate
+    return date.fromisoformat(cube.get('time')), rates
+
+
+class RateProvider:
+    """
+    Today's ECB rates, shared by every worker through one JSON file.
+
+    Lookups never wait on the network once any rates are known: stale rates
+    are served while one thread refreshes them in the background
+    (stale-while-revalidate). Only a process starting with no file at all has
+    to fetch before it can answer.
+
+    Refreshes are single-flight: a thread lock keeps one fetch per process
+    and an flock on `<path>.lock` one per host. The others pick the result
+    up from the file, which is replaced atomically so it is never half
+    written. `start()` also refreshes on a timer just after each ECB
+    publication, so the rates are usually current before anyone asks.
+    """
+
+    def __init__(self, url: str = ECB_DAILY_URL, path: Optional[str] = None,
+                 timeout: float = 10):
+        """
+        Args:
+            url: The daily feed; point it at a local server in tests
+            path: JSON file the workers share; None keeps rates in memory only
+            timeout: Seconds to wait for the feed
+        """
+        self.url = url
+        self.path = path
+        self.timeout = timeout
+        self._rates: Optional[dict] = None      # currency -> Decimal, EUR included
+        self._rates_date: Optional[date] = None  # the business day they are for
+        self._checked_at: float = 0              # last time the feed was asked
+        self._file_mtime: Optional[int] = None
+        self._state_lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._timer: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    @property
+    def rates_date(self) -> Optional[date]:
+        """The business day the current rates are for."""
+        return self._rates_date
+
+    def rates(self) -> dict:
+        """Current rates (1 EUR = X currency), fetching only if there are none."""
+        self._load_file()
+        if self._rates is None:
+            self.refresh(wait=True)
+            if self._rates is None:
+                raise RuntimeError(f'Failed to fetch ECB rates from {self.url}')
+        elif self.is_stale():
+            self.refresh_in_background()
+        return self._rates
+
+    def is_stale(self, now: Optional[datetime] = None) -> bool:
+        """Whether newer rates should be out and the feed is due a check."""
+        if self._rates is None:
+            return True
+        now = now or _ecb_now()
+        if self._rates_date is not None and self._rates_date >= latest_publication(now):
+            return False
+        return time.time() - self._checked_at >= RECHECK_INTERVAL.total_seconds()
+
+    def refresh(self, wait: bool = False) -> bool:
+        """
+        Fetch the feed unless another thread or worker already is.
+
+        Args:
+            wait: Block until the refresh in progress finishes instead of
+                  returning straight away
+
+        Returns:
+            True if this call fetched new rates
+        """
+        if not self._refresh_lock.acquire(blocking=wait):
+            return False
+        try:
+            with self._file_lock(wait) as locked:
+                if not locked:
+                    return False
+                # Whoever held the lock before may have just written the file
+                self._load_file()
+                if not self.is_stale():
+                    return False
+                return self._fetch()
+        finally:
+            self._refresh_lock.release()
+
+    def refresh_in_background(self):
+        """Start a refresh on a daemon thread, unless one is already running."""
+        if self._refresh_lock.locked():
+            return
+        threading.Thread(target=self.refresh, name='ecb-rates-refresh',
+                         daemon=True).start()
+
+    def start(self):
+        """Refresh just after each ECB publication, on a daemon thread."""
+        if self._timer is not None:
+            return
+        self._timer = threading.Thread(target=self._run_timer, name='ecb-rates-timer',
+                                       daemon=True)
+        self._timer.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run_timer(self):
+        while not self._stop.is_set():
+            self.refresh()
+            if self.is_stale():
+                # Published late, a holiday, or the ECB was unreachable
+                delay = RECHECK_INTERVAL.total_seconds()
+            else:
+                now = _ecb_now()
+                delay = (_next_publication(now) - now).total_seconds()
+            self._stop.wait(delay)
+
+    def _fetch(self) -> bool:
+        checked_at = time.time()
+        try:
+            response = requests.get(self.url, timeout=self.timeout)
+            response.raise_for_status()
+            rates_date, raw_rates = parse_daily_rates(response.content)
+        except (requests.RequestException, ET.ParseError, ValueError) as e:
+            logger.warning('Could not fetch ECB rates from %s: %s', self.url, e)
+            if self._rates is None:
+                return False
+            # Keep serving what we have; have every worker wait before retrying
+            rates_date, raw_rates = self._rates_date, self._raw_rates()
+            fetched = False
+        else:
+            fetched = True
+        self._set(rates_date, raw_rates, checked_at)
+        self._save_file(rates_date, raw_rates, checked_at)
+        return fetched
+
+    def _set(self, rates_date: Optional[date], raw_rates: dict, checked_at: float):
+        rates = {'EUR': Decimal('1.0')}  # EUR to EUR is always 1
+        rates.update((currency, Decimal(rate)) for currency, rate in raw_rates.items())
+        with self._state_lock:
+            self._rates = rates
+            self._rates_date = rates_date
+            self._checked_at = checked_at
+
+    def _raw_rates(self) -> dict:
+        return {currency: str(rate) for currency, rate in self._rates.items()
+                if currency != 'EUR'}
+
+    def _load_file(self):
+        """Take up the shared file if another worker has written it since."""
+        if not self.path:
+            return
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._file_mtime:
+            return
+        try:
+            with open(self.path, encoding='utf-8') as handle:
+                saved = json.load(handle)
+            rates_date = date.fromisoformat(saved['date']) if saved.get('date') else None
+            self._set(rates_date, saved['rates'], saved['checked_at'])
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning('Ignoring unreadable ECB rates file %s: %s', self.path, e)
+        self._file_mtime = mtime
+
+    def _save_file(self, rates_date: Optional[date], raw_rates: dict, checked_at: float):
+        if not self.path:
+            return
+        saved = {
+            'date': rates_date.isoformat() if rates_date else None,
+            'checked_at': checked_at,
+            'rates': raw_rates,
+        }
+        directory = os.path.dirname(self.path) or '.'
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, partial = tempfile.mkstemp(dir=directory, suffix='.partial')
+            with os.fdopen(fd, 'w', encoding='utf-8') as handle:
+                json.dump(saved, handle)
+            os.replace(partial, self.path)
+            self._file_mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            logger.warning('Could not save ECB rates to %s: %s', self.path, e)
+
+    @contextmanager
+    def _file_lock(self, wait: bool):
+        """Hold the cross-process refresh lock; yields False if it is taken."""
+        if not self.path:
+            yield True
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            handle = open(self.path + '.lock', 'a')
+        except OSError:
+            # Nowhere to coordinate; at worst each worker fetches once
+            yield True
+            return
+        with handle:
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+rate_provider = RateProvider(Config.ECB_DAILY_URL or ECB_DAILY_URL, Config.ECB_RATES_FILE)
 
 
 def fetch_ecb_rates() -> dict:
     """
-    Fetch current exchange rates from ECB.
+    Current exchange rates from ECB, without waiting on the network if any
+    are cached. See RateProvider.
 
     Returns:
         dict mapping currency codes to exchange rates (1 EUR = X currency)
     """
-    global _rates_cache, _cache_date
+    return rate_provider.rates()
 
-    # Return cached rates if fetched today
-    today = date.today()
-    if _cache_date == today and _rates_cache:
-        return _rates_cache
 
-    try:
-        response = requests.get(ECB_DAILY_URL, timeout=10)
-        response.raise_for_status()
+class RateHistory:
+    """
+    ECB reference rates by day, every calendar day filled in.
 
-        # Parse XML
-        root = ET.fromstring(response.content)
+    The ECB publishes on business days only. A weekend or holiday maps to the
+    same rates as the business day before it, so a lookup is one dict access
+    whatever the date.
+    """
 
-        # ECB XML namespace
-        namespaces = {
-            'gesmes': 'http://www.gesmes.org/xml/2002-08-01',
-            'eurofxref': 'http://www.ecb.int/vocabulary/2002-08-01/eurofxref'
-        }
+    def __init__(self, business_days: dict):
+        """
+        Args:
+            business_days: date -> {currency: rate} for the days the ECB
+                           published, rates as the text the ECB wrote
+        """
+        self._by_day = {}
+        if not business_days:
+            self.first = self.last = None
+            return
+        days = sorted(business_days)
+        self.first = days[0]
+        self.last = days[-1]
+        current = business_days[self.first]
+        day = self.first
+        while day <= self.last + HISTORY_GRACE:
+            current = business_days.get(day, current)
+            self._by_day[day] = current
+            day += timedelta(days=1)
+
+    def __len__(self):
+        return len(self._by_day)
+
+    def covers(self, day: date) -> bool:
+        return day in self._by_day
+
+    def rate(self, day: date, currency: str) -> Optional[Decimal]:
+        """Rate in force for this currency on this day, or None if the ECB had none."""
+        raw = self._by_day.get(day, {}).get(currency)
+        return Decimal(raw) if raw is not None else None
+
+
+def _rate_or_none(raw: str) -> Optional[str]:
+    # Kept as text: a Decimal per rate per day would double the memory, and
+    # only the few rates actually used are ever converted.
+    raw = raw.strip()
+    if not raw or raw == 'N/A':
+        return None
+    return raw
+
+
+def _parse_history_csv(text: str) -> dict:
+    """The ECB's eurofxref-hist.csv: a Date column, then one column per currency."""
+    reader = csv.reader(io.StringIO(text))
+    header = [name.strip() for name in next(reader, [])]
+    business_days = {}
+    for row in reader:
+        if not row or not row[0].strip():
+            continue
+        rates = {}
+        for currency, raw in zip(header[1:], row[1:]):
+            # Currencies the ECB no longer quotes read N/A; a trailing comma
+            # adds an empty column.
+            rate = _rate_or_none(raw) if currency else None
+            if rate is not None:
+                rates[currency] = rate
+        business_days[date.fromisoformat(row[0].strip())] = rates
+    return business_days
+
+
+def _parse_history_xml(content: bytes) -> dict:
+    """The ECB's eurofxref-hist.xml: one <Cube time="..."> per day."""
+    root = ET.fromstring(content)
+    business_days = {}
+    for day in root.iterfind('.//eurofxref:Cube/eurofxref:Cube[@time]', NAMESPACES):
+        rates = {}
+        for rate_elem in day.findall('eurofxref:Cube', NAMESPACES):
+            rate = _rate_or_none(rate_elem.get('rate', ''))
+            if rate is not None:
+                rates[rate_elem.get('currency')] = rate
+        business_days[date.fromisoformat(day.get('time'))] = rates
+    return business_days
+
+
+def load_rate_history(path: str) -> RateHistory:
+    """
+    Read an ECB rate history file: the zip the ECB publishes, or the CSV or
+    XML inside it.
+    """
+    with open(path, 'rb') as handle:
+        content = handle.read()
 
-        rates = {'EUR': Decimal('1.0')}  # EUR to EUR is always 1
+    if zipfile.is_zipfile(io.BytesIO(content)):
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            name = archive.namelist()[0]
+            content = archive.read(name)
+        path = name
 
-        # Find the Cube element containing rates
-        cube = root.find('.//eurofxref:Cube/eurofxref:Cube', namespaces)
-        if cube is not None:
-            for rate_elem in cube.findall('eurofxref:Cube', namespaces):
-                currency = rate_elem.get('currency')
-                rate = rate_elem.get('rate')
-                if currency and rate:
-                    rates[currency] = Decimal(rate)
+    if path.lower().endswith('.xml'):
+        history = RateHistory(_parse_history_xml(content))
+    else:
+        history = RateHistory(_parse_history_csv(content.decode('utf-8-sig')))
+    if not history:
+        raise ValueError(f'No rates in {path}')
+    return history
 
-        # Update cache
-        _rates_cache = rates
-        _cache_date = today
 
-        return rates
+# Loaded on first use and again whenever the file changes; None when there is
+# no history file
+_history: Optional[RateHistory] = None
+_history_mtime: Optional[int] = None
+_history_lock = threading.Lock()
 
-    except Exception as e:
-        # If fetch fails and we have cached rates, use them
-        if _rates_cache:
-            return _rates_cache
-        raise RuntimeError(f'Failed to fetch ECB rates: {e}')
 
+def get_rate_history() -> Optional[RateHistory]:
+    """
+    The rate history from Config.ECB_HISTORY_FILE, or None if there is none.
 
-def get_exchange_rate(currency: str) -> Optional[Decimal]:
+    Reread when the file's mtime changes, as after `flask update-ecb-history`,
+    so running workers pick up the new one.
+    """
+    global _history, _history_mtime
+    path = Config.ECB_HISTORY_FILE
+    try:
+        mtime = os.stat(path).st_mtime_ns if path else None
+    except FileNotFoundError:
+        mtime = None
+    if mtime == _history_mtime:
+        return _history
+    with _history_lock:
+        # Another thread may have loaded it while this one waited
+        if mtime != _history_mtime:
+            try:
+                _history = load_rate_history(path) if mtime is not None else None
+            except (OSError, ValueError, ET.ParseError, zipfile.BadZipFile) as e:
+                # Keep converting with the one already loaded
+                logger.warning('Ignoring unreadable ECB rate history %s: %s', path, e)
+            _history_mtime = mtime
+    return _history
+
+
+def get_exchange_rate(currency: str, on_date: Optional[date] = None) -> Optional[Decimal]:
     """
     Get the exchange rate for a currency (1 EUR = X currency).
 
     Args:
         currency: 3-letter currency code (e.g., 'USD', 'GBP')
+        on_date: Day the rate should apply to. Today's rate when omitted, or
+                 when there is no rate history. A day the history does not
+                 reach gets today's rate only if that is no older than the day.
 
     Returns:
-        Exchange rate as Decimal, or None if currency not supported
+        Exchange rate as Decimal, or None if currency not supported or there
+        is no rate for the day
     """
     currency = currency.upper()
 
     if currency == 'EUR':
         return Decimal('1.0')
 
+    history = get_rate_history() if on_date is not None else None
+    if history is not None and history.covers(on_date):
+        return history.rate(on_date, currency)
+
     rates = fetch_ecb_rates()
+    if history is not None and (rate_provider.rates_date is None
+                                or on_date < rate_provider.rates_date):
+        # Left unconverted rather than at a later day's rate; backfill-eur
+        # converts it once the history reaches the day
+        logger.warning('No ECB rate for %s on %s: the rate history covers %s to %s '
+                       '(`flask update-ecb-history` updates it)',
+                       currency, on_date, history.first, history.last)
+        return None
     return rates.get(currency)
 
 
-def convert_to_eur(amount: Decimal, currency: str) -> Tuple[Optional[Decimal], Optional[Decimal]]:
+def convert_to_eur(amount: Decimal, currency: str,
+                   on_date: Optional[date] = None) -> Tuple[Optional[Decimal], Optional[Decimal]]:
     """
     Convert an amount to EUR using ECB exchange rates.
 
     Args:
         amount: Amount in original currency
         currency: 3-letter currency code
+        on_date: When the amount was spent; the rate of that day is used.
+                 Today's rate when omitted.
 
     Returns:
         Tuple of (amount_eur, exchange_rate) or (None, None) if conversion failed
@@ -103,7 +517,10 @@ def convert_to_eur(amount: Decimal, currency: str) -> Tuple[Optional[Decimal], O
     if currency == 'EUR':
         return (amount, Decimal('1.0'))
 
-    rate = get_exchange_rate(currency)
+    return _apply_rate(amount, get_exchange_rate(currency, on_date))
+
+
+def _apply_rate(amount: Decimal, rate: Optional[Decimal]) -> Tuple[Optional[Decimal], Optional[Decimal]]:
     if rate is None:
         return (None, None)
 
@@ -116,6 +533,38 @@ def convert_to_eur(amount: Decimal, currency: str) -> Tuple[Optional[Decimal], O
     return (amount_eur, rate)
 
 
+def convert_all_to_eur(items) -> list:
+    """
+    convert_to_eur() for many amounts at once, each currency and day looked
+    up once however many amounts share it.
+
+    Where the ECB cannot be reached, the amounts come back as (None, None),
+    as for an unknown currency; `flask backfill-eur` converts them later.
+
+    Args:
+        items: (amount, currency, on_date) tuples
+
+    Returns:
+        List of (amount_eur, exchange_rate), in the order of items
+    """
+    rates = {}
+    converted = []
+    for amount, currency, on_date in items:
+        currency = currency.upper()
+        if currency == 'EUR':
+            converted.append((amount, Decimal('1.0')))
+            continue
+        key = (currency, on_date)
+        if key not in rates:
+            try:
+                rates[key] = get_exchange_rate(currency, on_date)
+            except RuntimeError as e:
+                logger.warning('No %s rate for %s: %s', currency, on_date, e)
+                rates[key] = None
+        converted.append(_apply_rate(amount, rates[key]))
+    return converted
+
+
 def get_supported_currencies() -> list:
     """
     Get list of currencies supported by ECB.
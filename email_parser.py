@@ -1,22 +1,54 @@
+"""
+Expenses from the invoice mailbox (Phase 3).
+
+fetch_new_emails() streams them out as they are parsed. Unread messages are
+read in batches of EMAIL_FETCH_BATCH UIDs: one FETCH brings the headers and
+BODYSTRUCTURE of the whole batch, and a second one just the parts that matter
+- the plain-text body and the first PDF - so images, HTML alternatives and
+other attachments never cross the wire. Claude parses up to
+EMAIL_PARSE_WORKERS emails at once through the client shared with ai_parser,
+while the next batch is fetched.
+
+Messages are fetched with BODY.PEEK and flagged \\Seen in batches once the
+caller has taken them, so if the caller stops half way the rest stay unread.
+email_sync polls by UID instead, for mailboxes where the flag can't be relied on.
+"""
+
+import base64
 import imaplib
-import email
-from email.header import decode_header
-from datetime import datetime
-import anthropic
+import logging
+import quopri
+import re
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from email.header import decode_header, make_header
+from email.parser import BytesHeaderParser
+from email.utils import parseaddr, parsedate_to_datetime
+from itertools import takewhile
+from typing import Iterator, Optional
+
+from ai_parser import _ask_claude
 from config import Config
 
+logger = logging.getLogger(__name__)
+
+HEADERS = 'HEADER.FIELDS (SUBJECT FROM DATE)'
+
+# Characters of the body sent to Claude
+MAX_BODY = 3000
+
 
 def connect_to_email():
     """Connect to email server via IMAP."""
-    mail = imaplib.IMAP4_SSL(Config.EMAIL_IMAP_SERVER)
+    if Config.EMAIL_IMAP_SSL:
+        mail = imaplib.IMAP4_SSL(Config.EMAIL_IMAP_SERVER, Config.EMAIL_IMAP_PORT)
+    else:
+        mail = imaplib.IMAP4(Config.EMAIL_IMAP_SERVER, Config.EMAIL_IMAP_PORT)
     mail.login(Config.EMAIL_ADDRESS, Config.EMAIL_PASSWORD)
     return mail
 
 
-def parse_email_with_claude(email_text, email_subject):
+def parse_email_with_claude(email_text, email_subject, retries: int = 3):
     """Use Claude to extract expense data from email text."""
-    client = anthropic.Anthropic(api_key=Config.ANTHROPIC_API_KEY)
-    
     prompt = f"""Parse this email and extract expense information. Return a JSON object with these fields:
 - amount (number)
 - type ("income" or "cost")
@@ -34,129 +66,356 @@ Email Content:
 
 Return ONLY valid JSON, no other text."""
 
-    message = client.messages.create(
-        model="claude-sonnet-4-6",
-        max_tokens=1000,
-        thinking={"type": "disabled"},
-        output_config={"effort": "low"},
-        messages=[
-            {"role": "user", "content": prompt}
-        ]
-    )
-    
-    # Extract JSON from response
-    response_text = message.content[0].text
-    # Strip markdown code blocks if present
-    if response_text.startswith('```'):
-        response_text = response_text.split('```')[1]
-        if response_text.startswith('json'):
-            response_text = response_text[4:]
-        response_text = response_text.strip()
-    
-    import json
-    return json.loads(response_text)
-
-
-def get_attachment(msg):
-    """Extract first PDF attachment from email message."""
-    for part in msg.walk():
-        if part.get_content_maintype() == 'multipart':
-            continue
-        if part.get('Content-Disposition') is None:
+    return _ask_claude(prompt, retries=retries)
+
+
+# --- IMAP responses -------------------------------------------------------
+
+def _joined(data) -> bytes:
+    """imaplib's split-up response, literals put back in place."""
+    raw = b''
+    for item in data:
+        if isinstance(item, tuple):
+            raw += item[0] + b'\r\n' + item[1]
+        elif item is not None:
+            raw += item
+    return raw
+
+
+_LITERAL = re.compile(rb'\{(\d+)\}\r\n')
+
+
+def _parse(raw: bytes, pos: int = 0):
+    """
+    The IMAP values in raw from pos on, as nested lists.
+
+    Returns:
+        Tuple of (values, position after the closing parenthesis or the end)
+    """
+    values = []
+    while pos < len(raw):
+        char = raw[pos:pos + 1]
+        if char in b' \r\n':
+            pos += 1
+        elif char == b'(':
+            value, pos = _parse(raw, pos + 1)
+            values.append(value)
+        elif char == b')':
+            return values, pos + 1
+        elif char == b'"':
+            end = pos + 1
+            value = bytearray()
+            while raw[end:end + 1] != b'"':
+                if raw[end:end + 1] == b'\\':
+                    end += 1
+                value += raw[end:end + 1]
+                end += 1
+            values.append(bytes(value))
+            pos = end + 1
+        elif char == b'{':
+            match = _LITERAL.match(raw, pos)
+            start = match.end()
+            pos = start + int(match.group(1))
+            values.append(raw[start:pos])
+        else:
+            # An atom; BODY[HEADER.FIELDS (A B)] counts as one, brackets and all
+            end, depth = pos, 0
+            while end < len(raw):
+                c = raw[end:end + 1]
+                if c == b'[':
+                    depth += 1
+                elif c == b']':
+                    depth -= 1
+                elif depth == 0 and c in b' ()\r\n':
+                    break
+                end += 1
+            atom = raw[pos:end]
+            values.append(None if atom.upper() == b'NIL' else atom)
+            pos = end
+    return values, pos
+
+
+def fetch_items(data) -> list:
+    """A FETCH response as one {item name: value} dict per message."""
+    messages = []
+    for value in _parse(_joined(data))[0]:
+        if isinstance(value, list):
+            items = dict(zip(value[::2], value[1::2]))
+            messages.append({name.decode().upper(): item for name, item in items.items()})
+    return messages
+
+
+def uid_set(uids) -> str:
+    """UIDs as an IMAP sequence set, runs collapsed: 1:3,7."""
+    uids = sorted(uids)
+    ranges = []
+    for uid in uids:
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(str(a) if a == b else f'{a}:{b}' for a, b in ranges)
+
+
+# --- BODYSTRUCTURE --------------------------------------------------------
+
+def _text(value) -> str:
+    return value.decode('utf-8', 'replace') if isinstance(value, bytes) else ''
+
+
+def _params(values) -> dict:
+    if not isinstance(values, list):
+        return {}
+    return {_text(k).lower(): _text(v) for k, v in zip(values[::2], values[1::2])}
+
+
+def _leaves(structure, section: str = ''):
+    """(section, part) for every non-multipart part, in MIME order."""
+    if isinstance(structure[0], list):
+        # The children come first, then the subtype and extension data
+        children = takewhile(lambda p: isinstance(p, list), structure)
+        for number, child in enumerate(children):
+            yield from _leaves(child, f'{section}.{number + 1}' if section else str(number + 1))
+    else:
+        yield section or '1', structure
+
+
+def find_parts(structure) -> tuple:
+    """
+    Where the body and the PDF are, from a BODYSTRUCTURE.
+
+    Returns:
+        Tuple of (body, pdf), each (section, encoding, charset, filename)
+        or None: the first text/plain part and the first attachment named .pdf
+    """
+    body = pdf = None
+    for section, part in _leaves(structure):
+        kind = f'{_text(part[0])}/{_text(part[1])}'.lower()
+        params = _params(part[2])
+        encoding = _text(part[5]).lower()
+        # Extension data: single parts carry their disposition after the MD5
+        extension = 9 if kind.startswith('text/') else 8
+        if kind == 'message/rfc822':
+            extension = 11
+        disposition = part[extension] if len(part) > extension else None
+        filename = None
+        if isinstance(disposition, list) and disposition:
+            filename = _params(disposition[1] if len(disposition) > 1 else None).get('filename')
+            filename = filename or params.get('name')
+            if filename:
+                filename = str(make_header(decode_header(filename)))
+
+        if body is None and kind == 'text/plain' and not filename:
+            body = (section, encoding, params.get('charset') or 'utf-8', None)
+        elif pdf is None and filename and filename.lower().endswith('.pdf'):
+            pdf = (section, encoding, None, filename)
+    return body, pdf
+
+
+def _decode(data: Optional[bytes], encoding: str) -> bytes:
+    if not data:
+        return b''
+    if encoding == 'base64':
+        return base64.b64decode(data)
+    if encoding == 'quoted-printable':
+        return quopri.decodestring(data)
+    return data
+
+
+# --- The pipeline ---------------------------------------------------------
+
+def _header(headers, name: str) -> str:
+    value = headers.get(name)
+    return str(make_header(decode_header(value))) if value else ''
+
+
+def _fetch_batch(mail, uids) -> list:
+    """Headers, body text and PDF bytes of these messages, in two FETCHes."""
+    status, data = mail.uid('FETCH', uid_set(uids), f'(UID BODYSTRUCTURE BODY.PEEK[{HEADERS}])')
+    if status != 'OK':
+        raise imaplib.IMAP4.error(f'FETCH failed: {data}')
+
+    messages, layouts = [], {}
+    for items in fetch_items(data):
+        # Unsolicited FETCH responses (flag changes) may ride along
+        if 'UID' not in items or 'BODYSTRUCTURE' not in items:
             continue
-        
-        filename = part.get_filename()
-        if filename and filename.lower().endswith('.pdf'):
-            return filename, part.get_payload(decode=True)
-    
-    return None, None
+        body, pdf = find_parts(items['BODYSTRUCTURE'])
+        # Servers differ in how they echo the field list, so match loosely
+        headers = next((value for name, value in items.items()
+                        if name.startswith('BODY[HEADER')), None)
+        message = {'uid': int(items['UID']), 'headers': headers or b'',
+                   'body': body, 'pdf': pdf}
+        messages.append(message)
+        # Messages laid out alike are fetched together
+        sections = tuple(part[0] for part in (body, pdf) if part)
+        if sections:
+            layouts.setdefault(sections, []).append(message)
+
+    for sections, group in layouts.items():
+        by_uid = {message['uid']: message for message in group}
+        wanted = ' '.join(f'BODY.PEEK[{section}]' for section in sections)
+        status, data = mail.uid('FETCH', uid_set(by_uid), f'(UID {wanted})')
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f'FETCH failed: {data}')
+        for items in fetch_items(data):
+            message = by_uid.get(int(items.get('UID', 0)))
+            if message is None:
+                continue
+            for key in ('body', 'pdf'):
+                part = message[key]
+                if part:
+                    message[key + '_data'] = _decode(items.get(f'BODY[{part[0]}]'), part[1])
+    return messages
+
+
+def _parse_message(message: dict) -> tuple:
+    """(expense, None) for one fetched message, or (None, error) if Claude couldn't read it."""
+    headers = BytesHeaderParser().parsebytes(message['headers'])
+    subject = _header(headers, 'Subject')
+    sender_email = parseaddr(headers.get('From', ''))[1]
+    sender_domain = sender_email.split('@')[1] if '@' in sender_email else ''
+    try:
+        email_date = parsedate_to_datetime(headers['Date'])
+    except (TypeError, ValueError):
+        email_date = None
+
+    body = ''
+    if message['body']:
+        try:
+            body = message.get('body_data', b'').decode(message['body'][2], 'replace')
+        except LookupError:
+            body = message.get('body_data', b'').decode('utf-8', 'replace')
+
+    parsed_data = parse_email_with_claude(body[:MAX_BODY], subject)
+    if 'error' in parsed_data:
+        return None, parsed_data['error']
+
+    attachment_filename = message['pdf'][3] if message['pdf'] else None
+    return {
+        'amount': parsed_data.get('amount'),
+        'type': parsed_data.get('type', 'cost'),
+        'currency': parsed_data.get('currency', 'USD'),
+        'explanation': parsed_data.get('explanation', ''),
+        'tags': parsed_data.get('tags', []),
+        'vendor_name': parsed_data.get('vendor_name', ''),
+        'invoice_number': parsed_data.get('invoice_number'),
+        'payment_status': parsed_data.get('payment_status'),
+        'sender_email': sender_email,
+        'sender_domain': sender_domain,
+        'email_subject': subject,
+        'email_date': email_date,
+        'has_attachments': attachment_filename is not None,
+        'attachment_filename': attachment_filename,
+        'attachment_data': message.get('pdf_data'),
+    }, None
+
+
+# The error parse_uids reports for a UID the server no longer has
+GONE = 'No longer in the mailbox'
 
 
-def fetch_new_emails():
+def parse_uids(mail, uids, batch_size: int = None, workers: int = None) -> Iterator[tuple]:
     """
-    Fetch unread emails and return list of parsed expense data.
-    Returns: List of dicts with expense data and email metadata.
+    Fetch and parse these messages, EMAIL_FETCH_BATCH at a time.
+
+    The next batch is fetched while Claude reads this one. Nothing is flagged;
+    what counts as done is up to the caller.
+
+    Args:
+        mail: A logged-in IMAP4 connection with the mailbox selected
+        uids: The UIDs to parse
+        batch_size: UIDs per FETCH; Config.EMAIL_FETCH_BATCH when omitted
+        workers: Emails parsed at once; Config.EMAIL_PARSE_WORKERS when omitted
+
+    Yields:
+        (uid, expense, None) or (uid, None, error), in the order parses finish
+
+    Raises:
+        imaplib.IMAP4.error, OSError: The connection failed
     """
+    batch_size = batch_size or Config.EMAIL_FETCH_BATCH
+    workers = workers or Config.EMAIL_PARSE_WORKERS
+    uids = list(uids)
+    executor = ThreadPoolExecutor(workers, thread_name_prefix='email-parse')
+    pending = {}
     try:
-        mail = connect_to_email()
-        mail.select('inbox')
-        
-        # Search for unread emails
-        status, messages = mail.search(None, 'UNSEEN')
-        email_ids = messages[0].split()
-        
-        expenses = []
-        
-        for email_id in email_ids:
-            # Fetch email
-            status, msg_data = mail.fetch(email_id, '(RFC822)')
-            
-            for response_part in msg_data:
-                if isinstance(response_part, tuple):
-                    msg = email.message_from_bytes(response_part[1])
-                    
-                    # Get subject
-                    subject = decode_header(msg['Subject'])[0][0]
-                    if isinstance(subject, bytes):
-                        subject = subject.decode()
-                    
-                    # Get sender
-                    sender = msg.get('From')
-                    sender_email = email.utils.parseaddr(sender)[1]
-                    sender_domain = sender_email.split('@')[1] if '@' in sender_email else ''
-                    
-                    # Get date
-                    email_date = email.utils.parsedate_to_datetime(msg['Date'])
-                    
-                    # Get email body
-                    body = ''
-                    if msg.is_multipart():
-                        for part in msg.walk():
-                            if part.get_content_type() == 'text/plain':
-                                body = part.get_payload(decode=True).decode()
-                                break
-                    else:
-                        body = msg.get_payload(decode=True).decode()
-                    
-                    # Get PDF attachment
-                    attachment_filename, attachment_data = get_attachment(msg)
-                    
-                    # Parse with Claude
+        for start in range(0, len(uids), batch_size):
+            batch = uids[start:start + batch_size]
+            # The connection is this thread's alone; the pool only talks to Claude
+            messages = _fetch_batch(mail, batch)
+            for uid in set(batch) - {message['uid'] for message in messages}:
+                yield uid, None, GONE
+            for message in messages:
+                pending[executor.submit(_parse_message, message)] = message['uid']
+
+            # Hand over whatever is ready, then go on fetching. Wait only when
+            # too much is in flight, or when there is nothing left to fetch.
+            last = start + batch_size >= len(uids)
+            while pending:
+                block = last or len(pending) > 2 * workers
+                done, _ = wait(pending, timeout=None if block else 0,
+                               return_when=FIRST_COMPLETED)
+                if not done:
+                    break
+                for future in done:
+                    uid = pending.pop(future)
                     try:
-                        parsed_data = parse_email_with_claude(body[:3000], subject)  # Limit body length
-                        
-                        expense_data = {
-                            'amount': parsed_data.get('amount'),
-                            'type': parsed_data.get('type', 'cost'),
-                            'currency': parsed_data.get('currency', 'USD'),
-                            'explanation': parsed_data.get('explanation', ''),
-                            'tags': parsed_data.get('tags', []),
-                            'vendor_name': parsed_data.get('vendor_name', ''),
-                            'invoice_number': parsed_data.get('invoice_number'),
-                            'payment_status': parsed_data.get('payment_status'),
-                            'sender_email': sender_email,
-                            'sender_domain': sender_domain,
-                            'email_subject': subject,
-                            'email_date': email_date,
-                            'has_attachments': attachment_filename is not None,
-                            'attachment_filename': attachment_filename,
-                            'attachment_data': attachment_data,
-                        }
-                        
-                        expenses.append(expense_data)
-                    
+                        expense, error = future.result()
                     except Exception as e:
-                        print(f"Error parsing email {email_id}: {e}")
-                        continue
-            
-            # Mark as read
-            mail.store(email_id, '+FLAGS', '\\Seen')
-        
-        mail.close()
-        mail.logout()
-        
-        return expenses
-    
-    except Exception as e:
-        print(f"Error fetching emails: {e}")
-        return []
+                        expense, error = None, str(e)
+                    yield uid, expense, error
+    finally:
+        # Parses not started yet are dropped
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def fetch_new_emails(mail=None, batch_size: int = None, workers: int = None) -> Iterator[dict]:
+    """
+    Parse unread emails, yielding each expense as soon as Claude has read it.
+
+    Expenses come in the order their parses finish. A message is flagged
+    \\Seen once the caller asks for the next one after it - so commit each
+    expense before then - or when Claude could not parse it. See email_sync
+    for polling that does not depend on the \\Seen flag.
+
+    Args:
+        mail: A logged-in IMAP4 connection; connect_to_email() when omitted.
+              It is closed at the end either way.
+        batch_size: UIDs per FETCH; Config.EMAIL_FETCH_BATCH when omitted
+        workers: Emails parsed at once; Config.EMAIL_PARSE_WORKERS when omitted
+
+    Yields:
+        Dicts with expense data and email metadata
+    """
+    batch_size = batch_size or Config.EMAIL_FETCH_BATCH
+    try:
+        mail = mail or connect_to_email()
+        mail.select('inbox')
+        status, data = mail.uid('SEARCH', None, 'UNSEEN')
+        uids = [int(uid) for uid in data[0].split()]
+    except (imaplib.IMAP4.error, OSError) as e:
+        logger.error('Error fetching emails: %s', e)
+        return
+
+    handled = []  # UIDs to flag \Seen with the next STORE
+    try:
+        for uid, expense, error in parse_uids(mail, uids, batch_size, workers):
+            if expense is not None:
+                yield expense
+            elif error != GONE:
+                logger.warning('Could not parse email %s: %s', uid, error)
+            handled.append(uid)
+            if len(handled) >= batch_size:
+                mail.uid('STORE', uid_set(handled), '+FLAGS', '(\\Seen)')
+                handled.clear()
+    except (imaplib.IMAP4.error, OSError) as e:
+        logger.error('Error fetching emails: %s', e)
+    finally:
+        try:
+            if handled:
+                mail.uid('STORE', uid_set(handled), '+FLAGS', '(\\Seen)')
+            mail.close()
+            mail.logout()
+        except (imaplib.IMAP4.error, OSError) as e:
+            logger.warning('Error closing the mailbox: %s', e)
@@ -0,0 +1,183 @@
+"""
+Incremental sync of the invoice mailbox, by UID.
+
+fetch_new_emails() goes by the \\Seen flag: each poll searches the whole
+mailbox for unread messages, a message Claude could not read is flagged read
+all the same, and anyone opening the mailbox in a mail client hides invoices
+from it. sync_mailbox() instead remembers per mailbox the UIDVALIDITY and the
+highest UID it has handled (mailbox_checkpoints) and asks the server only for
+UIDs above that, so a poll costs as much as there is new mail, however large
+the mailbox.
+
+A message that could not be parsed goes to email_retries and is tried again
+after RETRY_DELAY, doubling up to MAX_RETRY_DELAY. After MAX_ATTEMPTS it stays
+there, with its last error, for someone to look at. The first sync of a
+mailbox - or the first after the server renumbered it with a new UIDVALIDITY -
+starts from the unread messages, as fetch_new_emails() would.
+"""
+
+import imaplib
+import logging
+from datetime import datetime, timedelta
+from typing import Iterator
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from config import Config
+from email_parser import GONE, connect_to_email, parse_uids, uid_set
+from models import db, EmailRetry, MailboxCheckpoint
+
+logger = logging.getLogger(__name__)
+
+RETRY_DELAY = timedelta(minutes=5)
+MAX_RETRY_DELAY = timedelta(days=1)
+MAX_ATTEMPTS = 8
+
+
+def _search(mail, criteria: str) -> list:
+    status, data = mail.uid('SEARCH', None, criteria)
+    if status != 'OK':
+        raise imaplib.IMAP4.error(f'SEARCH failed: {data}')
+    return [int(uid) for uid in data[0].split()]
+
+
+def _select(mail, mailbox: str) -> tuple:
+    """Select the mailbox; returns its (UIDVALIDITY, UIDNEXT)."""
+    status, data = mail.select(mailbox)
+    if status != 'OK':
+        raise imaplib.IMAP4.error(f'SELECT {mailbox} failed: {data}')
+    # Both come with every SELECT response (RFC 3501 6.3.1)
+    values = []
+    for code in ('UIDVALIDITY', 'UIDNEXT'):
+        value = mail.response(code)[1][0]
+        if value is None:
+            raise imaplib.IMAP4.error(f'The server sent no {code} for {mailbox}')
+        values.append(int(value))
+    return tuple(values)
+
+
+def _record_failure(mailbox: str, uidvalidity: int, uid: int, error: str):
+    retry = db.session.get(EmailRetry, (mailbox, uid))
+    if retry is None:
+        retry = EmailRetry(mailbox=mailbox, uid=uid, uidvalidity=uidvalidity, attempts=0)
+        db.session.add(retry)
+    retry.attempts += 1
+    retry.error = error
+    if retry.attempts >= MAX_ATTEMPTS:
+        retry.next_attempt_at = None
+        logger.error('Giving up on email %s in %s after %d attempts: %s',
+                     uid, mailbox, retry.attempts, error)
+    else:
+        delay = min(RETRY_DELAY * 2 ** (retry.attempts - 1), MAX_RETRY_DELAY)
+        retry.next_attempt_at = datetime.utcnow() + delay
+        logger.warning('Could not parse email %s in %s, retrying in %s: %s',
+                       uid, mailbox, delay, error)
+
+
+def sync_mailbox(mail=None, mailbox: str = 'INBOX', batch_size: int = None,
+                 workers: int = None) -> Iterator[dict]:
+    """
+    Parse the messages that arrived since the last sync, and any retries due.
+
+    Needs an app context. Like fetch_new_emails(), expenses come as their
+    parses finish, and a message counts as handled once the caller asks for
+    the next one after it - so commit each expense before then. Retries and
+    the checkpoint are committed on the session as the sync goes. Parsed
+    messages are still flagged \\Seen, for whoever reads the mailbox.
+
+    Args:
+        mail: A logged-in IMAP4 connection; connect_to_email() when omitted.
+              It is closed at the end either way.
+        mailbox: The mailbox to sync
+        batch_size: UIDs per FETCH; Config.EMAIL_FETCH_BATCH when omitted
+        workers: Emails parsed at once; Config.EMAIL_PARSE_WORKERS when omitted
+
+    Yields:
+        Dicts with expense data and email metadata
+    """
+    batch_size = batch_size or Config.EMAIL_FETCH_BATCH
+    try:
+        mail = mail or connect_to_email()
+        uidvalidity, uidnext = _select(mail, mailbox)
+
+        checkpoint = db.session.get(MailboxCheckpoint, mailbox)
+        if checkpoint is not None and checkpoint.uidvalidity != uidvalidity:
+            logger.warning('UIDVALIDITY of %s changed; syncing it afresh', mailbox)
+            db.session.delete(checkpoint)
+            checkpoint = None
+        EmailRetry.query.filter(EmailRetry.mailbox == mailbox,
+                                EmailRetry.uidvalidity != uidvalidity).delete()
+
+        if checkpoint is None:
+            new = _search(mail, 'UNSEEN')
+        else:
+            # n:* always matches the highest UID, even one below n
+            new = [uid for uid in _search(mail, f'UID {checkpoint.last_uid + 1}:*')
+                   if uid > checkpoint.last_uid]
+        retries = dict(db.session.query(EmailRetry.uid, EmailRetry.next_attempt_at)
+                       .filter(EmailRetry.mailbox == mailbox))
+        db.session.commit()
+    except (imaplib.IMAP4.error, OSError) as e:
+        db.session.rollback()
+        logger.error('Error syncing %s: %s', mailbox, e)
+        return
+
+    now = datetime.utcnow()
+    new.sort()
+    due = sorted(uid for uid, at in retries.items() if at is not None and at <= now)
+    # New messages already waiting for a retry were handled by an earlier sync
+    # that stopped before moving the checkpoint past them.
+    handled = {uid for uid in new if uid in retries}
+    todo = [uid for uid in new if uid not in retries] + due
+    flagged = []
+    position = 0  # every UID in new[:position] is handled
+
+    def save():
+        """Commit the retries, flag what was parsed, move the checkpoint."""
+        nonlocal checkpoint, position
+        while position < len(new) and new[position] in handled:
+            position += 1
+        if checkpoint is None:
+            # A first sync only counts once it has seen every unread message;
+            # until then, restarting from the unread ones loses nothing.
+            if position == len(new):
+                checkpoint = MailboxCheckpoint(mailbox=mailbox, uidvalidity=uidvalidity,
+                                               last_uid=max([uidnext - 1, *new]))
+                db.session.add(checkpoint)
+        elif position:
+            checkpoint.last_uid = max(checkpoint.last_uid, new[position - 1])
+        db.session.commit()
+        if flagged:
+            mail.uid('STORE', uid_set(flagged), '+FLAGS', '(\\Seen)')
+            flagged.clear()
+
+    count = 0
+    try:
+        for uid, expense, error in parse_uids(mail, todo, batch_size, workers):
+            if expense is not None:
+                yield expense
+                flagged.append(uid)
+            if expense is None and error != GONE:
+                _record_failure(mailbox, uidvalidity, uid, error)
+            elif uid in retries:
+                EmailRetry.query.filter_by(mailbox=mailbox, uid=uid).delete()
+            handled.add(uid)
+            count += 1
+            if count % batch_size == 0:
+                save()
+    except (imaplib.IMAP4.error, OSError) as e:
+        logger.error('Error syncing %s: %s', mailbox, e)
+    finally:
+        # Also when the caller stops early: what was handled stays handled
+        try:
+            save()
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            logger.error('Could not save the sync state of %s: %s', mailbox, e)
+        except (imaplib.IMAP4.error, OSError) as e:
+            logger.warning('Could not flag emails in %s as read: %s', mailbox, e)
+        try:
+            mail.close()
+            mail.logout()
+        except (imaplib.IMAP4.error, OSError) as e:
+            logger.warning('Error closing the mailbox: %s', e)
@@ -0,0 +1,187 @@
+"""
+The email poller: `flask ingest-worker`, run as the Procfile's worker process.
+
+A scheduler inside the web app would poll once per gunicorn worker, each
+parsing the same invoices. This runs on its own instead, and of however many
+copies are started only the one holding a Postgres advisory lock polls; the
+others wait and take over if it goes away (the lock lives as long as its
+connection).
+
+Each expense is committed as it is parsed. The unique index that stops the API
+from saving an invoice twice (see DUPLICATE_INVOICE_INDEX) does the same here:
+an invoice already entered by hand or uploaded as a PDF is skipped.
+
+Polling speeds up with the mail: after a poll that found something the
+interval halves, down to EMAIL_POLL_MIN_SECONDS; each quiet poll stretches it
+by half again, up to EMAIL_CHECK_INTERVAL minutes.
+"""
+
+import logging
+import signal
+import threading
+from datetime import date
+from decimal import Decimal, InvalidOperation
+
+from sqlalchemy.exc import DataError, DBAPIError, IntegrityError
+
+import attachments
+import rollup
+from currency import convert_to_eur
+from email_sync import sync_mailbox
+from models import db, Expense
+
+logger = logging.getLogger(__name__)
+
+# Any number nothing else locks on; the same in every copy of the worker
+POLLER_LOCK = 730_418_112
+
+# Seconds between attempts to take the lock while another copy holds it
+STANDBY_INTERVAL = 30
+
+
+def next_interval(interval: float, found: int, shortest: float, longest: float) -> float:
+    """The pause before the next poll, given how much mail the last one found."""
+    if found:
+        return max(shortest, interval / 2)
+    return min(longest, interval * 1.5)
+
+
+def save_expense(data: dict) -> bool:
+    """
+    Commit one parsed email as an expense.
+
+    Returns:
+        False if the duplicate-invoice index turned it away
+    """
+    email_date = data.get('email_date')
+    expense_date = email_date.date() if email_date else date.today()
+    amount = Decimal(str(data.get('amount') or 0))
+    currency = data.get('currency') or 'USD'
+    try:
+        amount_eur, exchange_rate = convert_to_eur(amount, currency, expense_date)
+    except RuntimeError:
+        # The ECB is unreachable; `flask backfill-eur` converts it later
+        amount_eur = exchange_rate = None
+
+    expense = Expense(
+        amount=amount,
+        type=data.get('type', 'cost'),
+        currency=currency,
+        explanation=data.get('explanation'),
+        tags=data.get('tags') or [],
+        amount_eur=amount_eur,
+        exchange_rate=exchange_rate,
+        source_type='email_auto',
+        sender_email=data.get('sender_email'),
+        sender_domain=data.get('sender_domain'),
+        vendor_name=data.get('vendor_name'),
+        email_subject=data.get('email_subject'),
+        invoice_number=data.get('invoice_number'),
+        expense_date=expense_date,
+        email_date=email_date,
+        attachment_filename=data.get('attachment_filename'),
+        has_attachments=data.get('has_attachments', False),
+    )
+    try:
+        # In a savepoint: the session also holds the sync's retries, recorded
+        # and cleared, which a refused expense must not take with it, and a
+        # refused expense's attachment goes with it
+        with db.session.begin_nested():
+            if data.get('attachment_data'):
+                sha256, size = attachments.store(data['attachment_data'])
+                expense.attachment_sha256, expense.attachment_size = sha256, size
+            db.session.add(expense)
+            db.session.flush()
+            with db.session.connection().connection.cursor() as cur:
+                rollup.adjust(cur, [expense.id], 1)
+    except IntegrityError:
+        logger.info('Invoice %s from %s is already recorded; skipping',
+                    expense.invoice_number, expense.vendor_name)
+        db.session.commit()
+        return False
+    db.session.commit()
+    return True
+
+
+def poll(mailbox: str = 'INBOX') -> int:
+    """Sync the mailbox once; returns how many expenses were parsed."""
+    found = saved = 0
+    for data in sync_mailbox(mailbox=mailbox):
+        found += 1
+        try:
+            saved += save_expense(data)
+        except (DataError, InvalidOperation, TypeError, ValueError) as e:
+            # Nothing to roll back: save_expense() writes in a savepoint
+            logger.warning('Unusable email parse from %s: %s', data.get('sender_email'), e)
+    if found:
+        logger.info('%s: %d emails parsed, %d new expenses', mailbox, found, saved)
+    return found
+
+
+class Worker:
+    """Polls while it holds POLLER_LOCK, and waits for it otherwise."""
+
+    def __init__(self, app):
+        self.app = app
+        self.shortest = app.config['EMAIL_POLL_MIN_SECONDS']
+        self.longest = app.config['EMAIL_CHECK_INTERVAL'] * 60
+        self.stopping = threading.Event()
+        self._lock_connection = None
+
+    def stop(self, *args):
+        self.stopping.set()
+
+    def run(self, once: bool = False):
+        """Poll until stopped; with once, poll a single time if leader."""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        interval = self.shortest
+        with self.app.app_context():
+            while not self.stopping.is_set():
+                if not self._lead():
+                    if once:
+                        logger.info('Another worker is polling')
+                        return
+                    self.stopping.wait(STANDBY_INTERVAL)
+                    continue
+                try:
+                    found = poll()
+                except Exception:
+                    db.session.rollback()
+                    logger.exception('Email poll failed')
+                    found = 0
+                if once:
+                    break
+                interval = next_interval(interval, found, self.shortest, self.longest)
+                logger.debug('Next poll in %.0f s', interval)
+                self.stopping.wait(interval)
+            self._release()
+
+    def _lead(self) -> bool:
+        """Whether this process holds the lock, taking it if it is free."""
+        try:
+            if self._lock_connection is not None:
+                # Still connected means still holding it
+                self._lock_connection.exec_driver_sql('SELECT 1')
+                return True
+            # Outside any transaction, so it never sits idle in one
+            connection = db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+            taken = connection.exec_driver_sql(
+                f'SELECT pg_try_advisory_lock({POLLER_LOCK})').scalar()
+            if taken:
+                logger.info('Took the poller lock; polling')
+                self._lock_connection = connection
+            else:
+                connection.close()
+            return taken
+        except DBAPIError as e:
+            logger.warning('Lost the database connection holding the poller lock: %s', e)
+            self._release()
+            return False
+
+    def _release(self):
+        # Closed for real, not returned to the pool still holding the lock
+        if self._lock_connection is not None:
+            self._lock_connection.invalidate()
+            self._lock_connection.close()
+            self._lock_connection = None
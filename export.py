@@ -1,14 +1,46 @@
 """
-Excel export module for generating expense reports.
+Export module for generating expense reports.
+
+The Excel workbook is for people; CSV, JSON Lines and Parquet carry the same
+columns for tools. All of them consume the expenses as an iterator, one pass,
+so an export never holds the whole result in memory.
 """
 
-from io import BytesIO
+import csv
+import io
+import json
+import tempfile
 from datetime import date
 from decimal import Decimal
 from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, Alignment, PatternFill, Border, Side, NamedStyle
 from openpyxl.utils import get_column_letter
 
+# Columns of the expenses sheet, and the Expense attributes each row reads.
+HEADERS = [
+    "Date", "Type", "Category", "Vendor", "Explanation",
+    "Amount", "Currency", "Amount (EUR)", "Exchange Rate",
+    "Invoice #", "Tags", "Source"
+]
+EXPORT_COLUMNS = (
+    'expense_date', 'type', 'cost_category', 'vendor_name', 'explanation',
+    'amount', 'currency', 'amount_eur', 'exchange_rate',
+    'invoice_number', 'tags', 'source_type',
+)
+
+# Rows per chunk sent to the client by the machine formats, and per Parquet row group.
+STREAM_BATCH = 1000
+PARQUET_ROW_GROUP = 64 * 1024
+
+CATEGORY_LABELS = [
+    ('operations', "Operations"),
+    ('freelancers', "Freelancers"),
+    ('equipment', "Equipment"),
+    ('other', "Other"),
+    ('uncategorized', "Uncategorized"),
+]
+
 
 def _scope_label(year) -> str:
     """How the covered period is described inside the workbook."""
@@ -17,164 +49,310 @@ def _scope_label(year) -> str:
     return str(year)
 
 
-def generate_excel_report(expenses: list, year=None) -> BytesIO:
+def _named_styles() -> list:
+    """
+    The workbook's styles, registered once and referred to by name.
+
+    Every cell of the expenses sheet shares one of these instead of carrying
+    its own Font/Border objects.
+    """
+    thin = Side(style='thin')
+    border = Border(left=thin, right=thin, top=thin, bottom=thin)
+    right = Alignment(horizontal="right")
+    return [
+        NamedStyle(name="header", border=border,
+                   font=Font(bold=True, color="FFFFFF"),
+                   fill=PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid"),
+                   alignment=Alignment(horizontal="center", vertical="center")),
+        NamedStyle(name="cell", border=border),
+        NamedStyle(name="cell_right", border=border, alignment=right),
+        NamedStyle(name="cell_amount", border=border, alignment=right, number_format='#,##0.00'),
+        NamedStyle(name="cell_rate", border=border, alignment=right, number_format='#,##0.000000'),
+        NamedStyle(name="summary_title", font=Font(bold=True, size=14)),
+        NamedStyle(name="summary_total", font=Font(bold=True), number_format='#,##0.00'),
+        NamedStyle(name="summary_total_label", font=Font(bold=True)),
+        NamedStyle(name="summary_amount", number_format='#,##0.00'),
+    ]
+
+
+def _styled(ws, value, style):
+    cell = WriteOnlyCell(ws, value=value)
+    cell.style = style
+    return cell
+
+
+def _expense_values(expense) -> list:
+    """One expense as the values of a sheet row."""
+    return [
+        expense.expense_date.isoformat() if expense.expense_date else "",
+        expense.type.capitalize() if expense.type else "",
+        expense.cost_category.capitalize() if expense.cost_category else "",
+        expense.vendor_name or "",
+        expense.explanation or "",
+        float(expense.amount) if expense.amount else 0,
+        expense.currency or "",
+        float(expense.amount_eur) if expense.amount_eur else 0,
+        float(expense.exchange_rate) if expense.exchange_rate else "",
+        expense.invoice_number or "",
+        ", ".join(expense.tags) if expense.tags else "",
+        expense.source_type or "",
+    ]
+
+
+def generate_excel_report(expenses, year=None):
     """
     Generate an Excel report with the given expenses and a summary.
 
+    The workbook is written in openpyxl's write-only mode: each row goes out
+    to disk as it is appended and the summary is totalled along the way, so
+    memory stays flat however many expenses there are.
+
     Args:
-        expenses: List of Expense objects
+        expenses: Iterable of Expense objects, or rows with the
+                  EXPORT_COLUMNS attributes. Consumed once.
         year: Year the list covers, or 'all'. Recorded in the workbook so a
               downloaded file says what period it contains.
 
     Returns:
-        BytesIO object containing the Excel file
+        Temporary file containing the Excel file, positioned at the start.
+        It is deleted when closed.
     """
     scope = _scope_label(year)
 
-    wb = Workbook()
+    wb = Workbook(write_only=True)
+    for style in _named_styles():
+        wb.add_named_style(style)
 
     # Create sheets
-    ws_expenses = wb.active
-    ws_expenses.title = "All Expenses" if scope == "All years" else f"Expenses {scope}"
+    ws_expenses = wb.create_sheet("All Expenses" if scope == "All years" else f"Expenses {scope}")
     ws_summary = wb.create_sheet("Summary")
 
-    # Styles
-    header_font = Font(bold=True, color="FFFFFF")
-    header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
-    header_alignment = Alignment(horizontal="center", vertical="center")
-    currency_alignment = Alignment(horizontal="right")
-    thin_border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
-    )
-
     # === Sheet 1: All Expenses ===
-    headers = [
-        "Date", "Type", "Category", "Vendor", "Explanation",
-        "Amount", "Currency", "Amount (EUR)", "Exchange Rate",
-        "Invoice #", "Tags", "Source"
-    ]
-
-    # Write headers
-    for col, header in enumerate(headers, 1):
-        cell = ws_expenses.cell(row=1, column=col, value=header)
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.alignment = header_alignment
-        cell.border = thin_border
-
-    # Write expense data
-    for row, expense in enumerate(expenses, 2):
-        data = [
-            expense.expense_date.isoformat() if expense.expense_date else "",
-            expense.type.capitalize() if expense.type else "",
-            expense.cost_category.capitalize() if expense.cost_category else "",
-            expense.vendor_name or "",
-            expense.explanation or "",
-            float(expense.amount) if expense.amount else 0,
-            expense.currency or "",
-            float(expense.amount_eur) if expense.amount_eur else 0,
-            float(expense.exchange_rate) if expense.exchange_rate else "",
-            expense.invoice_number or "",
-            ", ".join(expense.tags) if expense.tags else "",
-            expense.source_type or ""
-        ]
-
-        for col, value in enumerate(data, 1):
-            cell = ws_expenses.cell(row=row, column=col, value=value)
-            cell.border = thin_border
-            # Right-align currency columns
-            if col in [6, 8, 9]:
-                cell.alignment = currency_alignment
-                if col in [6, 8] and isinstance(value, (int, float)):
-                    cell.number_format = '#,##0.00'
-                elif col == 9 and isinstance(value, (int, float)):
-                    cell.number_format = '#,##0.000000'
-
-    # Auto-adjust column widths
+    # Widths and the frozen header must be set before the first row is written
     column_widths = [12, 10, 12, 20, 30, 12, 10, 14, 14, 15, 20, 10]
     for col, width in enumerate(column_widths, 1):
         ws_expenses.column_dimensions[get_column_letter(col)].width = width
-
-    # Freeze header row
     ws_expenses.freeze_panes = "A2"
 
-    # === Sheet 2: Summary ===
-    # Calculate totals
-    total_income = sum(
-        float(e.amount_eur or 0) for e in expenses if e.type == 'income'
-    )
-    total_costs = sum(
-        float(e.amount_eur or 0) for e in expenses if e.type == 'cost'
-    )
-    net = total_income - total_costs
-
-    # Category breakdown
-    category_totals = {
-        'operations': Decimal('0'),
-        'freelancers': Decimal('0'),
-        'equipment': Decimal('0'),
-        'other': Decimal('0'),
-        'uncategorized': Decimal('0')
-    }
-
-    for e in expenses:
-        if e.type == 'cost' and e.amount_eur:
-            category = e.cost_category or 'uncategorized'
-            if category in category_totals:
-                category_totals[category] += Decimal(str(e.amount_eur))
-            else:
-                category_totals['uncategorized'] += Decimal(str(e.amount_eur))
-
-    # Write summary
-    summary_data = [
-        ("Expense Summary", ""),
-        ("Period", scope),
-        ("", ""),
-        ("Total Income (EUR)", total_income),
-        ("Total Costs (EUR)", total_costs),
-        ("Net (EUR)", net),
-        ("", ""),
-        ("Costs by Category", ""),
-        ("Operations", float(category_totals['operations'])),
-        ("Freelancers", float(category_totals['freelancers'])),
-        ("Equipment", float(category_totals['equipment'])),
-        ("Other", float(category_totals['other'])),
-        ("Uncategorized", float(category_totals['uncategorized'])),
-        ("", ""),
-        ("Report Generated", date.today().isoformat()),
-        ("Total Records", len(expenses))
-    ]
+    ws_expenses.append([_styled(ws_expenses, header, "header") for header in HEADERS])
+
+    # One styled cell per column, refilled for every row: a write-only sheet
+    # serializes a row during append(), so the cells are free again afterwards.
+    column_styles = ["cell"] * 5 + ["cell_amount", "cell", "cell_amount", "cell_rate"] + ["cell"] * 3
+    row_cells = [_styled(ws_expenses, None, style) for style in column_styles]
+    no_rate = _styled(ws_expenses, "", "cell_right")
+    rate_cell = row_cells[8]
+
+    # Write expense data, totalling the summary as the rows go past
+    total_income = 0.0
+    total_costs = 0.0
+    category_totals = {key: Decimal('0') for key, _ in CATEGORY_LABELS}
+    records = 0
 
-    for row, (label, value) in enumerate(summary_data, 1):
-        label_cell = ws_summary.cell(row=row, column=1, value=label)
-        value_cell = ws_summary.cell(row=row, column=2, value=value)
-
-        # Style headers
-        if row == 1 or label == "Costs by Category":
-            label_cell.font = Font(bold=True, size=14)
-        elif label in ["Total Income (EUR)", "Total Costs (EUR)", "Net (EUR)"]:
-            label_cell.font = Font(bold=True)
-            value_cell.font = Font(bold=True)
-            value_cell.number_format = '#,##0.00'
-        elif label in ["Operations", "Freelancers", "Equipment", "Other", "Uncategorized"]:
-            value_cell.number_format = '#,##0.00'
-
-    # Adjust column widths
+    for expense in expenses:
+        values = _expense_values(expense)
+        # A missing rate is blank text, which gets no number format
+        row_cells[8] = rate_cell if values[8] != "" else no_rate
+        for cell, value in zip(row_cells, values):
+            cell.value = value
+        ws_expenses.append(row_cells)
+        records += 1
+
+        if expense.type == 'income':
+            total_income += float(expense.amount_eur or 0)
+        elif expense.type == 'cost':
+            total_costs += float(expense.amount_eur or 0)
+            if expense.amount_eur:
+                category = expense.cost_category or 'uncategorized'
+                if category not in category_totals:
+                    category = 'uncategorized'
+                category_totals[category] += Decimal(str(expense.amount_eur))
+
+    # === Sheet 2: Summary ===
     ws_summary.column_dimensions['A'].width = 25
     ws_summary.column_dimensions['B'].width = 15
 
-    # Save to BytesIO
-    output = BytesIO()
+    def summary_row(label, value, label_style=None, value_style=None):
+        ws_summary.append([
+            _styled(ws_summary, label, label_style) if label_style else label,
+            _styled(ws_summary, value, value_style) if value_style else value,
+        ])
+
+    summary_row("Expense Summary", "", "summary_title")
+    summary_row("Period", scope)
+    summary_row("", "")
+    summary_row("Total Income (EUR)", total_income, "summary_total_label", "summary_total")
+    summary_row("Total Costs (EUR)", total_costs, "summary_total_label", "summary_total")
+    summary_row("Net (EUR)", total_income - total_costs, "summary_total_label", "summary_total")
+    summary_row("", "")
+    summary_row("Costs by Category", "", "summary_title")
+    for key, label in CATEGORY_LABELS:
+        summary_row(label, float(category_totals[key]), value_style="summary_amount")
+    summary_row("", "")
+    summary_row("Report Generated", date.today().isoformat())
+    summary_row("Total Records", records)
+
+    # On disk rather than in memory; the caller streams it out and closes it
+    output = tempfile.TemporaryFile()
     wb.save(output)
     output.seek(0)
 
     return output
 
 
-def get_export_filename(year=None) -> str:
+# Positions in an EXPORT_COLUMNS row of the values the machine formats convert.
+_DATE = EXPORT_COLUMNS.index('expense_date')
+_TAGS = EXPORT_COLUMNS.index('tags')
+_DECIMALS = [EXPORT_COLUMNS.index(name) for name in ('amount', 'amount_eur', 'exchange_rate')]
+
+
+def generate_csv(rows):
+    """
+    Yield the expenses as CSV, a chunk at a time.
+
+    Args:
+        rows: Iterable of tuples in EXPORT_COLUMNS order.
+
+    One header row of EXPORT_COLUMNS names, then raw values: amounts keep their
+    exact decimals, dates are ISO, tags are joined like the Excel sheet.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    # The csv module already writes None as empty, and dates and decimals as
+    # their str(); only the tags need turning into text.
+    for count, row in enumerate(rows, 1):
+        row = list(row)
+        row[_TAGS] = ", ".join(row[_TAGS]) if row[_TAGS] else ""
+        writer.writerow(row)
+        if count % STREAM_BATCH == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+def generate_jsonl(rows):
+    """Yield the expenses (tuples in EXPORT_COLUMNS order) as JSON Lines, a chunk at a time."""
+    lines = []
+    for row in rows:
+        row = list(row)
+        if row[_DATE] is not None:
+            row[_DATE] = row[_DATE].isoformat()
+        for index in _DECIMALS:
+            if row[index] is not None:
+                row[index] = float(row[index])
+        lines.append(json.dumps(dict(zip(EXPORT_COLUMNS, row))))
+        if len(lines) == STREAM_BATCH:
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
+            lines = []
+    if lines:
+        yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+class _DrainedFile:
+    """
+    A write-only file that hands back what was written since it was last drained.
+
+    ParquetWriter writes each row group out as soon as it is complete, so
+    draining after every group streams the file with one group in memory.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def parquet_available() -> bool:
+    """Whether pyarrow, which the Parquet export needs, is installed."""
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def generate_parquet(rows):
+    """
+    Yield the expenses (tuples in EXPORT_COLUMNS order) as a Parquet file,
+    one row group at a time.
+
+    Columns are typed: dates as date32, amounts as decimal128 matching the
+    database's NUMERIC precision, tags as a list of strings.
+    """
+    # Imported here: pyarrow is large and only this export needs it.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ('expense_date', pa.date32()),
+        ('type', pa.string()),
+        ('cost_category', pa.string()),
+        ('vendor_name', pa.string()),
+        ('explanation', pa.string()),
+        ('amount', pa.decimal128(10, 2)),
+        ('currency', pa.string()),
+        ('amount_eur', pa.decimal128(10, 2)),
+        ('exchange_rate', pa.decimal128(10, 6)),
+        ('invoice_number', pa.string()),
+        ('tags', pa.list_(pa.string())),
+        ('source_type', pa.string()),
+    ])
+
+    def row_group(batch):
+        columns = zip(*batch)
+        return pa.RecordBatch.from_arrays(
+            [pa.array(values, type=field.type) for values, field in zip(columns, schema)],
+            schema=schema,
+        )
+
+    sink = _DrainedFile()
+    writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == PARQUET_ROW_GROUP:
+            writer.write_batch(row_group(batch))
+            yield sink.drain()
+            batch = []
+    if batch:
+        writer.write_batch(row_group(batch))
+    writer.close()
+    yield sink.drain()
+
+
+# format -> (generator, mimetype, file extension) for the streamed exports
+STREAM_FORMATS = {
+    'csv': (generate_csv, 'text/csv; charset=utf-8', 'csv'),
+    'jsonl': (generate_jsonl, 'application/x-ndjson', 'jsonl'),
+    'parquet': (generate_parquet, 'application/vnd.apache.parquet', 'parquet'),
+}
+
+
+def get_export_filename(year=None, extension='xlsx') -> str:
     """
     Generate filename for the export, naming the period it covers.
 
@@ -183,5 +361,5 @@ def get_export_filename(year=None) -> str:
         no single year is selected.
     """
     if year is None or year == 'all':
-        return f"expenses_all-years_{date.today().isoformat()}.xlsx"
-    return f"expenses_{year}.xlsx"
+        return f"expenses_all-years_{date.today().isoformat()}.{extension}"
+    return f"expenses_{year}.{extension}"
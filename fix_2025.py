@@ -21,6 +21,7 @@ import click
 import psycopg2
 import psycopg2.extras
 
+import rollup
 from config import Config
 from reconcile import load_csv, load_db_rows, reconcile
 
@@ -64,6 +65,7 @@ def capture_undo(conn, ids):
         lines.append(f'DELETE FROM expenses WHERE id = {record["id"]};')
         lines.append(f'INSERT INTO expenses ({columns}) VALUES ({values});')
     lines.append("SELECT setval('expenses_id_seq', (SELECT max(id) FROM expenses));")
+    lines.append(rollup.REBUILD.strip())
     lines.append('COMMIT;')
     undo = Path(UNDO_PATH)
     undo.parent.mkdir(parents=True, exist_ok=True)
@@ -73,8 +75,8 @@ def capture_undo(conn, ids):
 
 def planned_corrections(conn):
     """Discrepancies from reconcile.py, as (row, txn), minus the ones we keep."""
-    txns, _ = load_csv('.context/attachments/V21A2l/transaction-history.csv', 2025)
-    rows = load_db_rows(conn, 2025, 45)
+    txns, _ = load_csv('.context/attachments/V21A2l/transaction-history.csv', [2025])
+    rows = load_db_rows(conn, [2025], 45)
     _, _, discrepancies, _ = reconcile(txns, rows)
     return [(row, txn) for txn, row, *_ in discrepancies if row.id not in KEEP_DESPITE_FLAG]
 
@@ -118,7 +120,10 @@ def main(do_apply):
         saved = capture_undo(conn, touched)
         click.echo(f'\nundo script written for {saved} rows: {UNDO_PATH}')
 
+        corrected = [row.id for row, _ in corrections]
         with conn.cursor() as cur:
+            # Out of the monthly totals before the change, back in after it.
+            rollup.adjust(cur, touched, -1)
             cur.execute('DELETE FROM expenses WHERE id = ANY(%s)', (list(deletions),))
             deleted = cur.rowcount
             for row, txn in corrections:
@@ -131,6 +136,7 @@ def main(do_apply):
                      txn.amount_eur,
                      txn.exchange_rate if txn.amount_eur else None,
                      row.id))
+            rollup.adjust(cur, corrected, 1)
         conn.commit()
         click.echo(f'deleted {deleted} rows, corrected {len(corrections)} rows')
         click.echo(f'undo with: psql "{Config.SQLALCHEMY_DATABASE_URI}" -f {UNDO_PATH}')
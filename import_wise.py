@@ -10,17 +10,27 @@ reversible:
 
     DELETE FROM expenses WHERE source_type = 'wise_import';
 
+followed by `flask --app app rebuild-rollups` to bring the summary totals back
+in line.
+
+The reviewed rows are COPYed into a temporary staging table, and a single
+INSERT ... SELECT moves across those whose `external_id` is not in the table
+yet. A dry run stages them the same way and counts what that INSERT would take,
+so both agree on what is new without the IDs ever leaving the database.
+
 Dry run by default. Pass --apply to write.
 
     python import_wise.py reconcile-output/missing-2025.csv --apply
 """
 
 import csv
+import io
 from decimal import Decimal
 
 import click
 import psycopg2
 
+import rollup
 from config import Config
 
 # The transaction is already recorded; only its date is wrong. Inserting it
@@ -42,12 +52,6 @@ def add_external_id_column(conn):
         ''')
 
 
-def existing_external_ids(conn):
-    with conn.cursor() as cur:
-        cur.execute('SELECT external_id FROM expenses WHERE external_id IS NOT NULL')
-        return {row[0] for row in cur.fetchall()}
-
-
 def decimal_or_none(raw, places='0.01'):
     if raw is None or raw == '':
         return None
@@ -60,7 +64,7 @@ def build_row(record):
     Amount and currency take the *merchant* side, which is how the database
     already records USD subscriptions. The EUR figure and rate come from Wise
     and are the ones actually charged - better than currency.convert_to_eur(),
-    which only knows today's ECB rate.
+    which can only apply the ECB reference rate of the day.
     """
     amount_eur = decimal_or_none(record['amount_eur'])
 
@@ -85,16 +89,69 @@ def build_row(record):
     }
 
 
-INSERT = '''
-    INSERT INTO expenses (amount, currency, type, cost_category, explanation,
-                          vendor_name, amount_eur, exchange_rate, expense_date,
-                          source_type, external_id, tags, has_attachments, created_at)
-    VALUES (%(amount)s, %(currency)s, %(type)s, %(cost_category)s, %(explanation)s,
-            %(vendor_name)s, %(amount_eur)s, %(exchange_rate)s, %(expense_date)s,
-            %(source_type)s, %(external_id)s, '{}', false, now())
+# The columns build_row() fills, in staging-table order
+COLUMNS = ('amount', 'currency', 'type', 'cost_category', 'explanation', 'vendor_name',
+           'amount_eur', 'exchange_rate', 'expense_date', 'source_type', 'external_id')
+
+# Dropped with the transaction, whether it commits or not. `line` keeps the
+# CSV's order, so ids are handed out as the per-row inserts used to.
+STAGING = '''
+    CREATE TEMPORARY TABLE wise_staging (
+        line SERIAL,
+        amount NUMERIC(10, 2),
+        currency VARCHAR(3),
+        type VARCHAR(10),
+        cost_category VARCHAR(20),
+        explanation TEXT,
+        vendor_name VARCHAR(255),
+        amount_eur NUMERIC(10, 2),
+        exchange_rate NUMERIC(10, 6),
+        expense_date DATE,
+        source_type VARCHAR(20),
+        external_id VARCHAR(100)
+    ) ON COMMIT DROP
+'''
+
+# The staged rows not imported before, each Wise id once. Shared by the insert
+# and the dry run, so the two cannot disagree.
+FRESH = '''
+    SELECT DISTINCT ON (s.external_id) s.*
+    FROM wise_staging s
+    WHERE NOT EXISTS (SELECT 1 FROM expenses e WHERE e.external_id = s.external_id)
+    ORDER BY s.external_id, s.line
+'''
+
+# ON CONFLICT still covers an import running alongside
+INSERT = f'''
+    INSERT INTO expenses ({', '.join(COLUMNS)}, tags, has_attachments, created_at)
+    SELECT {', '.join(COLUMNS)}, '{{}}', false, now()
+    FROM ({FRESH}) AS fresh
+    ORDER BY line
     ON CONFLICT (external_id) WHERE external_id IS NOT NULL DO NOTHING
+    RETURNING id
 '''
 
+COUNT = f'SELECT count(*), coalesce(sum(amount_eur), 0) FROM ({FRESH}) AS fresh'
+
+
+def _copy_value(value):
+    """A value in COPY's text format: NULL as \\N, specials backslash-escaped."""
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def stage(cur, records):
+    """COPY the records into wise_staging, one round trip however many there are."""
+    cur.execute(STAGING)
+    buffer = io.StringIO()
+    for record in records:
+        row = build_row(record)
+        buffer.write('\t'.join(_copy_value(row[column]) for column in COLUMNS) + '\n')
+    buffer.seek(0)
+    cur.copy_expert(f'COPY wise_staging ({", ".join(COLUMNS)}) FROM STDIN', buffer)
+
 
 @click.command()
 @click.argument('missing_csv', type=click.Path(exists=True, dir_okay=False))
@@ -126,24 +183,32 @@ def main(missing_csv, do_apply, include_personal, exclude):
     total = sum((decimal_or_none(r['amount_eur']) or Decimal(0)) for r in selected)
     click.echo(f'EUR {total:,.2f} (rows without a EUR figure count as 0)')
 
-    if not do_apply:
-        click.echo('\nDry run. Re-run with --apply to write.')
-        return
-
     conn = psycopg2.connect(Config.SQLALCHEMY_DATABASE_URI)
     try:
         add_external_id_column(conn)
-        already = existing_external_ids(conn)
-        fresh = [r for r in selected if r['wise_id'] not in already]
-        if len(fresh) < len(selected):
-            click.echo(f'{len(selected) - len(fresh)} already imported previously, skipping')
-
         with conn.cursor() as cur:
-            for record in fresh:
-                cur.execute(INSERT, build_row(record))
+            stage(cur, selected)
+            if do_apply:
+                cur.execute(INSERT)
+                inserted = [row[0] for row in cur.fetchall()]
+                fresh = len(inserted)
+                # Same transaction, so the summary pages never see half an import.
+                rollup.adjust(cur, inserted, 1)
+            else:
+                cur.execute(COUNT)
+                fresh, fresh_total = cur.fetchone()
+
+        if fresh < len(selected):
+            click.echo(f'{len(selected) - fresh} already imported previously, skipping')
+        if not do_apply:
+            click.echo(f'{fresh} rows would be inserted, EUR {fresh_total:,.2f}')
+            click.echo('\nDry run. Re-run with --apply to write.')
+            conn.rollback()
+            return
         conn.commit()
-        click.echo(f'\ninserted {len(fresh)} rows as source_type=wise_import')
+        click.echo(f'\ninserted {len(inserted)} rows as source_type=wise_import')
         click.echo('undo with: DELETE FROM expenses WHERE source_type = \'wise_import\';')
+        click.echo('     then: flask --app app rebuild-rollups')
     except Exception:
         conn.rollback()
         raise
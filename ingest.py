@@ -0,0 +1,285 @@
+"""
+Many invoices at once: PDFs or zip archives of them, parsed concurrently and
+saved in one transaction.
+
+POST /api/ingest unpacks the upload, drops PDFs it has already seen (the same
+bytes in this upload, or attached to an existing expense) and queues the rest
+as parse jobs of the batch, returning a batch id. The parse pool works through
+them INGEST_PARALLELISM at a time - backing off together when the API rate
+limits - under the same leases as single uploads, so a worker restart loses
+nothing: another worker takes the files over (see parse_jobs.py). Once the
+last file is parsed, an expense per parsed file is inserted. GET
+/api/ingest/<id> shows progress and, once done, what became of each file.
+
+The inserts run in one transaction, each in its own savepoint, so one invoice
+that is already recorded fails alone instead of taking the batch with it.
+"""
+
+import hashlib
+import logging
+import uuid
+import zipfile
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+from typing import Optional
+
+from sqlalchemy import select, update
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.orm import defer
+
+import attachments
+import rollup
+from ai_parser import MAX_PDF_BYTES
+from currency import convert_to_eur
+from models import db, Expense, IngestBatch, ParseJob
+from parse_jobs import pool as parse_pool, PENDING
+
+logger = logging.getLogger(__name__)
+
+
+def _is_pdf(name: str) -> bool:
+    return name.lower().endswith('.pdf')
+
+
+def collect_pdfs(uploads, max_files: int, max_bytes: int):
+    """
+    The PDFs in a multi-file upload, zip archives unpacked.
+
+    Args:
+        uploads: Werkzeug FileStorage objects
+        max_files: Files beyond this are skipped
+        max_bytes: Files that would take the upload past this many bytes,
+            unpacked, are skipped
+
+    Returns:
+        Tuple of ([(filename, bytes)], [report entries for skipped files])
+    """
+    pdfs, skipped = [], []
+    total = 0
+
+    def add(name, read, size=0):
+        nonlocal total
+        too_large = f'Larger than {MAX_PDF_BYTES // (1024 * 1024)}MB'
+        too_much = f'More than {max_bytes // (1024 * 1024)}MB in one upload'
+        if len(pdfs) >= max_files:
+            skipped.append({'filename': name, 'status': 'skipped',
+                            'error': f'More than {max_files} files in one upload'})
+            return
+        # The declared size, checked before anything is inflated
+        if size > MAX_PDF_BYTES:
+            skipped.append({'filename': name, 'status': 'skipped', 'error': too_large})
+            return
+        # A zip's declared sizes can lie, so never read more than either
+        # limit allows, plus a byte to tell that it was exceeded
+        limit = min(MAX_PDF_BYTES, max_bytes - total)
+        data = read(limit + 1)
+        if len(data) > MAX_PDF_BYTES:
+            skipped.append({'filename': name, 'status': 'skipped', 'error': too_large})
+        elif len(data) > limit:
+            skipped.append({'filename': name, 'status': 'skipped', 'error': too_much})
+        else:
+            total += len(data)
+            pdfs.append((name, data))
+
+    for upload in uploads:
+        name = upload.filename or ''
+        if _is_pdf(name):
+            add(name, upload.stream.read)
+        elif name.lower().endswith('.zip'):
+            try:
+                with zipfile.ZipFile(upload.stream) as archive:
+                    for info in archive.infolist():
+                        member = f'{name}/{info.filename}'
+                        if info.is_dir() or '__MACOSX/' in info.filename:
+                            continue
+                        if not _is_pdf(info.filename):
+                            skipped.append({'filename': member, 'status': 'skipped',
+                                            'error': 'Not a PDF'})
+                            continue
+                        add(member, lambda n, info=info: _read_member(archive, info, n),
+                            info.file_size)
+            except zipfile.BadZipFile:
+                skipped.append({'filename': name, 'status': 'skipped',
+                                'error': 'Not a valid zip archive'})
+        else:
+            skipped.append({'filename': name, 'status': 'skipped',
+                            'error': 'Not a PDF or zip archive'})
+    return pdfs, skipped
+
+
+def _read_member(archive, info, n: int) -> bytes:
+    """At most n bytes of a zip member, inflated."""
+    with archive.open(info) as member:
+        return member.read(n)
+
+
+def start(app, uploads) -> IngestBatch:
+    """Record a batch for these uploads and queue its files for parsing."""
+    pdfs, report = collect_pdfs(uploads, app.config['INGEST_MAX_FILES'],
+                                 app.config['INGEST_MAX_MB'] * 1024 * 1024)
+
+    # Identical bytes are parsed and saved once
+    todo, first_seen = [], {}
+    for filename, data in pdfs:
+        digest = hashlib.sha256(data).hexdigest()
+        entry = {'filename': filename, 'sha256': digest}
+        if digest in first_seen:
+            entry.update(status='duplicate', duplicate_of=first_seen[digest])
+        else:
+            first_seen[digest] = filename
+            todo.append((entry, data))
+        report.append(entry)
+
+    if first_seen:
+        existing = dict(db.session.query(Expense.attachment_sha256, Expense.id)
+                        .filter(Expense.attachment_sha256.in_(first_seen)))
+        for entry, _ in todo:
+            if entry['sha256'] in existing:
+                entry.update(status='duplicate', expense_id=existing[entry['sha256']])
+        todo = [(entry, data) for entry, data in todo if 'status' not in entry]
+    for entry, _ in todo:
+        entry['status'] = 'pending'
+
+    batch_id = uuid.uuid4().hex
+    jobs = parse_pool.submit_batch(batch_id, [(data, entry['filename']) for entry, data in todo])
+    for (entry, _), job in zip(todo, jobs):
+        entry['job_id'] = job.id
+    batch = IngestBatch(id=batch_id, status='running' if todo else 'done', total=len(report),
+                        parsed=len(report) - len(todo), report=report,
+                        finished_at=None if todo else datetime.utcnow())
+    db.session.add(batch)
+    db.session.commit()
+    parse_pool.start_batch(jobs)
+    return batch
+
+
+def get(batch_id: str) -> Optional[IngestBatch]:
+    """The batch, moved on first if the workers handling it have stopped."""
+    batch = db.session.get(IngestBatch, batch_id)
+    if batch is not None and batch.status == 'running':
+        parse_pool.take_over_orphans()
+        finish(batch_id, wait=False)
+        db.session.refresh(batch)
+    return batch
+
+
+def finish(batch_id: str, wait: bool = True):
+    """
+    Save the batch if every file in it has been parsed.
+
+    Called as each file's parse finishes, and on every poll, so a batch whose
+    worker stopped while saving it is saved by the next.
+
+    Args:
+        wait: Wait for whoever is saving it already, rather than leave it to them.
+              The parse pool waits: it may have finished the last file just as
+              another thread looked and still saw it pending.
+    """
+    query = select(IngestBatch).where(IngestBatch.id == batch_id,
+                                      IngestBatch.status == 'running')
+    batch = db.session.execute(
+        query.with_for_update(skip_locked=not wait)
+        .execution_options(populate_existing=True)
+    ).scalar()
+    if batch is None or ParseJob.query.filter(ParseJob.batch_id == batch_id,
+                                              ParseJob.status.in_(PENDING)).first():
+        db.session.rollback()
+        return
+
+    report = [dict(entry) for entry in batch.report]
+    try:
+        _save_all(batch, report)
+    except Exception as e:
+        db.session.rollback()
+        logger.exception('Ingest batch %s failed', batch_id)
+        db.session.execute(
+            update(IngestBatch)
+            .where(IngestBatch.id == batch_id, IngestBatch.status == 'running')
+            .values(status='failed', error=str(e), finished_at=datetime.utcnow())
+        )
+        db.session.commit()
+
+
+def _save_all(batch, report):
+    """Insert an expense per parsed file, all in one transaction."""
+    # Each PDF is fetched only when its expense is saved, not all at once
+    jobs = {job.id: job for job in
+            ParseJob.query.filter_by(batch_id=batch.id).options(defer(ParseJob.pdf_data))}
+    created = []
+    for entry in report:
+        if entry['status'] != 'pending':
+            continue
+        job = jobs.get(entry.pop('job_id'))
+        if job is None:
+            entry.update(status='failed', error='Expired before it was parsed')
+            continue
+        if job.status == 'failed':
+            entry.update(status='failed', error=job.error)
+            continue
+        parsed = job.result
+        try:
+            with db.session.begin_nested():
+                pdf_data = db.session.scalar(
+                    select(ParseJob.pdf_data).where(ParseJob.id == job.id))
+                expense = _expense_from(parsed, entry['filename'], pdf_data)
+                db.session.add(expense)
+            entry.update(status='created', expense_id=expense.id)
+            if expense.amount_eur is None:
+                entry['error'] = 'Saved without a EUR amount: no exchange rate for it yet'
+            created.append(expense.id)
+        except IntegrityError:
+            entry.update(status='failed',
+                         error=f'Invoice {parsed.get("invoice_number")} from '
+                               f'{parsed.get("vendor_name")} is already recorded '
+                               f'for this amount and date.')
+        except (DataError, InvalidOperation, TypeError, ValueError) as e:
+            entry.update(status='failed', error=f'Unusable parse result: {e}')
+
+    with db.session.connection().connection.cursor() as cur:
+        rollup.adjust(cur, created, 1)
+
+    # Their results are in the report now
+    ParseJob.query.filter_by(batch_id=batch.id).delete(synchronize_session=False)
+    batch.status = 'done'
+    batch.report = report
+    batch.finished_at = datetime.utcnow()
+    db.session.commit()
+
+
+def _expense_from(parsed: dict, filename: str, pdf_data: bytes) -> Expense:
+    """An expense from a parse result, as POST /api/expenses would save it."""
+    expense_date = date.today()
+    if parsed.get('expense_date'):
+        try:
+            expense_date = date.fromisoformat(parsed['expense_date'])
+        except (TypeError, ValueError):
+            pass
+
+    amount = Decimal(str(parsed.get('amount', 0)))
+    currency = parsed.get('currency') or 'USD'
+    try:
+        amount_eur, exchange_rate = convert_to_eur(amount, currency, expense_date)
+    except RuntimeError:
+        # The ECB is unreachable. Keep the parse that was paid for and let
+        # `flask backfill-eur` convert it later.
+        amount_eur = exchange_rate = None
+    attachment_sha256, attachment_size = attachments.store(pdf_data)
+
+    return Expense(
+        amount=amount,
+        type=parsed.get('type', 'cost'),
+        cost_category=parsed.get('cost_category'),
+        currency=currency,
+        explanation=parsed.get('explanation'),
+        tags=parsed.get('tags') or [],
+        amount_eur=amount_eur,
+        exchange_rate=exchange_rate,
+        source_type='pdf_upload',
+        vendor_name=parsed.get('vendor_name'),
+        invoice_number=parsed.get('invoice_number'),
+        expense_date=expense_date,
+        attachment_filename=filename.rsplit('/', 1)[-1],
+        attachment_sha256=attachment_sha256,
+        attachment_size=attachment_size,
+        has_attachments=True,
+    )
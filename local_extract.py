@@ -0,0 +1,370 @@
+"""
+Reading invoices locally before asking Claude.
+
+Most PDFs come from the same few SaaS vendors, with a text layer and a layout
+that never changes. `flask learn-vendor-rules` looks at the expenses already
+saved with such a PDF and works out, per vendor, where the confirmed amount,
+date and invoice number sit in the text: the words in front of each, the
+date format, the shape of the invoice number. The rules go to a JSON file
+(VENDOR_RULES_FILE).
+
+extract() reads a new PDF's text layer. If exactly one vendor's markers appear
+in it and each of that vendor's rules finds exactly one value, it returns the
+fields without a network call. Anything less certain - no text layer, an
+unknown vendor, two different totals behind the same label - returns None, and
+the PDF goes to Claude as before.
+
+pypdf is optional: without it nothing is extracted locally.
+
+How often that works, and how long it takes next to a Claude call, is counted
+in `stats` for GET /api/local-extraction.
+"""
+
+import io
+import json
+import logging
+import os
+import re
+import sqlite3
+from collections import Counter
+from contextlib import closing, contextmanager
+from datetime import date
+from decimal import Decimal
+from typing import Optional
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Invoices put the figures on the first page or two; later pages are terms
+MAX_PAGES = 3
+
+# Less text than this means a scan with no text layer
+MIN_TEXT = 40
+
+# A vendor needs this many samples agreeing on a rule, and at least this share
+MIN_SAMPLES = 2
+MIN_AGREEMENT = 0.8
+
+# Samples learned from per vendor, newest first
+SAMPLES_PER_VENDOR = 10
+
+CURRENCY_SYMBOLS = {'$': 'USD', '€': 'EUR', '£': 'GBP'}
+CURRENCY_CODES = ('USD', 'EUR', 'GBP', 'CHF', 'CAD', 'AUD', 'SEK', 'DKK', 'NOK', 'PLN', 'JPY')
+
+# 1,234.56 / 1.234,56 / 1234.56 - always with cents, as invoice totals are
+AMOUNT = re.compile(
+    r'(?P<before>[$€£]|\b(?:' + '|'.join(CURRENCY_CODES) + r'))?\s?'
+    r'(?<![\d.,])(?P<units>\d{1,3}(?:[.,]\d{3})+|\d+)[.,](?P<cents>\d{2})(?![\d])'
+    r'(?:\s?(?P<after>[€$£]|(?:' + '|'.join(CURRENCY_CODES) + r')\b))?'
+)
+
+MONTHS = {name: number for number, names in enumerate((
+    ('jan', 'january'), ('feb', 'february'), ('mar', 'march'), ('apr', 'april'),
+    ('may',), ('jun', 'june'), ('jul', 'july'), ('aug', 'august'),
+    ('sep', 'sept', 'september'), ('oct', 'october'), ('nov', 'november'),
+    ('dec', 'december'),
+), start=1) for name in names}
+MONTH = r'(?P<month>' + '|'.join(sorted(MONTHS, key=len, reverse=True)) + r')\.?'
+
+# Format name -> pattern. 03/04/2024 is tried both ways; learning keeps
+# whichever reading matched the confirmed dates.
+DATE_FORMATS = {
+    'iso': re.compile(r'\b(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})\b'),
+    'dmy.': re.compile(r'\b(?P<day>\d{1,2})\.(?P<month>\d{1,2})\.(?P<year>\d{4})\b'),
+    'mdy/': re.compile(r'\b(?P<month>\d{1,2})/(?P<day>\d{1,2})/(?P<year>\d{4})\b'),
+    'dmy/': re.compile(r'\b(?P<day>\d{1,2})/(?P<month>\d{1,2})/(?P<year>\d{4})\b'),
+    'mon d y': re.compile(r'\b' + MONTH + r' (?P<day>\d{1,2}),? (?P<year>\d{4})\b', re.IGNORECASE),
+    'd mon y': re.compile(r'\b(?P<day>\d{1,2}) ' + MONTH + r',? (?P<year>\d{4})\b', re.IGNORECASE),
+}
+
+
+def pypdf_available() -> bool:
+    """Whether pypdf, which reads the text layer, is installed."""
+    try:
+        import pypdf  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def pdf_lines(pdf_data: bytes) -> Optional[list]:
+    """The text layer as whitespace-collapsed lines, or None if there is none."""
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        return None
+    try:
+        reader = PdfReader(io.BytesIO(pdf_data))
+        text = '\n'.join(page.extract_text() or '' for page in reader.pages[:MAX_PAGES])
+    except Exception:
+        # Broken or encrypted files raise all sorts; Claude may still cope
+        return None
+    lines = [' '.join(line.split()) for line in text.splitlines()]
+    lines = [line for line in lines if line]
+    if sum(len(line) for line in lines) < MIN_TEXT:
+        return None
+    return lines
+
+
+def _label(lines: list, index: int, start: int) -> str:
+    """The last few words before a value: on its line, else the line above."""
+    words = re.findall(r'[^\W\d_]+', lines[index][:start].lower())
+    if words:
+        return ' '.join(words[-3:])
+    if index > 0:
+        words = re.findall(r'[^\W\d_]+', lines[index - 1].lower())
+        return '^' + ' '.join(words[-3:])
+    return ''
+
+
+def find_amounts(lines: list) -> list:
+    """(value, currency or None, label) for every money-looking figure."""
+    found = []
+    for index, line in enumerate(lines):
+        for match in AMOUNT.finditer(line):
+            units = re.sub(r'[.,]', '', match['units'])
+            value = Decimal(f'{units}.{match["cents"]}')
+            sign = match['before'] or match['after']
+            currency = CURRENCY_SYMBOLS.get(sign, sign)
+            found.append((value, currency, _label(lines, index, match.start())))
+    return found
+
+
+def find_dates(lines: list) -> list:
+    """(format, date, label) for every date in any of DATE_FORMATS."""
+    found = []
+    for index, line in enumerate(lines):
+        for name, pattern in DATE_FORMATS.items():
+            for match in pattern.finditer(line):
+                month = match['month']
+                month = int(month) if month.isdigit() else MONTHS[month.lower()]
+                try:
+                    value = date(int(match['year']), month, int(match['day']))
+                except ValueError:
+                    continue
+                found.append((name, value, _label(lines, index, match.start())))
+    return found
+
+
+def invoice_shape(number: str) -> str:
+    """A pattern for invoice numbers like this one: digit runs may vary, the rest not."""
+    return r'(?<![\w-])' + re.sub(r'\d+', r'\\d+', re.escape(number)) + r'(?![\w-])'
+
+
+def _most_common(values: list, total: int):
+    """The value most samples agree on, if enough do; else None."""
+    if not values:
+        return None
+    value, count = Counter(values).most_common(1)[0]
+    if count >= MIN_SAMPLES and count >= MIN_AGREEMENT * total:
+        return value
+    return None
+
+
+def learn_vendor(vendor: str, markers: list, samples: list) -> Optional[dict]:
+    """
+    Rules for one vendor from its confirmed expenses.
+
+    Args:
+        vendor: The vendor_name the rules fill in
+        markers: Lowercase strings that may identify the vendor's invoices
+                 (its name, aliases, sender domain)
+        samples: (expense dict, pdf bytes) pairs, newest first
+
+    Returns:
+        The rules, or None if the samples don't agree on where the amount
+        and date are or on the shape of the invoice number
+    """
+    texts = []
+    for expense, pdf_data in samples:
+        lines = pdf_lines(pdf_data)
+        if lines is not None:
+            texts.append((expense, lines))
+    if len(texts) < MIN_SAMPLES:
+        return None
+
+    # Markers that appear on (nearly) every invoice of this vendor
+    lowered = [' '.join(lines).lower() for _, lines in texts]
+    markers = [m for m in markers
+               if len(m) >= 3 and sum(m in text for text in lowered) >= MIN_AGREEMENT * len(texts)]
+    if not markers:
+        return None
+
+    amount_labels, date_rules, shapes = [], [], []
+    for expense, lines in texts:
+        amount = Decimal(str(expense['amount']))
+        # Each sample votes once per label, however often it repeats the total
+        amount_labels.extend({label for value, _, label in find_amounts(lines) if value == amount})
+        if expense.get('expense_date'):
+            expense_date = date.fromisoformat(expense['expense_date'])
+            date_rules.extend({(name, label) for name, value, label in find_dates(lines)
+                               if value == expense_date})
+        number = expense.get('invoice_number')
+        if number and number in ' '.join(lines):
+            shapes.append(invoice_shape(number))
+
+    amount_label = _most_common(amount_labels, len(texts))
+    date_rule = _most_common(date_rules, len(texts))
+    # Without the invoice number a second copy of an invoice would not be
+    # caught as a duplicate, so that is left to Claude too
+    shape = _most_common(shapes, len(texts))
+    if amount_label is None or date_rule is None or shape is None:
+        return None
+
+    def usual(field):
+        return Counter(json.dumps(e.get(field)) for e, _ in texts).most_common(1)[0][0]
+
+    return {
+        'vendor_name': vendor,
+        'markers': markers,
+        'amount_label': amount_label,
+        'date_format': date_rule[0],
+        'date_label': date_rule[1],
+        'invoice_shape': shape,
+        'currency': _most_common([e['currency'] for e, _ in texts], len(texts)),
+        # Filled in as on the vendor's recent expenses
+        'defaults': {field: json.loads(usual(field))
+                     for field in ('type', 'cost_category', 'explanation', 'tags')},
+        'samples': len(texts),
+    }
+
+
+def extract_with(rules: dict, lines: list) -> Optional[dict]:
+    """The expense fields by one vendor's rules, or None unless each is unambiguous."""
+    amounts = {(value, currency) for value, currency, label in find_amounts(lines)
+               if label == rules['amount_label']}
+    dates = {value for name, value, label in find_dates(lines)
+             if name == rules['date_format'] and label == rules['date_label']}
+    if len(amounts) != 1 or len(dates) != 1:
+        return None
+    (amount, currency), = amounts
+    currency = currency or rules['currency']
+    if currency is None:
+        return None
+
+    # Rules learned before the shape was required may lack one
+    if not rules['invoice_shape']:
+        return None
+    numbers = set(re.findall(rules['invoice_shape'], '\n'.join(lines)))
+    if len(numbers) != 1:
+        return None
+    invoice_number, = numbers
+
+    return {
+        **rules['defaults'],
+        'amount': float(amount),
+        'currency': currency,
+        'vendor_name': rules['vendor_name'],
+        'invoice_number': invoice_number,
+        'expense_date': dates.pop().isoformat(),
+        'local_extraction': True,
+    }
+
+
+class VendorRules:
+    """The rules in VENDOR_RULES_FILE, reread whenever the file changes."""
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self._rules = []
+        self._mtime = None
+
+    def get(self) -> list:
+        if not self.path:
+            return []
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            self._rules, self._mtime = [], None
+            return self._rules
+        if mtime != self._mtime:
+            with open(self.path, encoding='utf-8') as handle:
+                self._rules = json.load(handle)['vendors']
+            self._mtime = mtime
+        return self._rules
+
+    def save(self, rules: list):
+        """Replace the file in one step, so a worker never reads half of it."""
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        partial = self.path + '.partial'
+        with open(partial, 'w', encoding='utf-8') as handle:
+            json.dump({'vendors': rules}, handle, indent=1)
+        os.replace(partial, self.path)
+
+
+vendor_rules = VendorRules(Config.VENDOR_RULES_FILE)
+
+
+class Counters:
+    """Named totals in a SQLite file of their own, summed over all workers."""
+
+    def __init__(self, path: Optional[str]):
+        """
+        Args:
+            path: The SQLite file; None or '' turns counting off
+        """
+        self.path = path
+        self._ready = False
+
+    def add(self, **amounts):
+        """Add to the named totals, e.g. add(local_hits=1, local_hit_us=5200)."""
+        if not self.path:
+            return
+        try:
+            with self._connect() as conn:
+                conn.executemany('''
+                    INSERT INTO counters (name, value) VALUES (?, ?)
+                    ON CONFLICT (name) DO UPDATE SET value = value + excluded.value
+                ''', amounts.items())
+        except (OSError, sqlite3.Error) as e:
+            logger.warning('Local extraction count failed: %s', e)
+
+    def get(self) -> dict:
+        """Every total by name; those never added to are missing."""
+        if not self.path:
+            return {}
+        try:
+            with self._connect() as conn:
+                return dict(conn.execute('SELECT name, value FROM counters'))
+        except (OSError, sqlite3.Error) as e:
+            logger.warning('Local extraction stats failed: %s', e)
+            return {}
+
+    @contextmanager
+    def _connect(self):
+        """A connection in a transaction, committed and closed on the way out."""
+        if not self._ready:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with closing(sqlite3.connect(self.path, timeout=5)) as conn:
+            if not self._ready:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('CREATE TABLE IF NOT EXISTS counters '
+                             '(name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+                self._ready = True
+            with conn:
+                yield conn
+
+
+stats = Counters(Config.LOCAL_EXTRACTION_STATS_FILE)
+
+
+def extract(pdf_data: bytes) -> Optional[dict]:
+    """
+    The expense fields of a PDF from a known vendor, read locally.
+
+    Returns:
+        A dict shaped like Claude's answer (plus 'local_extraction': True),
+        or None when Claude should read the PDF instead
+    """
+    rules = vendor_rules.get()
+    if not rules:
+        return None
+    lines = pdf_lines(pdf_data)
+    if lines is None:
+        return None
+    text = ' '.join(lines).lower()
+    vendors = [r for r in rules if any(marker in text for marker in r['markers'])]
+    if len(vendors) != 1:
+        return None
+    return extract_with(vendors[0], lines)
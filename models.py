@@ -4,6 +4,126 @@ from flask_sqlalchemy import SQLAlchemy
 db = SQLAlchemy()
 
 
+class Attachment(db.Model):
+    """A PDF, stored once however many expenses refer to it."""
+    __tablename__ = 'attachments'
+
+    sha256 = db.Column(db.String(64), primary_key=True)  # hex digest of data
+    size = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class MonthlyRollup(db.Model):
+    """EUR totals per month, type and category. Maintained by rollup.py."""
+    __tablename__ = 'monthly_rollup'
+
+    year = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.Integer, primary_key=True)
+    type = db.Column(db.String(10), primary_key=True)
+    cost_category = db.Column(db.String(20), primary_key=True)  # '' when uncategorized
+    total_eur = db.Column(db.Numeric(14, 2), nullable=False, default=0)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class DataVersion(db.Model):
+    """One row counting writes to expenses. Bumped by rollup.py."""
+    __tablename__ = 'data_version'
+
+    id = db.Column(db.Integer, primary_key=True)  # always 1
+    version = db.Column(db.BigInteger, nullable=False)
+
+
+class ParseJob(db.Model):
+    """A PDF waiting for, or done with, a background parse. See parse_jobs.py."""
+    __tablename__ = 'parse_jobs'
+
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex, handed to the client
+    status = db.Column(db.String(10), nullable=False, index=True)  # queued, running, done, failed
+    filename = db.Column(db.String(255))
+    pdf_data = db.Column(db.LargeBinary)  # dropped once parsed, or for a batch once saved
+    use_cache = db.Column(db.Boolean, nullable=False, default=True)
+    # The ingest batch it is a file of; None for a single upload
+    batch_id = db.Column(db.String(32), db.ForeignKey('ingest_batches.id', ondelete='CASCADE'),
+                         index=True)
+    result = db.Column(db.JSON)
+    error = db.Column(db.Text)
+    # Renewed by the worker holding the job; once past, another may take it over
+    lease_until = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def to_dict(self):
+        data = {'success': self.status != 'failed', 'job_id': self.id,
+                'status': self.status, 'filename': self.filename}
+        if self.status == 'done':
+            data['data'] = self.result
+        elif self.status == 'failed':
+            data['error'] = self.error
+        return data
+
+
+class IngestBatch(db.Model):
+    """A set of uploaded invoices being parsed and saved together. See ingest.py."""
+    __tablename__ = 'ingest_batches'
+
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex
+    status = db.Column(db.String(10), nullable=False)  # running, done, failed
+    total = db.Column(db.Integer, nullable=False)  # files found in the upload
+    parsed = db.Column(db.Integer, nullable=False, default=0)
+    report = db.Column(db.JSON)  # one entry per file; the outcome of each once done
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    def to_dict(self):
+        return {
+            'success': self.status != 'failed',
+            'batch_id': self.id,
+            'status': self.status,
+            'total': self.total,
+            'parsed': self.parsed,
+            'files': self.report,
+            'error': self.error,
+        }
+
+
+class MailboxCheckpoint(db.Model):
+    """How far email_sync has read a mailbox."""
+    __tablename__ = 'mailbox_checkpoints'
+
+    mailbox = db.Column(db.String(255), primary_key=True)
+    # UIDs only mean anything within one UIDVALIDITY; a new one starts over
+    uidvalidity = db.Column(db.BigInteger, nullable=False)
+    last_uid = db.Column(db.BigInteger, nullable=False)  # every UID up to here is handled
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class EmailRetry(db.Model):
+    """A message email_sync could not parse, to try again later."""
+    __tablename__ = 'email_retries'
+
+    mailbox = db.Column(db.String(255), primary_key=True)
+    uid = db.Column(db.BigInteger, primary_key=True)
+    uidvalidity = db.Column(db.BigInteger, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, index=True)  # NULL once given up on
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class IdempotencyKey(db.Model):
+    """An Idempotency-Key sent with POST /api/expenses, and the expense it created."""
+    __tablename__ = 'idempotency_keys'
+
+    key = db.Column(db.String(255), primary_key=True)
+    request_sha256 = db.Column(db.String(64), nullable=False)  # of the body it came with
+    # NULL only while the request that claimed the key is still saving
+    expense_id = db.Column(db.Integer, db.ForeignKey('expenses.id', ondelete='CASCADE'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)  # pruned after a day
+
+
 class Expense(db.Model):
     __tablename__ = 'expenses'
 
@@ -31,19 +151,24 @@ class Expense(db.Model):
     email_subject = db.Column(db.String(500))
     invoice_number = db.Column(db.String(100))
 
-    # PDF attachment
+    # PDF attachment. The bytes live in the attachments table, keyed by hash,
+    # so the expenses table stays small enough to scan.
     attachment_filename = db.Column(db.String(255))
-    attachment_data = db.Column(db.LargeBinary)
+    attachment_sha256 = db.Column(db.String(64), db.ForeignKey('attachments.sha256'))
+    attachment_size = db.Column(db.Integer)
     has_attachments = db.Column(db.Boolean, default=False)
 
     # Timestamps
     expense_date = db.Column(db.Date)  # When the expense occurred
     email_date = db.Column(db.DateTime)  # When the email was sent (Phase 3)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Not null: the expense list pages by it (see encode_cursor)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
     def __repr__(self):
         return f'<Expense {self.id}: {self.type} {self.amount} {self.currency}>'
 
+    # The expense list renders rows the same way without loading them as
+    # Expenses (serialize.FIELDS); a change here belongs there too.
     def to_dict(self):
         return {
             'id': self.id,
@@ -0,0 +1,176 @@
+"""
+Cache of AI parse results, keyed by what was parsed.
+
+Re-submitting the same invoice PDF or pasted email - after a failed save, say -
+returns the earlier result from a local SQLite file instead of asking Claude
+again. Keys are the SHA-256 of the prompt version and the normalized input, so
+changing the prompt or model starts over without anyone clearing anything.
+
+The file is shared by all workers. Entries expire after `ttl` seconds, and
+past `max_entries` the least recently used are evicted. Hits, misses and
+evictions are counted in the file as well, so `stats()` covers every worker.
+A broken or unwritable cache only costs the API call it would have saved.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from contextlib import closing, contextmanager
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS parse_results (
+        key TEXT PRIMARY KEY,
+        result TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        used_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS parse_results_used_at ON parse_results (used_at);
+    CREATE TABLE IF NOT EXISTS counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    );
+'''
+
+COUNT = '''
+    INSERT INTO counters (name, value) VALUES (?, ?)
+    ON CONFLICT (name) DO UPDATE SET value = value + excluded.value
+'''
+
+
+def content_key(version: str, *parts) -> str:
+    """SHA-256 over the prompt version and the parts (str or bytes) of the input."""
+    digest = hashlib.sha256(version.encode('utf-8'))
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        # Length-prefixed, so ('ab', 'c') and ('a', 'bc') differ
+        digest.update(b'%d:' % len(part))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class ParseCache:
+    """Parse results by content key, in a SQLite file."""
+
+    def __init__(self, path: Optional[str], ttl: float = 30 * 24 * 3600,
+                 max_entries: int = 10000):
+        """
+        Args:
+            path: The SQLite file; None or '' disables the cache
+            ttl: Seconds an entry stays valid
+            max_entries: Entries kept before the least recently used go
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._ready = False
+
+    def get_or_parse(self, key: str, parse: Callable[[], dict],
+                     use_cache: bool = True) -> dict:
+        """
+        The cached result for this key, or parse() stored under it.
+
+        Error results are returned but never stored, so a failure is retried
+        next time.
+
+        Args:
+            use_cache: False skips the lookup and parses afresh; the fresh
+                       result still replaces the cached one
+        """
+        if use_cache:
+            cached = self.get(key)
+            if cached is not None:
+                return cached
+        result = parse()
+        if 'error' not in result:
+            self.put(key, result)
+        return result
+
+    def get(self, key: str) -> Optional[dict]:
+        """The live entry for this key, counted as a hit or miss."""
+        if not self.path:
+            return None
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    'SELECT result FROM parse_results WHERE key = ? AND created_at > ?',
+                    (key, now - self.ttl)).fetchone()
+                if row is None:
+                    conn.execute(COUNT, ('misses', 1))
+                    return None
+                conn.execute('UPDATE parse_results SET used_at = ? WHERE key = ?', (now, key))
+                conn.execute(COUNT, ('hits', 1))
+            return json.loads(row[0])
+        except (sqlite3.Error, ValueError) as e:
+            logger.warning('Parse cache lookup failed: %s', e)
+            return None
+
+    def put(self, key: str, result: dict):
+        """Store a result, then drop expired entries and any beyond max_entries."""
+        if not self.path:
+            return
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                conn.execute('INSERT OR REPLACE INTO parse_results VALUES (?, ?, ?, ?)',
+                             (key, json.dumps(result), now, now))
+                expired = conn.execute('DELETE FROM parse_results WHERE created_at <= ?',
+                                       (now - self.ttl,)).rowcount
+                evicted = conn.execute('''
+                    DELETE FROM parse_results WHERE key IN (
+                        SELECT key FROM parse_results ORDER BY used_at DESC
+                        LIMIT -1 OFFSET ?)''', (self.max_entries,)).rowcount
+                if expired + evicted:
+                    conn.execute(COUNT, ('evictions', expired + evicted))
+        except sqlite3.Error as e:
+            logger.warning('Parse cache store failed: %s', e)
+
+    def stats(self) -> dict:
+        """Hit, miss and eviction counts across all workers, and the entry count."""
+        stats = {'enabled': bool(self.path), 'hits': 0, 'misses': 0,
+                 'evictions': 0, 'entries': 0}
+        if not self.path:
+            return stats
+        try:
+            with self._connect() as conn:
+                stats.update(conn.execute(
+                    "SELECT name, value FROM counters WHERE name IN ('hits', 'misses', 'evictions')"))
+                stats['entries'] = conn.execute(
+                    'SELECT count(*) FROM parse_results').fetchone()[0]
+        except sqlite3.Error as e:
+            logger.warning('Parse cache stats failed: %s', e)
+        return stats
+
+    def clear(self):
+        """Drop every entry and reset the counters."""
+        if not self.path:
+            return
+        with self._connect() as conn:
+            conn.execute('DELETE FROM parse_results')
+            conn.execute('DELETE FROM counters')
+
+    @contextmanager
+    def _connect(self):
+        """A connection in a transaction, committed and closed on the way out."""
+        # One per call: they are cheap, and may not cross threads
+        if not self._ready:
+            try:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            except OSError as e:
+                # As the callers handle it: a cache that cannot open is a miss
+                raise sqlite3.OperationalError(f'Cannot create {self.path}: {e}') from e
+        with closing(sqlite3.connect(self.path, timeout=5)) as conn:
+            if not self._ready:
+                # WAL lets workers read while another writes
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.executescript(SCHEMA)
+                self._ready = True
+            with conn:
+                yield conn
@@ -0,0 +1,276 @@
+"""
+Background parsing of uploaded PDFs.
+
+A Claude round trip on a large PDF takes long enough that doing it inside the
+request ties up a gunicorn worker, and a few uploads at once stall the whole
+UI. POST /api/parse-jobs instead stores the PDF in `parse_jobs` and returns a
+job id straight away. A small thread pool in each worker does the parsing,
+and the page polls GET /api/parse-jobs/<id> until the result is there.
+
+The table, not the pool, is what remembers the jobs. Each pool renews a lease
+on the jobs it holds every few seconds; when a worker restarts, the leases on
+its unfinished jobs run out and the next worker to look takes them over: on
+the next upload, on a poll for one of them, or from its own renewal thread.
+Results stay in the table for a day, readable from any worker.
+
+The files of an ingest batch (see ingest.py) are parse jobs too, with a
+batch_id. They run on threads of their own, INGEST_PARALLELISM of them with
+retries when rate limited, so a large batch neither waits behind nor holds up
+single uploads. They keep their PDF until the batch is saved.
+"""
+
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+from sqlalchemy import case, func, update
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import db, IngestBatch, ParseJob
+
+logger = logging.getLogger(__name__)
+
+# Jobs in these states still need a worker
+PENDING = ('queued', 'running')
+
+# How long a job stays claimed without renewal, and how often it is renewed
+LEASE = timedelta(seconds=30)
+RENEW_INTERVAL = 10
+
+# Finished jobs, and their results, are deleted after this
+RETENTION = timedelta(days=1)
+
+
+class ParsePool:
+    """Threads that parse queued PDFs, one pool per worker process."""
+
+    def __init__(self, parse: Callable = None):
+        """
+        Args:
+            parse: Called as parse(pdf_data, filename, use_cache=..., local=..., timeout=...,
+                   retries=...) and returns the parsed fields or {'error': ...}.
+                   ai_parser.parse_pdf_with_claude when omitted.
+        """
+        self.parse = parse
+        self.app = None
+        self._executors = {}  # batch job or not -> ThreadPoolExecutor
+        self._renewer: Optional[threading.Thread] = None
+        self._held = set()  # ids of the jobs this process has queued or running
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config['PARSE_JOB_WORKERS']
+        self.max_pending = app.config['PARSE_JOB_MAX_PENDING']
+        self.timeout = app.config['PARSE_JOB_TIMEOUT']
+        self.batch_workers = app.config['INGEST_PARALLELISM']
+        self.batch_retries = app.config['INGEST_RETRIES']
+        if self.parse is None:
+            from ai_parser import parse_pdf_with_claude
+            self.parse = parse_pdf_with_claude
+
+    def submit(self, pdf_data: bytes, filename: str, use_cache: bool = True) -> Optional[ParseJob]:
+        """
+        Queue a PDF for parsing.
+
+        Returns:
+            The new job, or None when max_pending jobs are already waiting
+        """
+        # Jobs a restarted worker left behind would otherwise hold their place
+        # until they expire, whether or not anyone polls for them
+        self.take_over_orphans()
+        pending = ParseJob.query.filter(ParseJob.status.in_(PENDING),
+                                        ParseJob.batch_id.is_(None)).count()
+        if pending >= self.max_pending:
+            return None
+
+        # Not the jobs of a batch: saving it deletes them
+        ParseJob.query.filter(
+            ParseJob.created_at < datetime.utcnow() - RETENTION,
+            ParseJob.status.notin_(PENDING),
+            ParseJob.batch_id.is_(None),
+        ).delete(synchronize_session=False)
+
+        job = ParseJob(
+            id=uuid.uuid4().hex,
+            status='queued',
+            filename=filename,
+            pdf_data=pdf_data,
+            use_cache=use_cache,
+            lease_until=func.now() + LEASE,
+        )
+        db.session.add(job)
+        db.session.commit()
+        self._start(job.id)
+        return job
+
+    def submit_batch(self, batch_id: str, files) -> list:
+        """
+        Queue the files of an ingest batch, in the caller's transaction; start
+        them with start_batch() once it is committed.
+
+        Args:
+            files: (pdf_data, filename) pairs
+
+        Returns:
+            The new jobs, in the order of files
+        """
+        jobs = [ParseJob(id=uuid.uuid4().hex, status='queued', batch_id=batch_id,
+                         filename=filename, pdf_data=pdf_data, use_cache=True,
+                         lease_until=func.now() + LEASE)
+                for pdf_data, filename in files]
+        db.session.add_all(jobs)
+        return jobs
+
+    def start_batch(self, jobs):
+        for job in jobs:
+            self._start(job.id, job.batch_id)
+
+    def get(self, job_id: str) -> Optional[ParseJob]:
+        """The job, taken over first if the worker that held it is gone."""
+        job = db.session.get(ParseJob, job_id)
+        if job is None or job.status not in PENDING:
+            return job
+
+        orphaned = db.session.execute(
+            update(ParseJob)
+            .where(ParseJob.id == job_id,
+                   ParseJob.status.in_(PENDING),
+                   ParseJob.lease_until < func.now())
+            .values(status='queued', lease_until=func.now() + LEASE)
+        ).rowcount
+        db.session.commit()
+        if orphaned:
+            logger.warning('Taking over parse job %s from a worker that stopped', job_id)
+            self._start(job_id, job.batch_id)
+        return job
+
+    def take_over_orphans(self):
+        """Requeue and start every pending job whose lease has run out."""
+        orphaned = db.session.execute(
+            update(ParseJob)
+            .where(ParseJob.status.in_(PENDING),
+                   ParseJob.lease_until < func.now())
+            .values(status='queued', lease_until=func.now() + LEASE)
+            .returning(ParseJob.id, ParseJob.batch_id)
+        ).all()
+        db.session.commit()
+        for job_id, batch_id in orphaned:
+            logger.warning('Taking over parse job %s from a worker that stopped', job_id)
+            self._start(job_id, batch_id)
+
+    def _start(self, job_id: str, batch_id: Optional[str] = None):
+        batch = batch_id is not None
+        with self._lock:
+            if self._renewer is None:
+                self._renewer = threading.Thread(target=self._renew_leases,
+                                                 name='parse-job-leases', daemon=True)
+                self._renewer.start()
+            executor = self._executors.get(batch)
+            if executor is None:
+                executor = self._executors[batch] = ThreadPoolExecutor(
+                    self.batch_workers if batch else self.workers,
+                    thread_name_prefix='ingest-parse' if batch else 'parse-job')
+            self._held.add(job_id)
+        executor.submit(self._run, job_id)
+
+    def _run(self, job_id: str):
+        with self.app.app_context():
+            try:
+                self._parse_job(job_id)
+            except SQLAlchemyError as e:
+                # Its lease will lapse and the next poll retries it
+                db.session.rollback()
+                logger.warning('Parse job %s failed to run: %s', job_id, e)
+            except Exception as e:
+                # Retrying would only fail again: report it
+                db.session.rollback()
+                logger.exception('Parse job %s failed', job_id)
+                try:
+                    self._finish(job_id, {'error': f'Parsing failed: {e}'})
+                except SQLAlchemyError:
+                    db.session.rollback()
+                    logger.exception('Could not mark parse job %s failed', job_id)
+            finally:
+                with self._lock:
+                    self._held.discard(job_id)
+
+    def _parse_job(self, job_id: str):
+        claimed = db.session.execute(
+            update(ParseJob)
+            .where(ParseJob.id == job_id, ParseJob.status == 'queued')
+            .values(status='running', started_at=datetime.utcnow(),
+                    lease_until=func.now() + LEASE)
+        ).rowcount
+        if not claimed:
+            db.session.rollback()
+            return
+        job = db.session.get(ParseJob, job_id)
+        pdf_data, filename, use_cache = job.pdf_data, job.filename, job.use_cache
+        batch_id = job.batch_id
+        # No transaction may stay open through the API call
+        db.session.commit()
+
+        try:
+            result = self.parse(pdf_data, filename, use_cache=use_cache, local=use_cache,
+                                timeout=self.timeout,
+                                retries=self.batch_retries if batch_id else 0)
+        except Exception as e:
+            result = {'error': f'AI parsing failed: {e}'}
+
+        self._finish(job_id, result)
+
+    def _finish(self, job_id: str, result: dict):
+        """Record a running job's result or {'error': ...}, and save its batch if it was the last."""
+        failed = 'error' in result
+        finished = db.session.execute(
+            update(ParseJob)
+            # Not if its lease lapsed and another worker finished it meanwhile
+            .where(ParseJob.id == job_id, ParseJob.status == 'running')
+            .values(status='failed' if failed else 'done',
+                    result=None if failed else result,
+                    error=result['error'] if failed else None,
+                    # A batch still needs it, to save as the attachment
+                    pdf_data=case((ParseJob.batch_id.is_(None), None), else_=ParseJob.pdf_data),
+                    finished_at=datetime.utcnow())
+            .returning(ParseJob.batch_id)
+        ).first()
+        batch_id = finished.batch_id if finished else None
+        if batch_id:
+            db.session.execute(
+                update(IngestBatch)
+                .where(IngestBatch.id == batch_id)
+                .values(parsed=IngestBatch.parsed + 1)
+            )
+        db.session.commit()
+
+        if batch_id:
+            # Imported here: ingest queues its files through this pool
+            import ingest
+            ingest.finish(batch_id)
+
+    def _renew_leases(self):
+        while True:
+            time.sleep(RENEW_INTERVAL)
+            with self._lock:
+                held = list(self._held)
+            with self.app.app_context():
+                try:
+                    if held:
+                        db.session.execute(
+                            update(ParseJob)
+                            .where(ParseJob.id.in_(held), ParseJob.status.in_(PENDING))
+                            .values(lease_until=func.now() + LEASE)
+                        )
+                        db.session.commit()
+                    self.take_over_orphans()
+                except SQLAlchemyError as e:
+                    db.session.rollback()
+                    logger.warning('Could not renew parse job leases: %s', e)
+
+
+pool = ParsePool()
@@ -9,14 +9,27 @@ local database holds live production data (see CLAUDE.md).
 
 Usage:
     python reconcile.py transaction-history.csv --year 2025
+
+Several Wise accounts and years go in one run: the transactions of every CSV
+are matched together against one load of the database, so a charge near New
+Year or a row two cards could claim is paired exactly once. The reports, one
+set per year, are then written in parallel.
+
+    python reconcile.py business.csv personal.csv travel.csv --years 2022-2025
 """
 
 import csv
 import difflib
+import os
 import re
+import sys
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date, timedelta
 from decimal import Decimal
+from functools import lru_cache
+from operator import itemgetter
 from pathlib import Path
 
 import click
@@ -78,8 +91,9 @@ LEGAL_SUFFIXES = re.compile(
 NOISE_TOKENS = {'wrede2024', 'keepthescor', 'c'}
 
 
+@lru_cache(maxsize=None)
 def normalize(name):
-    """Reduce a vendor name to a comparable form."""
+    """Reduce a vendor name to a comparable form. Cached, as names recur."""
     if not name:
         return ''
     text = name.lower().replace('ı', 'i')        # "Notıon Labs" -> "notion labs"
@@ -93,31 +107,67 @@ def normalize(name):
 # Loading
 # ---------------------------------------------------------------------------
 
+# The CSV columns a Txn is built from, in the order it takes them
+TXN_COLUMNS = (
+    'ID', 'Created on', 'Target name', 'Category',
+    'Source amount (after fees)', 'Source currency',
+    'Target amount (after fees)', 'Target currency', 'Exchange rate',
+)
+
+
 class Txn:
-    """One Wise card transaction."""
+    """One Wise card transaction, from a tuple of TXN_COLUMNS values.
 
-    def __init__(self, idx, row):
+    A statement can run to hundreds of thousands of these: slots instead of a
+    __dict__, and the merchant name normalized only when first asked for.
+    """
+
+    __slots__ = ('idx', 'wise_id', 'date', 'merchant', 'wise_category',
+                 'src_amount', 'src_currency', 'tgt_amount', 'tgt_currency',
+                 'exchange_rate', 'amount_keys', 'amount_eur', '_norm', '_vendor_forms')
+
+    def __init__(self, idx, values):
+        (self.wise_id, created, merchant, category, src_amount, src_currency,
+         tgt_amount, tgt_currency, exchange_rate) = values
         self.idx = idx
-        self.wise_id = row['ID']
-        self.date = date.fromisoformat(row['Created on'][:10])
-        self.merchant = row['Target name']
-        self.norm = normalize(self.merchant)
-        self.wise_category = row['Category']
-
-        self.src_amount = _money(row['Source amount (after fees)'])
-        self.src_currency = row['Source currency']
-        self.tgt_amount = _money(row['Target amount (after fees)'])
-        self.tgt_currency = row['Target currency']
-        self.exchange_rate = row['Exchange rate']
+        self.date = _day(created[:10])
+
+        # The same few thousand names, categories and rates recur on every
+        # line; one copy of each is enough.
+        self.merchant = sys.intern(merchant)
+        self.wise_category = sys.intern(category)
+        self.src_currency = sys.intern(src_currency)
+        self.tgt_currency = sys.intern(tgt_currency)
+        self.exchange_rate = sys.intern(exchange_rate)
+
+        self.src_amount = _money(src_amount)
+        self.tgt_amount = _money(tgt_amount)
 
         # The database stores sometimes the EUR charged, sometimes the merchant
         # amount, so both are valid join keys.
-        keys = {(self.src_amount, self.src_currency)}
+        source = (self.src_amount, self.src_currency)
         if self.tgt_amount is not None and self.tgt_currency:
-            keys.add((self.tgt_amount, self.tgt_currency))
-        self.amount_keys = keys
+            target = (self.tgt_amount, self.tgt_currency)
+            self.amount_keys = (source,) if target == source else (source, target)
+        else:
+            self.amount_keys = (source,)
 
         self.amount_eur = self.src_amount if self.src_currency == 'EUR' else None
+        self._norm = self._vendor_forms = None
+
+    @property
+    def norm(self):
+        if self._norm is None:
+            self._norm = normalize(self.merchant)
+        return self._norm
+
+    @property
+    def vendor_forms(self):
+        """The forms vendor_matches() compares, normalized once rather than per row."""
+        if self._vendor_forms is None:
+            forms = {self.norm, normalize(self.alias)}
+            self._vendor_forms = tuple(form for form in forms if form)
+        return self._vendor_forms
 
     @property
     def alias(self):
@@ -157,39 +207,74 @@ def _q(value):
     return Decimal(str(value)).quantize(Decimal('0.01'))
 
 
+# Cached: a statement repeats the same few thousand amounts and days, and
+# both are immutable, so transactions can share them.
+@lru_cache(maxsize=None)
 def _money(raw):
     if raw is None or raw == '':
         return None
     return _q(raw)
 
 
-def load_csv(path, year):
-    """Completed outgoing card transactions for the given year."""
-    txns, skipped = [], 0
+_day = lru_cache(maxsize=None)(date.fromisoformat)
+
+
+def scan_csv(path, years=()):
+    """Read a Wise CSV in one pass.
+
+    Returns the number of lines per year, for infer_year(); the completed
+    outgoing card transactions of the given years - of every year if none are
+    given - in file order; and how many lines were left out.
+    """
+    wanted = {str(year) for year in years}
+    per_year, txns, skipped = {}, [], 0
     with open(path, newline='', encoding='utf-8') as handle:
-        for row in csv.DictReader(handle):
-            if row['Status'] != 'COMPLETED' or row['Direction'] != 'OUT':
-                skipped += 1
+        reader = csv.reader(handle)
+        header = next(reader, [])
+        status, direction, created = (header.index(column)
+                                      for column in ('Status', 'Direction', 'Created on'))
+        values = itemgetter(*(header.index(column) for column in TXN_COLUMNS))
+        for line in reader:
+            if not line:
                 continue
-            if year and row['Created on'][:4] != str(year):
+            year = line[created][:4]
+            per_year[year] = per_year.get(year, 0) + 1
+            if (line[status] != 'COMPLETED' or line[direction] != 'OUT'
+                    or wanted and year not in wanted):
                 skipped += 1
                 continue
-            txns.append(Txn(len(txns), row))
-    return txns, skipped
+            txns.append(Txn(len(txns), values(line)))
+    return per_year, txns, skipped
 
 
-def infer_year(path):
-    with open(path, newline='', encoding='utf-8') as handle:
-        years = defaultdict(int)
-        for row in csv.DictReader(handle):
-            years[row['Created on'][:4]] += 1
-    return int(max(years, key=years.get))
+def infer_year(per_year):
+    """The year most of the CSV's lines fall in, from scan_csv()."""
+    return int(max(per_year, key=per_year.get))
 
 
-def load_db_rows(conn, year, margin_days):
-    """Cost rows around the target year. Reads only."""
-    start = date(year, 1, 1) - timedelta(days=margin_days)
-    end = date(year + 1, 1, 1) + timedelta(days=margin_days)
+def in_years(txns, years, start=0):
+    """The scanned transactions in the given years (any if empty), and how many
+    were in other years.
+
+    Renumbered from `start`, so transactions from several CSVs keep distinct idx.
+    """
+    kept = [t for t in txns if not years or t.date.year in years]
+    for n, txn in enumerate(kept, start):
+        txn.idx = n
+    return kept, len(txns) - len(kept)
+
+
+def load_csv(path, years, start=0):
+    """Completed outgoing card transactions in the given years."""
+    _, txns, skipped = scan_csv(path, years)
+    txns, _ = in_years(txns, years, start)
+    return txns, skipped
+
+
+def load_db_rows(conn, years, margin_days):
+    """Cost rows around the target years. Reads only."""
+    start = date(min(years), 1, 1) - timedelta(days=margin_days)
+    end = date(max(years) + 1, 1, 1) + timedelta(days=margin_days)
     with conn.cursor() as cur:
         cur.execute(
             """
@@ -205,6 +290,13 @@ def load_db_rows(conn, year, margin_days):
         return [DbRow(rec) for rec in cur.fetchall()]
 
 
+def rows_around(rows, year, margin_days):
+    """The rows load_db_rows() would return for this year alone."""
+    start = date(year, 1, 1) - timedelta(days=margin_days)
+    end = date(year + 1, 1, 1) + timedelta(days=margin_days)
+    return [r for r in rows if start <= r.date < end]
+
+
 # ---------------------------------------------------------------------------
 # Matching
 #
@@ -232,12 +324,9 @@ def amount_near(txn, row):
 
 
 def vendor_matches(txn, row):
-    candidates = {txn.norm}
-    if txn.alias:
-        candidates.add(normalize(txn.alias))
-    for candidate in candidates:
-        if not candidate or not row.norm:
-            continue
+    if not row.norm:
+        return False
+    for candidate in txn.vendor_forms:
         if candidate == row.norm or candidate in row.norm or row.norm in candidate:
             return True
     return False
@@ -283,12 +372,86 @@ PASSES = (
 )
 
 
+class RowIndex:
+    """The database rows of one pass, indexed for the transactions to look up.
+
+    Each lookup returns every row that could satisfy its predicate - possibly
+    more, never fewer - so run_pass() can leave the deciding to the predicate and
+    still compare a transaction with a handful of rows instead of all of them.
+    """
+
+    def __init__(self, rows):
+        by_date = sorted(rows, key=lambda r: r.date)
+        self.rows = by_date
+        self.dates = [r.date for r in by_date]
+
+        # (amount, currency) -> its rows, by date
+        self.amount_rows = defaultdict(list)
+        for row in by_date:
+            self.amount_rows[(row.amount, row.currency)].append(row)
+        self.amount_dates = {key: [r.date for r in group]
+                             for key, group in self.amount_rows.items()}
+
+        # currency -> its rows, by amount
+        self.currency_rows = defaultdict(list)
+        for row in sorted(rows, key=lambda r: r.amount):
+            self.currency_rows[row.currency].append(row)
+        self.currency_amounts = {currency: [r.amount for r in group]
+                                 for currency, group in self.currency_rows.items()}
+
+    @staticmethod
+    def _between(keys, low, high):
+        return bisect_left(keys, low), bisect_right(keys, high)
+
+    def dated(self, txn, window):
+        """Rows within the window of the transaction's date."""
+        start, end = self._between(self.dates, txn.date - timedelta(days=window),
+                                   txn.date + timedelta(days=window))
+        return self.rows[start:end]
+
+    def same_amount(self, txn, window):
+        """Rows within the window with one of the transaction's amount keys."""
+        out = []
+        for key in txn.amount_keys:
+            dates = self.amount_dates.get(key)
+            if dates:
+                start, end = self._between(dates, txn.date - timedelta(days=window),
+                                           txn.date + timedelta(days=window))
+                out += self.amount_rows[key][start:end]
+        return out
+
+    def near_amount(self, txn, window):
+        """Rows within amount_near()'s tolerance of one of the amount keys."""
+        out = {}
+        for amount, currency in txn.amount_keys:
+            amounts = self.currency_amounts.get(currency)
+            if not amounts:
+                continue
+            tolerance = max(Decimal('1.00'), amount * Decimal('0.02'))
+            start, end = self._between(amounts, amount - tolerance, amount + tolerance)
+            for row in self.currency_rows[currency][start:end]:
+                out[row.id] = row
+        return out.values()
+
+
+# Where run_pass() finds the rows each predicate can accept. A predicate not
+# listed here is tried against every row in the date window.
+LOOKUPS = {
+    amount_exact: RowIndex.same_amount,
+    exact_and_vendor: RowIndex.same_amount,
+    near_and_vendor: RowIndex.near_amount,
+    same_day_same_vendor: RowIndex.dated,
+}
+
+
 def run_pass(txns, rows, window, predicate):
     """Best-first assignment: nearest date wins, so a far pair cannot consume a
     database row that a nearer pair needed."""
+    index = RowIndex(rows)
+    lookup = LOOKUPS.get(predicate, RowIndex.dated)
     candidates = []
     for txn in txns:
-        for row in rows:
+        for row in lookup(index, txn, window):
             distance = abs((row.date - txn.date).days)
             if distance > window:
                 continue
@@ -368,12 +531,12 @@ def diagnose(txn, leftover):
     """Nearest unclaimed database row and why it did not match.
 
     Without this every missing row is a research project; with it most resolve
-    at a glance.
+    at a glance. `leftover` is a RowIndex of the unclaimed rows.
     """
     # Wider than any matching window on purpose: this only ever explains, never
     # pairs, so it can safely reach the previous month to surface "a duplicate
     # absorbed this slot".
-    near = [r for r in leftover if abs((r.date - txn.date).days) <= 40]
+    near = leftover.dated(txn, 40)
     by_vendor = [r for r in near if vendor_matches(txn, r)]
     if by_vendor:
         row = min(by_vendor, key=lambda r: abs((r.date - txn.date).days))
@@ -495,7 +658,7 @@ def _csv_amounts(txn):
     return f'{source} → {txn.tgt_amount} {txn.tgt_currency}'
 
 
-def write_markdown(path, year, csv_path, txns, matched, probable, discrepancies,
+def write_markdown(path, year, csv_paths, txns, matched, probable, discrepancies,
                    missing, leftover, rows, dupes, fixable, alias_hints):
     business = [t for t in missing if not t.is_personal]
     personal = [t for t in missing if t.is_personal]
@@ -503,7 +666,7 @@ def write_markdown(path, year, csv_path, txns, matched, probable, discrepancies,
     add = out.append
 
     add(f'# Reconciliation {year} — Wise card vs expenses database\n')
-    add(f'Source: `{csv_path}`\n')
+    add(f"Source: {', '.join(f'`{p}`' for p in csv_paths)}\n")
     add('Report only. Nothing in the database was modified.\n')
 
     add('## Summary\n')
@@ -651,8 +814,8 @@ def write_markdown(path, year, csv_path, txns, matched, probable, discrepancies,
     add('## Database rows the CSV could fix\n')
     if fixable:
         add(f'{len(fixable)} matched rows have no `amount_eur`. The CSV carries the '
-            'historical rate actually charged; `flask backfill-eur` would apply '
-            "today's ECB rate instead, since `convert_to_eur()` takes no date.\n")
+            'rate actually charged; `flask backfill-eur` would apply the ECB '
+            'reference rate of the expense date instead.\n')
         add('| db id | date | amount | true EUR | rate | vendor |')
         add('|---:|---|---:|---:|---|---|')
         for row, txn in fixable:
@@ -669,65 +832,135 @@ def write_markdown(path, year, csv_path, txns, matched, probable, discrepancies,
     Path(path).write_text('\n'.join(out), encoding='utf-8')
 
 
+def write_reports(out_dir, year, csv_paths, txns, rows, claimed,
+                  matched, probable, discrepancies, missing):
+    """Write one year's report and missing-YEAR.csv from the shared matching.
+
+    Runs in a worker process, given only that year's share of the results.
+    """
+    leftover = RowIndex([r for r in rows if r.id not in claimed])
+    dupes = find_db_duplicates(rows, year, claimed)
+    fixable = find_fixable_eur(matched, year)
+    alias_hints = suggest_aliases(missing, rows)
+
+    directory = Path(out_dir)
+    missing_csv = directory / f'missing-{year}.csv'
+    report_md = directory / f'reconcile-{year}.md'
+    write_missing_csv(missing_csv, missing, leftover, rows)
+    write_markdown(report_md, year, csv_paths, txns, matched, probable, discrepancies,
+                   missing, leftover, rows, dupes, fixable, alias_hints)
+    return report_md, missing_csv
+
+
+def parse_years(ctx, param, value):
+    if value is None:
+        return None
+    first, _, last = value.partition('-')
+    try:
+        years = range(int(first), int(last or first) + 1)
+    except ValueError:
+        raise click.BadParameter('expected a year or a range like 2022-2025')
+    if not years:
+        raise click.BadParameter(f'{value} is an empty range')
+    return list(years)
+
+
 # ---------------------------------------------------------------------------
 # CLI
 # ---------------------------------------------------------------------------
 
 @click.command()
-@click.argument('csv_path', type=click.Path(exists=True, dir_okay=False))
-@click.option('--year', type=int, default=None, help='Year to reconcile (default: infer from CSV).')
+@click.argument('csv_paths', nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False))
+@click.option('--year', type=int, default=None,
+              help='Year to reconcile (default: infer from each CSV).')
+@click.option('--years', callback=parse_years, metavar='FROM-TO',
+              help='Range of years to reconcile, e.g. 2022-2025. Overrides --year.')
 @click.option('--out-dir', default='reconcile-output', help='Where to write the reports.')
 @click.option('--margin-days', default=45, show_default=True,
               help='How far outside the year to look for matching database rows.')
-def main(csv_path, year, out_dir, margin_days):
+@click.option('--jobs', type=int, default=None,
+              help='Processes writing the yearly reports (default: one per CPU).')
+def main(csv_paths, year, years, out_dir, margin_days, jobs):
     """Report which Wise card transactions are missing from the expenses database."""
-    year = year or infer_year(csv_path)
-
-    txns, skipped = load_csv(csv_path, year)
-    click.echo(f'CSV        {len(txns)} card transactions in {year}'
-               + (f' ({skipped} rows skipped)' if skipped else ''))
+    # One pass per CSV: when the year is to be inferred, every year's
+    # transactions are kept until it is known.
+    years = years or ([year] if year else [])
+    scans = [(csv_path, *scan_csv(csv_path, years)) for csv_path in csv_paths]
+    years = years or sorted({infer_year(per_year) for _, per_year, _, _ in scans})
+    label = f'{years[0]}-{years[-1]}' if len(years) > 1 else f'{years[0]}'
+
+    txns = []
+    for csv_path, _, scanned, skipped in scans:
+        loaded, other_years = in_years(scanned, years, start=len(txns))
+        skipped += other_years
+        txns += loaded
+        click.echo(f'CSV        {len(loaded)} card transactions in {label}'
+                   + (f' ({skipped} rows skipped)' if skipped else '')
+                   + (f' from {csv_path}' if len(csv_paths) > 1 else ''))
+    del scans, scanned  # and with them the other years' transactions
 
     for key in dead_alias_keys(txns):
         click.echo(f'  warning: VENDOR_ALIASES key {key!r} matches no merchant '
-                   f'in this CSV — check it against normalize()', err=True)
+                   f'in {"these CSVs" if len(csv_paths) > 1 else "this CSV"} '
+                   f'— check it against normalize()', err=True)
 
     conn = psycopg2.connect(Config.SQLALCHEMY_DATABASE_URI)
     conn.set_session(readonly=True)
     click.echo(f'Database   {Config.SQLALCHEMY_DATABASE_URI} (read-only session)')
     try:
-        rows = load_db_rows(conn, year, margin_days)
+        rows = load_db_rows(conn, years, margin_days)
     finally:
         conn.close()
     click.echo(f'           {len(rows)} cost rows in range')
 
+    # One matching over every account and year: a database row can only be
+    # claimed once, however many CSVs or years reach it.
     matched, probable, discrepancies, missing = reconcile(txns, rows)
-    business = [t for t in missing if not t.is_personal]
-    personal = [t for t in missing if t.is_personal]
-
     claimed = {r.id for _, r, *_ in matched + probable + discrepancies}
-    leftover = [r for r in rows if r.id not in claimed]
-
-    dupes = find_db_duplicates(rows, year, claimed)
-    fixable = find_fixable_eur(matched, year)
-    alias_hints = suggest_aliases(missing, rows)
 
-    directory = Path(out_dir)
-    directory.mkdir(parents=True, exist_ok=True)
-    missing_csv = directory / f'missing-{year}.csv'
-    report_md = directory / f'reconcile-{year}.md'
-    write_missing_csv(missing_csv, missing, leftover, rows)
-    write_markdown(report_md, year, csv_path, txns, matched, probable, discrepancies,
-                   missing, leftover, rows, dupes, fixable, alias_hints)
+    def pairs_in(pairs, year):
+        return [pair for pair in pairs if pair[0].date.year == year]
+
+    jobs_by_year = {}
+    for year in years:
+        year_rows = rows_around(rows, year, margin_days)
+        jobs_by_year[year] = dict(
+            out_dir=out_dir, year=year, csv_paths=csv_paths,
+            txns=[t for t in txns if t.date.year == year],
+            rows=year_rows, claimed=claimed & {r.id for r in year_rows},
+            matched=pairs_in(matched, year), probable=pairs_in(probable, year),
+            discrepancies=pairs_in(discrepancies, year),
+            missing=[t for t in missing if t.date.year == year],
+        )
 
-    click.echo('')
-    click.echo(f'  matched            {len(matched):4d}   EUR {eur_total([t for t, *_ in matched]):>10,.2f}')
-    click.echo(f'  probable (verify)  {len(probable):4d}   EUR {eur_total([t for t, *_ in probable]):>10,.2f}')
-    click.echo(f'  amount discrepancy {len(discrepancies):4d}   EUR {eur_total([t for t, *_ in discrepancies]):>10,.2f}')
-    click.echo(f'  MISSING business   {len(business):4d}   EUR {eur_total(business):>10,.2f}')
-    click.echo(f'  missing personal   {len(personal):4d}   EUR {eur_total(personal):>10,.2f}')
-    click.echo('')
-    click.echo(f'  {report_md}')
-    click.echo(f'  {missing_csv}')
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    if len(years) == 1:
+        reports = {years[0]: write_reports(**jobs_by_year[years[0]])}
+    else:
+        with ProcessPoolExecutor(min(jobs or os.cpu_count(), len(years))) as pool:
+            futures = {year: pool.submit(write_reports, **job)
+                       for year, job in jobs_by_year.items()}
+            reports = {year: future.result() for year, future in futures.items()}
+
+    for year in years:
+        job = jobs_by_year[year]
+        matched, probable, discrepancies = job['matched'], job['probable'], job['discrepancies']
+        business = [t for t in job['missing'] if not t.is_personal]
+        personal = [t for t in job['missing'] if t.is_personal]
+        report_md, missing_csv = reports[year]
+
+        click.echo('')
+        if len(years) > 1:
+            click.echo(f'{year}')
+        click.echo(f'  matched            {len(matched):4d}   EUR {eur_total([t for t, *_ in matched]):>10,.2f}')
+        click.echo(f'  probable (verify)  {len(probable):4d}   EUR {eur_total([t for t, *_ in probable]):>10,.2f}')
+        click.echo(f'  amount discrepancy {len(discrepancies):4d}   EUR {eur_total([t for t, *_ in discrepancies]):>10,.2f}')
+        click.echo(f'  MISSING business   {len(business):4d}   EUR {eur_total(business):>10,.2f}')
+        click.echo(f'  missing personal   {len(personal):4d}   EUR {eur_total(personal):>10,.2f}')
+        click.echo('')
+        click.echo(f'  {report_md}')
+        click.echo(f'  {missing_csv}')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,103 @@
+"""
+Conditional GETs and cached responses for the read endpoints.
+
+The dashboard and summary pages fetch the stats, years, summaries and expense
+list on every visit, and each used to be recomputed even when nothing had been
+written since. Every writer now bumps `data_version` in its own transaction
+(see rollup.py), so the version says whether anything could have changed:
+
+- the ETag of a response is the version it was made at, and a client sending
+  it back in If-None-Match gets a 304 with no query beyond reading the version;
+- a response this worker has already made for the same endpoint and arguments
+  at the current version is served from memory, up to RESPONSE_CACHE_MB.
+
+The current year is part of the ETag too, as it is what /api/stats and
+/api/years default to.
+"""
+
+import functools
+import threading
+from collections import OrderedDict
+from datetime import date
+
+from flask import Response, current_app, request
+
+from models import db, DataVersion
+
+
+def current_version() -> int:
+    return db.session.execute(db.select(DataVersion.version)).scalar() or 0
+
+
+class ResponseCache:
+    """Response bodies by (endpoint, arguments, version), least recently used out first."""
+
+    def __init__(self, max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.version = None  # the newest version an entry was stored for
+        self._entries = OrderedDict()  # key -> (body, mimetype)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.max_bytes = app.config['RESPONSE_CACHE_MB'] * 1024 * 1024
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, version: int, body: bytes, mimetype: str):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if self.version is not None and version < self.version:
+                # Made by a request that started before the latest write
+                return
+            if version != self.version:
+                # Nothing can ask for an older version again
+                self._entries.clear()
+                self._size = 0
+                self.version = version
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old[0])
+            self._entries[key] = (body, mimetype)
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+
+cache = ResponseCache()
+
+
+def versioned(view):
+    """Serve a GET view with a data-version ETag, from the cache where possible."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method != 'GET':
+            return view(*args, **kwargs)
+
+        # Read before the view's queries, so what it returns is at least this new
+        version = current_version()
+        etag = f'{version}-{date.today().year}'
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            key = (request.endpoint, tuple(sorted(request.args.items(multi=True))), etag)
+            cached = cache.get(key)
+            if cached is not None:
+                response = Response(cached[0], mimetype=cached[1])
+            else:
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                cache.put(key, version, response.get_data(), response.mimetype)
+        response.set_etag(etag)
+        # Stored by the browser, but checked with us before each use
+        response.cache_control.no_cache = True
+        return response
+    return wrapper
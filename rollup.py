@@ -0,0 +1,76 @@
+"""
+Monthly EUR totals, kept up to date as expenses are written.
+
+`monthly_rollup` holds one row per (year, month, type, cost_category) with the
+EUR sum and row count of the dated expenses in it, so the summary pages read a
+few hundred rows instead of aggregating the whole expenses table. NULL
+categories are stored as '' because they are part of the key.
+
+Every writer keeps it current in its own transaction: retract the rows it is
+about to change or delete, write, then add back the rows it inserted or changed.
+The functions here take a DB-API cursor, so the app (through the session's
+connection) and the psycopg2 scripts share them.
+
+If it ever drifts, `flask --app app rebuild-rollups` recomputes it.
+
+Both also bump `data_version`, the counter the read endpoints build their
+ETags and cached responses on (see response_cache.py). It is bumped in the
+writer's transaction, so a new version and the change it stands for become
+visible together.
+"""
+
+# Adds (sign=1) or removes (sign=-1) the given expenses' contribution. Sorted, so
+# concurrent writers lock the rollup rows in the same order and cannot deadlock.
+ADJUST = '''
+    INSERT INTO monthly_rollup AS r (year, month, type, cost_category, total_eur, count)
+    SELECT extract(year FROM expense_date)::int,
+           extract(month FROM expense_date)::int,
+           type,
+           coalesce(cost_category, ''),
+           %(sign)s * coalesce(sum(amount_eur), 0),
+           %(sign)s * count(*)
+    FROM expenses
+    WHERE id = ANY(%(ids)s) AND expense_date IS NOT NULL
+    GROUP BY 1, 2, 3, 4
+    ORDER BY 1, 2, 3, 4
+    ON CONFLICT (year, month, type, cost_category) DO UPDATE
+    SET total_eur = r.total_eur + EXCLUDED.total_eur,
+        count = r.count + EXCLUDED.count
+'''
+
+# Taken first by every writer, before any rollup row or table lock, so they
+# all queue in the same order.
+BUMP = '''
+    INSERT INTO data_version (id, version) VALUES (1, 1)
+    ON CONFLICT (id) DO UPDATE SET version = data_version.version + 1
+'''
+
+# Recomputes the table from scratch. The lock holds writers off until the new
+# totals are committed, so none of their adjustments land on the old ones.
+REBUILD = BUMP.rstrip() + ''';
+    LOCK TABLE monthly_rollup IN EXCLUSIVE MODE;
+    DELETE FROM monthly_rollup;
+    INSERT INTO monthly_rollup (year, month, type, cost_category, total_eur, count)
+    SELECT extract(year FROM expense_date)::int,
+           extract(month FROM expense_date)::int,
+           type,
+           coalesce(cost_category, ''),
+           coalesce(sum(amount_eur), 0),
+           count(*)
+    FROM expenses
+    WHERE expense_date IS NOT NULL
+    GROUP BY 1, 2, 3, 4;
+'''
+
+
+def adjust(cur, ids, sign):
+    """Add (sign=1) or retract (sign=-1) these expenses in the rollup."""
+    ids = list(ids)
+    if ids:
+        cur.execute(BUMP)
+        cur.execute(ADJUST, {'ids': ids, 'sign': sign})
+
+
+def rebuild(cur):
+    """Recompute every rollup row from the expenses table."""
+    cur.execute(REBUILD)
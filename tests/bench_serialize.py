@@ -0,0 +1,133 @@
+"""
+Times the expense list's serializer (serialize.py) against what it replaced:
+loading Expense objects, to_dict() and jsonify. Every body must be
+byte-identical to the old one; the script exits 1 if any is not.
+
+Runs on the newest rows of DATABASE_URL, once per --rows count. With
+--synthetic it first inserts that many rows, with the values the encoders
+treat differently (non-ASCII and DEL, tiny and zero exchange rates, NULLs),
+and rolls them back when done.
+
+    python tests/bench_serialize.py --rows 10000 --rows 100000 --synthetic
+
+Not collected by pytest: it needs a populated database and takes a while.
+"""
+
+import hashlib
+import os
+import sys
+import time
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import jsonify  # noqa: E402
+from sqlalchemy import select  # noqa: E402
+
+import serialize  # noqa: E402
+from app import app  # noqa: E402
+from models import db, Expense  # noqa: E402
+
+# Newest first, as GET /api/expenses lists them
+ORDER = (Expense.created_at.desc(), Expense.id.desc())
+
+SYNTHETIC = '''
+    INSERT INTO expenses (amount, type, cost_category, currency, explanation, tags,
+                          amount_eur, exchange_rate, source_type, vendor_name,
+                          invoice_number, has_attachments, expense_date, email_date,
+                          created_at)
+    SELECT (i % 1000000) / 100.0 + 0.01,
+           CASE WHEN i % 5 = 0 THEN 'income' ELSE 'cost' END,
+           CASE WHEN i % 5 = 0 THEN NULL ELSE 'operations' END,
+           (ARRAY['EUR', 'USD', 'GBP', 'JPY'])[i % 4 + 1],
+           CASE WHEN i % 3 = 0 THEN NULL ELSE 'Row ' || i || ' für Café "Zürich" \\ ' || chr(127) END,
+           CASE WHEN i % 4 = 0 THEN NULL ELSE ARRAY['bench', 'größe', '😀'] END,
+           CASE i % 7 WHEN 0 THEN 0 WHEN 1 THEN NULL ELSE (i % 100000) / 97.0 END,
+           CASE i % 13 WHEN 0 THEN 0.000001 WHEN 1 THEN 0.00005 WHEN 2 THEN 0
+                       WHEN 3 THEN NULL ELSE 1 + (i % 1000) / 7777.0 END,
+           'bench',
+           (ARRAY['Notion', 'Café Zürich', '😀 Emoji Ltd', 'Tab' || chr(9), NULL])[i % 5 + 1],
+           'BENCH-' || i,
+           i % 2 = 0,
+           CASE WHEN i % 17 = 0 THEN NULL ELSE date '2024-01-01' + i % 700 END,
+           CASE WHEN i % 2 = 0 THEN NULL ELSE timestamp '2024-01-01' + i * interval '1 minute' END,
+           -- Newer than anything already there, so they are the rows benchmarked
+           newest + interval '1 day' - i * interval '1 millisecond'
+    FROM generate_series(1, :rows) AS i,
+         (SELECT coalesce(max(created_at), now()) AS newest FROM expenses) AS e
+'''
+
+
+def old_body(rows: int) -> bytes:
+    expenses = Expense.query.order_by(*ORDER).limit(rows).all()
+    body = jsonify([expense.to_dict() for expense in expenses]).get_data()
+    # Each request started with an empty session, and so does each run
+    db.session.expunge_all()
+    return body
+
+
+def new_body(rows: int) -> bytes:
+    query = select(*serialize.COLUMNS).order_by(*ORDER).limit(rows)
+    return serialize.json_response(serialize.expense_rows(query)).get_data()
+
+
+def stdlib_body(rows: int) -> bytes:
+    orjson, serialize.orjson = serialize.orjson, None
+    try:
+        return new_body(rows)
+    finally:
+        serialize.orjson = orjson
+
+
+def best_of(repeat: int, run, rows: int):
+    """The body and the fastest of `repeat` runs, in milliseconds."""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = run(rows)
+        elapsed = (time.perf_counter() - started) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return body, best
+
+
+@click.command()
+@click.option('--rows', multiple=True, type=int, default=(10000, 100000), show_default=True,
+              help='Newest rows to serialize; repeat for several sizes.')
+@click.option('--repeat', default=3, show_default=True, help='Runs per timing; the best counts.')
+@click.option('--synthetic', is_flag=True,
+              help='Insert max(--rows) rows first and roll them back afterwards.')
+def main(rows, repeat, synthetic):
+    paths = [('to_dict + jsonify', old_body), ('serialize, stdlib', stdlib_body)]
+    if serialize.orjson is not None:
+        paths.append(('serialize, orjson', new_body))
+    else:
+        click.echo('orjson is not installed: timing the stdlib encoder only.')
+
+    identical = True
+    with app.test_request_context():
+        if synthetic:
+            db.session.execute(db.text(SYNTHETIC), {'rows': max(rows)})
+        try:
+            for count in rows:
+                # Warm, so neither side pays for the first query's planning
+                old_body(min(count, 100))
+                baseline = None
+                for label, run in paths:
+                    body, elapsed = best_of(repeat, run, count)
+                    baseline = baseline or (body, elapsed)
+                    same = body == baseline[0]
+                    identical &= same
+                    click.echo(f'{count:>7} rows  {label:<18} {elapsed:9.1f} ms  '
+                               f'x{baseline[1] / elapsed:4.1f}  {len(body):>12,} B  '
+                               f'sha256 {hashlib.sha256(body).hexdigest()[:12]}  '
+                               f'{"identical" if same else "DIFFERENT"}')
+        finally:
+            db.session.rollback()
+
+    if not identical:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+"""
+Shared fixtures. Tests that need Postgres use DATABASE_URL, as the app does,
+and are skipped when nothing answers there.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def app():
+    from sqlalchemy.exc import OperationalError
+
+    from app import app
+    from models import db
+
+    with app.app_context():
+        try:
+            db.session.execute(db.text('SELECT 1'))
+        except OperationalError as e:
+            pytest.skip(f'No database at DATABASE_URL: {e}')
+    return app
@@ -0,0 +1,69 @@
+"""
+The year-scoped endpoints filter with predicates the expense_date indexes can
+serve (see year_filter in app.py).
+
+Each endpoint is called and the statements it runs on `expenses` are EXPLAINed
+with sequential scans disabled. A filter no index can serve, such as
+extract('year', expense_date) = 2024, still plans as a scan of the whole table
+then, so this holds on a table of any size, even an empty one.
+"""
+
+import re
+
+import pytest
+from sqlalchemy import event
+
+import response_cache
+from models import db
+
+# And whether the year must be an index condition. A page of the listing may
+# instead walk the (created_at, id) index newest first and stop at the limit.
+ENDPOINTS = [
+    ('/api/expenses?year=2024', True),
+    ('/api/expenses?year=2024&limit=50', False),
+    ('/api/expenses?year=2024&type=cost', True),
+    ('/api/stats?year=2024', True),
+    ('/api/export?year=2024&format=csv', True),
+]
+
+# An index condition on expense_date, from an index or a bitmap index scan
+DATE_INDEX_CONDITION = re.compile(r'(Index|Recheck) Cond: .*expense_date')
+
+
+@pytest.fixture
+def statements(app):
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if re.search(r'\bFROM expenses\b', statement):
+            captured.append((statement, parameters))
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', capture)
+    yield captured
+    event.remove(engine, 'before_cursor_execute', capture)
+
+
+def explain(app, statement, parameters) -> str:
+    with app.app_context(), db.engine.connect() as connection:
+        cursor = connection.connection.cursor()
+        cursor.execute('SET enable_seqscan = off')
+        cursor.execute('EXPLAIN ' + statement, parameters)
+        return '\n'.join(line for line, in cursor.fetchall())
+
+
+@pytest.mark.parametrize('url, by_date', ENDPOINTS)
+def test_year_filter_uses_the_expense_date_indexes(app, statements, monkeypatch, url, by_date):
+    # Computed, not answered from memory
+    monkeypatch.setattr(response_cache.cache, 'max_bytes', 0)
+    response = app.test_client().get(url)
+    response.get_data()
+    assert response.status_code == 200
+    assert statements, f'{url} ran no query on expenses'
+
+    for statement, parameters in statements:
+        plan = explain(app, statement, parameters)
+        assert 'Seq Scan on expenses' not in plan, plan
+        if by_date:
+            assert DATE_INDEX_CONDITION.search(plan), plan
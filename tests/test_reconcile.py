@@ -0,0 +1,146 @@
+"""
+run_pass() finds its candidates through RowIndex (see LOOKUPS in reconcile.py).
+A lookup may return extra rows but must never miss one, so each pass has to
+pair exactly as comparing every transaction with every row did.
+
+The fixtures in fixtures/reconcile are a small statement and expense table with
+an answer known for every line, including amounts right at amount_near()'s 2%
+and EUR 1 limits and a cent past them. A seeded random set adds more of the
+same, with amount keys in two currencies and rows competing for a transaction.
+"""
+
+import csv
+import os
+import random
+from datetime import date, timedelta
+from decimal import Decimal
+
+import pytest
+
+import reconcile
+from reconcile import PASSES, DbRow, Txn, load_csv, run_pass
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures', 'reconcile')
+
+# Wise ID -> (pass label, expense id) for each transaction paired in the fixture
+GOLDEN = {
+    'CARD-1': ('exact', 1),
+    'CARD-9': ('exact', 8),          # a day nearer than CARD-8
+    'CARD-2': ('near-date', 2),      # the USD target amount, 7 days apart
+    'CARD-3': ('aliased', 3),        # 13 days apart, "Figma" = "Figma Inc"
+    'CARD-4': ('probable', 4),       # 102.00 USD is 100.00 USD + 2%
+    'CARD-6': ('probable', 6),       # 21.00 EUR is 20.00 EUR + EUR 1
+    'CARD-10': ('probable', 10),     # 0.50 USD off beats 0.90 EUR off
+    'CARD-14': ('probable', 12),     # + 2% exactly; 1020.01 is a day nearer
+    'CARD-15': ('probable', 14),     # - 2% exactly; 489.99 is a day nearer
+    'CARD-16': ('probable', 16),     # - EUR 1 exactly; 3.99 is a day nearer
+    'CARD-8': ('discrepancy', 9),    # Claude -> Anthropic, same day
+}
+# A cent past the limit: CARD-5 (102.01 USD), CARD-7 (21.01 EUR). Personal: CARD-11.
+GOLDEN_MISSING = {'CARD-5', 'CARD-7', 'CARD-11'}
+
+
+def brute_force_pass(txns, rows, window, predicate):
+    """run_pass() as it was before RowIndex: every transaction against every row."""
+    candidates = []
+    for txn in txns:
+        for row in rows:
+            distance = abs((row.date - txn.date).days)
+            if distance > window:
+                continue
+            ok, delta = predicate(txn, row)
+            if ok:
+                candidates.append((distance, delta or Decimal('0'), txn, row))
+
+    candidates.sort(key=lambda c: (c[0], c[1], c[2].idx, c[3].id))
+
+    taken_txns, taken_rows, pairs = set(), set(), []
+    for distance, delta, txn, row in candidates:
+        if txn.idx in taken_txns or row.id in taken_rows:
+            continue
+        taken_txns.add(txn.idx)
+        taken_rows.add(row.id)
+        pairs.append((txn, row, distance, delta))
+    return pairs
+
+
+def load_fixture():
+    txns, _ = load_csv(os.path.join(FIXTURES, 'statement.csv'), [2025])
+    with open(os.path.join(FIXTURES, 'expenses.csv'), newline='', encoding='utf-8') as handle:
+        rows = [DbRow((int(r['id']), date.fromisoformat(r['expense_date']),
+                       Decimal(r['amount']), r['currency'], Decimal(r['amount_eur']),
+                       r['vendor_name'] or None, r['explanation'] or None,
+                       r['cost_category']))
+                for r in csv.DictReader(handle)]
+    return txns, rows
+
+
+def random_fixture(seed, count=300):
+    """Transactions, and rows near them in date and amount, some a cent past
+    the near-amount tolerance either way."""
+    rng = random.Random(seed)
+    vendors = ['Notion Labs', 'Claude', 'Superhuman', 'Slack', 'Zoom', 'AWS', 'Buffer Plan']
+    start = date(2025, 1, 1)
+    txns, rows = [], []
+    for n in range(count):
+        day = start + timedelta(days=rng.randrange(365))
+        amount = Decimal(rng.choice([rng.randrange(100, 5000), rng.randrange(5000, 200000)])) / 100
+        target = (amount * Decimal('1.08')).quantize(Decimal('0.01'))
+        two_currencies = rng.random() < 0.5
+        txns.append(Txn(n, (f'R-{n}', f'{day.isoformat()} 12:00:00', rng.choice(vendors),
+                            'General', str(amount), 'EUR',
+                            str(target if two_currencies else amount),
+                            'USD' if two_currencies else 'EUR', '1')))
+
+        for m in range(rng.randrange(3)):
+            currency, base = ('USD', target) if two_currencies and rng.random() < 0.5 \
+                else ('EUR', amount)
+            tolerance = max(Decimal('1.00'), base * Decimal('0.02'))
+            offset = rng.choice([Decimal('0'), tolerance, -tolerance,
+                                 tolerance + Decimal('0.01'), -tolerance - Decimal('0.01'),
+                                 Decimal(rng.randrange(-300, 300)) / 100])
+            vendor = rng.choice(vendors + ['Anthropic', 'Superhuman Mail', 'Notion', None])
+            rows.append(DbRow((len(rows) + 1, day + timedelta(days=rng.randrange(-16, 17)),
+                               base + offset, currency, base + offset, vendor, None,
+                               'operations')))
+    return txns, rows
+
+
+def summary(pairs):
+    return [(txn.idx, row.id, distance, delta) for txn, row, distance, delta in pairs]
+
+
+def test_fixture_reconciles_as_expected():
+    txns, rows = load_fixture()
+    matched, probable, discrepancies, missing = reconcile.reconcile(txns, rows)
+
+    paired = {txn.wise_id: (label, row.id)
+              for txn, row, label, _, _ in matched + probable + discrepancies}
+    assert paired == GOLDEN
+    assert {txn.wise_id for txn in missing} == GOLDEN_MISSING
+
+
+@pytest.mark.parametrize('fixture', ['golden', 'random-1', 'random-2', 'random-3'])
+@pytest.mark.parametrize('label, window, predicate, outcome', PASSES,
+                         ids=[label for label, *_ in PASSES])
+def test_indexed_pass_matches_brute_force(fixture, label, window, predicate, outcome):
+    txns, rows = load_fixture() if fixture == 'golden' else random_fixture(fixture)
+    indexed = run_pass(txns, rows, window, predicate)
+    assert summary(indexed) == summary(brute_force_pass(txns, rows, window, predicate))
+    if fixture == 'golden' and label == 'probable':
+        # Each limit reached exactly is in, a cent past it is out
+        assert {row.id for _, row, _, _ in indexed} >= {4, 6, 12, 14, 16}
+        assert not {row.id for _, row, _, _ in indexed} & {5, 7, 13, 15, 17}
+
+
+@pytest.mark.parametrize('seed', ['random-1', 'random-2', 'random-3'])
+def test_reconcile_matches_brute_force(monkeypatch, seed):
+    txns, rows = random_fixture(seed)
+    indexed = reconcile.reconcile(txns, rows)
+    monkeypatch.setattr(reconcile, 'run_pass', brute_force_pass)
+    brute_force = reconcile.reconcile(txns, rows)
+
+    for got, expected in zip(indexed[:3], brute_force[:3]):
+        assert [(t.idx, r.id, label, d, delta) for t, r, label, d, delta in got] == \
+               [(t.idx, r.id, label, d, delta) for t, r, label, d, delta in expected]
+    assert [t.idx for t in indexed[3]] == [t.idx for t in brute_force[3]]